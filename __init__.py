@@ -1,23 +1,31 @@
 from .comfyui_structured_outputs import DOTENV_FILE
+from .comfyui_structured_outputs.backends import prewarm_from_env
+from .comfyui_structured_outputs.metrics import register_metrics_route
 from .comfyui_structured_outputs.utils.loggable import Loggable
 from .nodes.attribute import AttributeNode
 from .nodes.attribute_to_text import AttributeToTextNode
+from .nodes.fused_structured_output import FusedStructuredOutputNode
 from .nodes.structured_output import StructuredOutputNode
 
 NODE_CLASS_MAPPINGS = {
     AttributeNode.NAME: AttributeNode,
     StructuredOutputNode.NAME: StructuredOutputNode,
     AttributeToTextNode.NAME: AttributeToTextNode,
+    FusedStructuredOutputNode.NAME: FusedStructuredOutputNode,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     AttributeNode.NAME: "Attribute",
     StructuredOutputNode.NAME: "Structured Output",
     AttributeToTextNode.NAME: "Attribute to Text",
+    FusedStructuredOutputNode.NAME: "Fused Structured Output",
 }
 
 __all__ = ["NODE_CLASS_MAPPINGS"]
 
+# serves request metrics on the ComfyUI server, see metrics.py
+register_metrics_route()
+
 Loggable.log().info(
     f"[Structured Output] Loaded {len(NODE_CLASS_MAPPINGS)} Structured Output nodes"
 )
@@ -27,3 +35,6 @@ if not DOTENV_FILE.exists():
         f"File '{DOTENV_FILE}' does not exist, please add a .env file with your API keys\n"
         f"See the README for more information"
     )
+else:
+    # optionally open the API connection in the background, see `PREWARM_CLIENT` in .env.example
+    prewarm_from_env(DOTENV_FILE)
@@ -0,0 +1,4 @@
+"""
+Benchmarks for the plugin's hot paths, run as modules from the project root, e.g.
+`python -m benchmarks.bench_image_encoding`.
+"""
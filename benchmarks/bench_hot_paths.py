@@ -0,0 +1,302 @@
+"""
+Micro-benchmarks of the plugin's CPU hot paths: image (de)serialization, fingerprinting and caching, attribute type and model creation,
+and the attribute and text nodes.
+
+Usage, from the project root::
+
+    # run, and save the results as the baseline
+    python -m benchmarks.bench_hot_paths --save-baseline
+    # after a change, compare against the baseline, exits with 1 if any case regressed
+    python -m benchmarks.bench_hot_paths --compare
+    # only some cases, with fewer sizes
+    python -m benchmarks.bench_hot_paths --quick --filter base64
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+from collections.abc import Callable, Iterator
+from pathlib import Path
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    clear_model_caches,
+    create_attribute_model,
+    string_to_type,
+)
+from comfyui_structured_outputs.encoded_image_cache import EncodedImageCache
+from comfyui_structured_outputs.utils.image_utils import (
+    base64_to_tensor,
+    encode_image,
+    tensor_fingerprint,
+    tensor_to_base64,
+)
+from comfyui_structured_outputs.utils.loggable import Loggable
+from logs import LOGS_DIR
+
+from .bench_image_encoding import synthetic_image
+from .harness import (
+    BASELINE_FILE,
+    DEFAULT_REGRESSION_THRESHOLD,
+    RESULTS_DIR,
+    BenchResult,
+    compare_results,
+    format_us,
+    import_project_module,
+    load_results,
+    save_results,
+    time_fn,
+)
+
+# (width, height), from SD 1.5 outputs to 8K
+IMAGE_SIZES: list[tuple[int, int]] = [
+    (512, 512),
+    (1024, 1024),
+    (2048, 2048),
+    (3840, 2160),
+    (7680, 4320),
+]
+QUICK_IMAGE_SIZES: list[tuple[int, int]] = [(512, 512), (1024, 1024)]
+BATCH_SIZES: list[int] = [1, 4, 16]
+ATTRIBUTE_COUNTS: list[int] = [1, 10, 100, 500]
+OPTION_COUNTS: list[int] = [0, 2, 10, 100, 1000]
+
+# a case is a name and a function to time
+Case = tuple[str, Callable[[], object]]
+
+
+def image_cases(quick: bool) -> Iterator[Case]:
+    for width, height in QUICK_IMAGE_SIZES if quick else IMAGE_SIZES:
+        image = synthetic_image(width, height)
+        encoded = tensor_to_base64(image)
+        yield (
+            f"tensor_to_base64[{width}x{height}]",
+            lambda image=image: tensor_to_base64(image),
+        )
+        yield (
+            f"base64_to_tensor[{width}x{height}]",
+            lambda encoded=encoded: base64_to_tensor(encoded),
+        )
+
+    # batches only encode their first image, see `tensor_to_base64`
+    for batch_size in BATCH_SIZES:
+        batch = synthetic_image(512, 512).repeat(batch_size, 1, 1, 1)
+        yield (
+            f"tensor_to_base64[batch={batch_size}]",
+            lambda batch=batch: tensor_to_base64(batch),
+        )
+
+    # fingerprints hash the whole batch, the cache key of every request with an image
+    width, height = QUICK_IMAGE_SIZES[-1] if quick else (3840, 2160)
+    for batch_size in BATCH_SIZES:
+        batch = synthetic_image(width, height).repeat(batch_size, 1, 1, 1)
+        yield (
+            f"tensor_fingerprint[{width}x{height},batch={batch_size}]",
+            lambda batch=batch: tensor_fingerprint(batch),
+        )
+        yield (
+            f"tensor_fingerprint[{width}x{height},batch={batch_size},stride=16]",
+            lambda batch=batch: tensor_fingerprint(batch, sample_stride=16),
+        )
+
+    # every node after the first sending the same image gets the cached payload, see `EncodedImageCache`
+    cache = EncodedImageCache(max_bytes=1 << 30)
+    for width, height in QUICK_IMAGE_SIZES if quick else IMAGE_SIZES[:-1]:
+        image = synthetic_image(width, height)
+        cache.encode(image)
+        yield (
+            f"encode_image[{width}x{height}]",
+            lambda image=image: encode_image(image),
+        )
+        yield (
+            f"encoded_image_cache_hit[{width}x{height}]",
+            lambda image=image: cache.encode(image),
+        )
+
+
+def option_list(count: int) -> str:
+    return ", ".join(str(index) for index in range(count))
+
+
+def attribute_cases(quick: bool) -> Iterator[Case]:
+    for count in OPTION_COUNTS[:3] if quick else OPTION_COUNTS:
+        options = option_list(count)
+        yield (
+            f"string_to_type[options={count}]",
+            lambda options=options: string_to_type("int", options),
+        )
+
+    for count in ATTRIBUTE_COUNTS[:2] if quick else ATTRIBUTE_COUNTS:
+        attributes = [
+            create_attribute_model(f"attribute_{index}", "str")
+            for index in range(count)
+        ]
+
+        def build_uncached(attributes=attributes):
+            # models are memoized, so time building them from scratch as well as a cache hit
+            clear_model_caches()
+            attributes_to_model(attributes)
+
+        yield (f"attributes_to_model[attributes={count}]", build_uncached)
+        yield (
+            f"attributes_to_model_cached[attributes={count}]",
+            lambda attributes=attributes: attributes_to_model(attributes),
+        )
+
+
+def node_cases(quick: bool) -> Iterator[Case]:
+    attribute_node = import_project_module("nodes.attribute").AttributeNode()
+    text_node = import_project_module("nodes.attribute_to_text").AttributeToTextNode()
+    # the caches used by the nodes
+    node_attribute_utils = import_project_module(
+        "comfyui_structured_outputs.attribute_utils"
+    )
+
+    for count in OPTION_COUNTS[:3] if quick else OPTION_COUNTS:
+        options = option_list(count)
+
+        def init_attribute(options=options):
+            node_attribute_utils.clear_model_caches()
+            attribute_node.init_attribute(
+                ["count"], ["int"], None, [""], [""], [options]
+            )
+
+        yield (f"AttributeNode.init_attribute[options={count}]", init_attribute)
+
+    for count in ATTRIBUTE_COUNTS[:2] if quick else ATTRIBUTE_COUNTS:
+        names = [f"attribute_{index}" for index in range(count)]
+        attributes_model = attributes_to_model(
+            [create_attribute_model(name, "str") for name in names]
+        )
+        attributes = attributes_model.model_validate(
+            {name: {"key": name, "value": f"value {name}"} for name in names}
+        )
+        format_text = " ".join(f"{{{name}}}" for name in names)
+        yield (
+            f"AttributeToTextNode.get_text[attributes={count}]",
+            lambda attributes=attributes, format_text=format_text: text_node.get_text(
+                [attributes], [format_text], None, None
+            ),
+        )
+
+    # rendering one template across the results of a batch
+    attributes_model = attributes_to_model(
+        [create_attribute_model(name, "str") for name in ("subject", "style")]
+    )
+    results = [
+        attributes_model.model_validate(
+            {
+                "subject": {"key": "subject", "value": f"subject {index}"},
+                "style": {"key": "style", "value": "watercolor"},
+            }
+        )
+        for index in range(1000)
+    ]
+    yield (
+        "AttributeToTextNode.get_text[batch=1000]",
+        lambda: text_node.get_text(
+            results, ["A {style} painting of {subject}"], None, None, [True]
+        ),
+    )
+
+
+SUITES: dict[str, Callable[[bool], Iterator[Case]]] = {
+    "image": image_cases,
+    "attribute": attribute_cases,
+    "node": node_cases,
+}
+
+
+def run(
+    quick: bool = False, name_filter: str | None = None, repeats: int = 5
+) -> dict[str, BenchResult]:
+    """
+    Runs the benchmark cases, returning their results by case name.
+
+    :param quick: Use fewer and smaller sizes
+    :param name_filter: Only run cases whose name contains this
+    :param repeats: Timed repeats per case
+    """
+    results: dict[str, BenchResult] = {}
+    for cases in SUITES.values():
+        for name, fn in cases(quick):
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = time_fn(fn, repeats=repeats)
+            Loggable.log().info(
+                f"{name:>50}: {format_us(results[name].median_us):>10} "
+                f"(min {format_us(results[name].min_us)}, {results[name].calls_per_repeat} calls x {repeats})"
+            )
+    return results
+
+
+def report_comparison(
+    results: dict[str, BenchResult],
+    baseline_path: Path,
+    threshold: float = DEFAULT_REGRESSION_THRESHOLD,
+) -> bool:
+    """Logs the results against the baseline, returning True if any case regressed."""
+    comparisons = compare_results(results, load_results(baseline_path))
+    regressed = False
+    for comparison in comparisons:
+        is_regression = comparison.is_regression(threshold)
+        regressed |= is_regression
+        Loggable.log().log(
+            logging.WARNING if is_regression else logging.INFO,
+            f"{comparison.name:>50}: {format_us(comparison.baseline_us):>10} -> "
+            f"{format_us(comparison.current_us):>10} ({comparison.ratio:.2f}x)"
+            f"{'  REGRESSION' if is_regression else ''}",
+        )
+    if not comparisons:
+        Loggable.log().warning(f"No cases in common with baseline '{baseline_path}'")
+    return regressed
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller sizes")
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / "latest.json",
+        help="where to save the results",
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="also save as the baseline"
+    )
+    parser.add_argument(
+        "--compare", action="store_true", help="compare against the baseline"
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="relative slowdown flagged as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick, name_filter=args.filter, repeats=args.repeats)
+    save_results(results, args.output)
+    Loggable.log().info(f"Saved {len(results)} results to '{args.output}'")
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        Loggable.log().info(f"Saved baseline to '{args.baseline}'")
+
+    if args.compare:
+        if not args.baseline.exists():
+            Loggable.log().error(
+                f"Baseline '{args.baseline}' does not exist, run with --save-baseline first"
+            )
+            return 2
+        return int(report_comparison(results, args.baseline, args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    Loggable.setup_logs(log_path=LOGS_DIR / "benchmarks.log")
+    sys.exit(main())
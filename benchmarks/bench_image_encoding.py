@@ -0,0 +1,77 @@
+"""
+Compares the latency and payload size of the image encoding modes used for VLM requests.
+"""
+
+from __future__ import annotations
+
+import statistics
+import time
+
+import torch
+
+from comfyui_structured_outputs.utils.image_utils import encode_image
+from comfyui_structured_outputs.utils.loggable import Loggable
+from logs import LOGS_DIR
+
+# (width, height) of typical ComfyUI outputs
+IMAGE_SIZES: list[tuple[int, int]] = [(1024, 1024), (2048, 2048), (3840, 2160)]
+
+# name -> `encode_image` kwargs
+ENCODING_MODES: dict[str, dict] = {
+    "png_full": {"image_format": "PNG"},
+    "png_tiled": {"image_format": "PNG", "detail": "auto"},
+    "jpeg_tiled": {"image_format": "JPEG", "quality": 85, "detail": "auto"},
+    "webp_tiled": {"image_format": "WEBP", "quality": 80, "detail": "auto"},
+    "jpeg_low": {"image_format": "JPEG", "quality": 85, "detail": "low"},
+}
+
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> torch.Tensor:
+    """
+    Returns a [1, H, W, 3] float image with smooth gradients and some noise, which compresses more like a
+    real render than pure noise.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    y = torch.linspace(0, 1, height).view(height, 1, 1)
+    x = torch.linspace(0, 1, width).view(1, width, 1)
+    phase = torch.tensor([0.0, 2.0, 4.0]).view(1, 1, 3)
+    image = 0.5 + 0.5 * torch.sin(6 * x + 4 * y + phase)
+    image += 0.05 * torch.randn((height, width, 3), generator=generator)
+    return image.clamp(0, 1).unsqueeze(0)
+
+
+def bench_encode(image: torch.Tensor, repeats: int, **encode_kwargs) -> dict:
+    """Returns the median encode time (ms) and payload size (KiB) of encoding the image."""
+    timings: list[float] = []
+    encoded = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encoded = encode_image(image, **encode_kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "payload_kib": encoded.size_bytes / 1024,
+        "size": f"{encoded.width}x{encoded.height}",
+    }
+
+
+def main(repeats: int = 3) -> dict[str, dict[str, dict]]:
+    results: dict[str, dict[str, dict]] = {}
+    for width, height in IMAGE_SIZES:
+        image = synthetic_image(width, height)
+        image_name = f"{width}x{height}"
+        results[image_name] = {}
+        for mode_name, encode_kwargs in ENCODING_MODES.items():
+            result = bench_encode(image, repeats, **encode_kwargs)
+            results[image_name][mode_name] = result
+            Loggable.log().info(
+                f"{image_name:>10} {mode_name:>11}: {result['median_ms']:8.1f} ms, "
+                f"{result['payload_kib']:9.1f} KiB, sent as {result['size']}"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    Loggable.setup_logs(log_path=LOGS_DIR / "benchmarks.log")
+    main()
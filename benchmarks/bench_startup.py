@@ -0,0 +1,169 @@
+"""
+Startup benchmark: how long ComfyUI takes to import the plugin and register its nodes.
+
+Each repeat imports the plugin in a fresh interpreter, the way ComfyUI loads custom nodes, then calls `INPUT_TYPES`
+of every registered node. Heavy dependencies (torch, instructor, openai, ...) should only be imported by a node's
+first run, the benchmark lists any that were imported at startup.
+
+Usage, from the project root::
+
+    python -m benchmarks.bench_startup --save-baseline
+    # after a change, exits with 1 if the import got slower
+    python -m benchmarks.bench_startup --compare
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+from comfyui_structured_outputs.utils.loggable import Loggable
+from logs import LOGS_DIR
+
+from .bench_hot_paths import report_comparison
+from .harness import (
+    DEFAULT_REGRESSION_THRESHOLD,
+    RESULTS_DIR,
+    BenchResult,
+    format_us,
+    save_results,
+)
+
+PROJECT_DIR: Path = Path(__file__).parent.parent
+STARTUP_RESULTS_FILE: Path = RESULTS_DIR / "startup.json"
+STARTUP_BASELINE_FILE: Path = RESULTS_DIR / "startup_baseline.json"
+# slow to import, and only needed to run the nodes
+HEAVY_MODULES: tuple[str, ...] = (
+    "torch",
+    "numpy",
+    "PIL",
+    "instructor",
+    "openai",
+    "httpx",
+    "aiohttp",
+)
+
+# runs in a fresh interpreter, with the arguments as JSON
+STARTUP_SCRIPT: str = """
+import importlib, json, sys, time
+
+args = json.loads(sys.argv[1])
+sys.path.insert(0, args["path"])
+start = time.perf_counter()
+module = importlib.import_module(args["module"])
+import_s = time.perf_counter() - start
+loaded_by_import = [name for name in args["heavy_modules"] if name in sys.modules]
+
+start = time.perf_counter()
+for node_class in getattr(module, "NODE_CLASS_MAPPINGS", {}).values():
+    node_class.INPUT_TYPES()
+register_s = time.perf_counter() - start
+loaded_by_registration = [
+    name for name in args["heavy_modules"] if name in sys.modules and name not in loaded_by_import
+]
+print(json.dumps({
+    "import_s": import_s,
+    "register_s": register_s,
+    "loaded_by_import": loaded_by_import,
+    "loaded_by_registration": loaded_by_registration,
+}))
+"""
+
+
+def measure_startup(
+    module: str = PROJECT_DIR.name,
+    path: Path = PROJECT_DIR.parent,
+    heavy_modules: tuple[str, ...] = HEAVY_MODULES,
+) -> dict:
+    """
+    Imports the module in a fresh interpreter, returning the import and node registration times (seconds) and
+    the heavy modules each of them imported.
+
+    :param module: Module to import, the plugin package by default
+    :param path: Directory the module is imported from
+    :param heavy_modules: Modules to report, if they were imported
+    """
+    args = {"module": module, "path": str(path), "heavy_modules": list(heavy_modules)}
+    completed = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, json.dumps(args)],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=path,
+    )
+    # the plugin may log to stdout, the measurements are the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def to_result(values_s: list[float]) -> BenchResult:
+    return BenchResult(
+        median_us=statistics.median(values_s) * 1e6,
+        min_us=min(values_s) * 1e6,
+        max_us=max(values_s) * 1e6,
+        calls_per_repeat=1,
+        repeats=len(values_s),
+    )
+
+
+def run(repeats: int = 5) -> dict[str, BenchResult]:
+    """Measures the plugin's startup `repeats` times, returning the results by case name."""
+    measurements = [measure_startup() for _ in range(repeats)]
+    results = {
+        "plugin_import": to_result([m["import_s"] for m in measurements]),
+        "node_registration": to_result([m["register_s"] for m in measurements]),
+    }
+    for name, result in results.items():
+        Loggable.log().info(
+            f"{name:>20}: {format_us(result.median_us):>10} (min {format_us(result.min_us)}, {repeats} runs)"
+        )
+
+    if loaded := measurements[-1]["loaded_by_import"]:
+        Loggable.log().warning(f"Imported at startup: {', '.join(loaded)}")
+    if loaded := measurements[-1]["loaded_by_registration"]:
+        Loggable.log().warning(f"Imported by node registration: {', '.join(loaded)}")
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", type=Path, default=STARTUP_RESULTS_FILE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="also save as the baseline"
+    )
+    parser.add_argument(
+        "--compare", action="store_true", help="compare against the baseline"
+    )
+    parser.add_argument("--baseline", type=Path, default=STARTUP_BASELINE_FILE)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_THRESHOLD,
+        help="relative slowdown flagged as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(repeats=args.repeats)
+    save_results(results, args.output)
+    Loggable.log().info(f"Saved {len(results)} results to '{args.output}'")
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        Loggable.log().info(f"Saved baseline to '{args.baseline}'")
+
+    if args.compare:
+        if not args.baseline.exists():
+            Loggable.log().error(
+                f"Baseline '{args.baseline}' does not exist, run with --save-baseline first"
+            )
+            return 2
+        return int(report_comparison(results, args.baseline, args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    Loggable.setup_logs(log_path=LOGS_DIR / "benchmarks.log")
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Compares the time and peak memory of converting IMAGE tensors to uint8, per image (the original approach)
+and as a chunked batch conversion.
+"""
+
+from __future__ import annotations
+
+import time
+import tracemalloc
+from collections.abc import Callable
+
+import numpy as np
+import torch
+
+from comfyui_structured_outputs.utils.image_utils import tensor_to_uint8
+from comfyui_structured_outputs.utils.loggable import Loggable
+from logs import LOGS_DIR
+
+# (batch size, height, width)
+IMAGE_SHAPES: list[tuple[int, int, int]] = [
+    (1, 4320, 7680),
+    (16, 1024, 1024),
+    (64, 512, 512),
+]
+
+
+def per_image_uint8(image_tensor: torch.Tensor) -> list[np.ndarray]:
+    """The original conversion, with several full-size float temporaries per image."""
+    return [
+        (image.detach().cpu().numpy() * 255).clip(0, 255).astype(np.uint8)
+        for image in image_tensor
+    ]
+
+
+def measure(fn: Callable, image_tensor: torch.Tensor) -> tuple[float, float]:
+    """Returns the time (ms) and the peak traced memory (MiB) of calling `fn` on the tensor."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(image_tensor)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2**20
+
+
+def main() -> dict[str, dict[str, tuple[float, float]]]:
+    results: dict[str, dict[str, tuple[float, float]]] = {}
+    for batch_size, height, width in IMAGE_SHAPES:
+        image_tensor = torch.rand((batch_size, height, width, 3), dtype=torch.float32)
+        shape_name = f"{batch_size}x{width}x{height}"
+        results[shape_name] = {
+            "per_image": measure(per_image_uint8, image_tensor),
+            "batch": measure(tensor_to_uint8, image_tensor),
+        }
+        for name, (elapsed_ms, peak_mib) in results[shape_name].items():
+            Loggable.log().info(
+                f"{shape_name:>16} {name:>9}: {elapsed_ms:8.1f} ms, peak {peak_mib:8.1f} MiB"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    Loggable.setup_logs(log_path=LOGS_DIR / "benchmarks.log")
+    main()
@@ -0,0 +1,157 @@
+"""
+Timing, result files and baseline comparison shared by the benchmarks.
+
+Results are saved as JSON, keyed by case name (e.g. `tensor_to_base64[1024x1024]`), so a later run can be
+compared against a stored baseline and regressions flagged before a change is merged.
+"""
+
+from __future__ import annotations
+
+import gc
+import importlib
+import json
+import platform
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+from types import ModuleType
+from typing import Any, NamedTuple
+
+RESULTS_DIR: Path = Path(__file__).parent / "results"
+BASELINE_FILE: Path = RESULTS_DIR / "baseline.json"
+
+# a case is flagged if its median is this much slower than the baseline's
+DEFAULT_REGRESSION_THRESHOLD: float = 0.10
+# ignore differences below this, timer noise dominates for very fast cases
+MIN_SIGNIFICANT_DIFF_US: float = 1.0
+
+
+class BenchResult(NamedTuple):
+    """Timings of one benchmark case, in microseconds per call."""
+
+    median_us: float
+    min_us: float
+    max_us: float
+    calls_per_repeat: int
+    repeats: int
+
+
+class Comparison(NamedTuple):
+    """A benchmark case compared against the baseline."""
+
+    name: str
+    baseline_us: float
+    current_us: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current_us / self.baseline_us if self.baseline_us else 1.0
+
+    def is_regression(self, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> bool:
+        return (
+            self.ratio > 1 + threshold
+            and self.current_us - self.baseline_us > MIN_SIGNIFICANT_DIFF_US
+        )
+
+
+def time_fn(
+    fn: Callable[[], Any], repeats: int = 5, min_repeat_s: float = 0.05
+) -> BenchResult:
+    """
+    Times `fn`, calling it enough times per repeat to fill `min_repeat_s`, so that fast functions are not
+    dominated by timer resolution. Slow functions are called once per repeat.
+
+    :param fn: Function to time, called without arguments
+    :param repeats: Number of timed repeats, the median is reported
+    :param min_repeat_s: Minimum duration of a repeat
+    """
+    # warm up, and estimate the number of calls per repeat
+    start = time.perf_counter()
+    fn()
+    single_s = time.perf_counter() - start
+    calls = max(1, int(min_repeat_s / single_s)) if single_s > 0 else 1000
+
+    timings: list[float] = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            timings.append((time.perf_counter() - start) / calls * 1e6)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return BenchResult(
+        median_us=statistics.median(timings),
+        min_us=min(timings),
+        max_us=max(timings),
+        calls_per_repeat=calls,
+        repeats=repeats,
+    )
+
+
+def environment_info() -> dict[str, str]:
+    """Describes the machine the benchmarks ran on, timings are only comparable on the same machine."""
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+    for package in ("numpy", "torch", "pydantic", "PIL"):
+        if (module := sys.modules.get(package)) is not None:
+            info[package] = getattr(module, "__version__", "unknown")
+    return info
+
+
+def save_results(results: dict[str, BenchResult], path: Path) -> None:
+    """Saves the results as JSON, along with the environment they were measured in."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        "created_at": datetime.now().astimezone().isoformat(),
+        "environment": environment_info(),
+        "results": {name: result._asdict() for name, result in results.items()},
+    }
+    path.write_text(json.dumps(data, indent=2))
+
+
+def load_results(path: Path) -> dict[str, BenchResult]:
+    """Loads results saved by `save_results`."""
+    data = json.loads(path.read_text())
+    return {name: BenchResult(**result) for name, result in data["results"].items()}
+
+
+def compare_results(
+    current: dict[str, BenchResult], baseline: dict[str, BenchResult]
+) -> list[Comparison]:
+    """Compares the median timings of the cases present in both results, in the order of `current`."""
+    return [
+        Comparison(name, baseline[name].median_us, result.median_us)
+        for name, result in current.items()
+        if name in baseline
+    ]
+
+
+def format_us(value_us: float) -> str:
+    if value_us >= 1e6:
+        return f"{value_us / 1e6:.2f} s"
+    if value_us >= 1e3:
+        return f"{value_us / 1e3:.2f} ms"
+    return f"{value_us:.2f} us"
+
+
+def import_project_module(name: str) -> ModuleType:
+    """
+    Imports a module of the project (e.g. "nodes.attribute") through the project directory, the same way
+    ComfyUI imports custom nodes. Nodes use relative imports of the plugin package, so they can't be imported
+    from the project root. Note the plugin package imported this way is a separate copy, with its own caches.
+    """
+    project_dir = Path(__file__).parent.parent
+    if str(project_dir.parent) not in sys.path:
+        sys.path.insert(0, str(project_dir.parent))
+    return importlib.import_module(f"{project_dir.name}.{name}")
@@ -2,3 +2,6 @@ from pathlib import Path
 
 # .env file should be placed here
 DOTENV_FILE: Path = Path(__file__).parent.parent / ".env"
+
+# local caches (e.g. responses) are stored here
+CACHE_DIR: Path = Path(__file__).parent.parent / ".cache"
@@ -0,0 +1,271 @@
+"""
+Pools of API keys, to spread requests over several keys (or organizations) and their rate limits.
+
+A backend's API key setting (e.g. `OPENAI_KEY`) can hold several comma-separated keys, each optionally with an
+organization as `key@organization`. Every API call leases a key from the pool, round-robin or least-loaded
+(`LLM_KEY_STRATEGY`). Keys that are rate limited cool down for the `Retry-After` delay, keys that fail repeatedly
+back off, and rejected keys (401, 403) are skipped for a while. A call never waits for a rejected key: once
+every key is rejected, calls fail at once with the rejection.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import CancelledError
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import partial
+from typing import TYPE_CHECKING, NamedTuple
+
+from . import DOTENV_FILE
+from .hedging import cancellable
+from .scheduler import retry_after_s, unwrap_error
+from .utils.loggable import Loggable
+from .utils.utils import get_env, lazy_import
+
+if TYPE_CHECKING:
+    import openai
+
+    from .backends import BackendSettings
+else:
+    openai = lazy_import("openai")
+
+KEY_STRATEGIES: tuple[str, ...] = ("round_robin", "least_loaded")
+# consecutive failures (other than 429s) before a key backs off
+MAX_CONSECUTIVE_FAILURES: int = 3
+FAILURE_COOLDOWN_S: float = 30.0
+RATE_LIMIT_COOLDOWN_S: float = 1.0
+# rejected keys are retried after this long, in case the rejection was temporary
+REJECTED_COOLDOWN_S: float = 600.0
+
+
+class ApiKey(NamedTuple):
+    key: str | None
+    organization: str | None = None
+
+    @property
+    def label(self) -> str:
+        """Identifies the key in logs and metrics, without revealing it."""
+        if not self.key:
+            return "none"
+        return f"...{self.key[-4:]}" + (
+            f"@{self.organization}" if self.organization else ""
+        )
+
+
+@dataclass
+class KeyHealth:
+    in_flight: int = 0
+    successes: int = 0
+    failures: int = 0
+    rate_limited: int = 0
+    consecutive_failures: int = 0
+    cooldown_until: float = 0.0
+    # the error that rejected the key (401, 403), until a call with the key succeeds
+    rejected: BaseException | None = None
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+
+def parse_api_keys(value: str | None) -> list[ApiKey]:
+    """Parses comma-separated `key` or `key@organization` entries."""
+    keys: list[ApiKey] = []
+    for entry in (value or "").split(","):
+        if not (entry := entry.strip()):
+            continue
+        key, _, organization = entry.partition("@")
+        keys.append(ApiKey(key.strip(), organization.strip() or None))
+    return keys
+
+
+class ApiKeyPool(Loggable):
+    """Hands out API keys per call, tracking the load and health of each key. Safe to use from several threads."""
+
+    def __init__(self, keys: list[ApiKey], strategy: str = "round_robin"):
+        """
+        :param keys: Keys in the pool, at least one
+        :param strategy: "round_robin" or "least_loaded" (fewest calls in flight)
+        """
+        if not keys:
+            Loggable.log().error(msg := "An API key pool needs at least one key")
+            raise ValueError(msg)
+        if strategy not in KEY_STRATEGIES:
+            Loggable.log().error(
+                msg
+                := f"Invalid key strategy: '{strategy}' is not in '{KEY_STRATEGIES}'"
+            )
+            raise ValueError(msg)
+
+        self.keys = keys
+        self.strategy = strategy
+        self.health: dict[ApiKey, KeyHealth] = {key: KeyHealth() for key in keys}
+        self._next_index = 0
+        self._condition = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _select(self, now: float) -> ApiKey | None:
+        # caller must hold the lock
+        available = [key for key in self.keys if self.health[key].is_available(now)]
+        if not available:
+            return None
+        if self.strategy == "least_loaded":
+            return min(available, key=lambda key: self.health[key].in_flight)
+
+        # round robin over the keys, skipping those cooling down
+        for offset in range(len(self.keys)):
+            key = self.keys[(self._next_index + offset) % len(self.keys)]
+            if key in available:
+                self._next_index = (self.keys.index(key) + 1) % len(self.keys)
+                return key
+        return None
+
+    def acquire(self, deadline: float | None = None) -> ApiKey:
+        """
+        Returns the next key, waiting for the first cooldown to end if every key is cooling down. Rejected keys
+        aren't waited for: if every key was rejected, the error that rejected them is raised at once.
+
+        :param deadline: Monotonic time by which a key must be free, a TimeoutError is raised at once if none will be
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if (key := self._select(now)) is not None:
+                    self.health[key].in_flight += 1
+                    return key
+                if not (
+                    cooling_down := [
+                        health.cooldown_until
+                        for health in self.health.values()
+                        if health.rejected is None
+                    ]
+                ):
+                    rejected = next(iter(self.health.values())).rejected
+                    self.log().error(
+                        "Every API key was rejected, failing the call: %s", rejected
+                    )
+                    # the error is shared by the calls, each raises it with its own traceback
+                    raise rejected.with_traceback(None)
+                free_at = min(cooling_down)
+                if deadline is not None and free_at > deadline:
+                    self.log().error(
+                        msg
+                        := f"No API key is free by the deadline, the next one in {free_at - now:.1f} s"
+                    )
+                    raise TimeoutError(msg)
+                self._condition.wait(timeout=max(0.0, free_at - now))
+
+    def release(
+        self,
+        key: ApiKey,
+        error: BaseException | None = None,
+        retry_after_s: float | None = None,
+    ) -> None:
+        """
+        Returns a key to the pool, updating its health with the outcome of the call.
+
+        :param key: The key returned by `acquire`
+        :param error: The error raised by the call, if any
+        :param retry_after_s: Delay requested by a rate limited response
+        """
+        with self._condition:
+            health = self.health[key]
+            health.in_flight -= 1
+            now = time.monotonic()
+            if error is None:
+                health.successes += 1
+                health.consecutive_failures = 0
+                health.rejected = None
+            elif isinstance(error, openai.RateLimitError):
+                health.rate_limited += 1
+                health.cooldown_until = max(
+                    health.cooldown_until,
+                    now
+                    + (
+                        retry_after_s
+                        if retry_after_s is not None
+                        else RATE_LIMIT_COOLDOWN_S
+                    ),
+                )
+            elif isinstance(
+                error, openai.AuthenticationError | openai.PermissionDeniedError
+            ):
+                health.failures += 1
+                health.cooldown_until = now + REJECTED_COOLDOWN_S
+                health.rejected = error
+                self.log().error(
+                    f"API key '{key.label}' was rejected, skipping it for {REJECTED_COOLDOWN_S:.0f} s"
+                )
+            elif isinstance(error, openai.APIConnectionError | openai.APIStatusError):
+                health.failures += 1
+                health.consecutive_failures += 1
+                if health.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                    health.cooldown_until = now + FAILURE_COOLDOWN_S
+                    health.consecutive_failures = 0
+                    self.log().warning(
+                        f"API key '{key.label}' failed {MAX_CONSECUTIVE_FAILURES} times in a row, "
+                        f"skipping it for {FAILURE_COOLDOWN_S:.0f} s"
+                    )
+            self._condition.notify_all()
+
+    @contextmanager
+    def lease(self, deadline: float | None = None) -> Iterator[ApiKey]:
+        """
+        Acquires a key for one call, releasing it with the call's outcome. A call abandoned by `hedged_call`
+        releases the key at once, as neither a success nor a failure.
+
+        :param deadline: Monotonic deadline of the call, see `acquire`
+        """
+        key = self.acquire(deadline)
+        release = cancellable(partial(self.release, key), CancelledError())
+        try:
+            yield key
+        except BaseException as e:
+            error = unwrap_error(e)
+            release(error, retry_after_s(error))
+            raise
+        release()
+
+    def stats(self) -> dict[str, dict]:
+        """Returns the health of each key, by label."""
+        with self._condition:
+            now = time.monotonic()
+            return {
+                key.label: {
+                    "in_flight": health.in_flight,
+                    "successes": health.successes,
+                    "failures": health.failures,
+                    "rate_limited": health.rate_limited,
+                    "available": health.is_available(now),
+                }
+                for key, health in self.health.items()
+            }
+
+
+_pools: dict[tuple, ApiKeyPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_api_key_pool(settings: BackendSettings) -> ApiKeyPool:
+    """
+    Returns the process-wide key pool of the backend. A new pool (with fresh health) is created when the key
+    setting or strategy changes.
+    """
+    keys = parse_api_keys(
+        get_env(settings.api_key_env, DOTENV_FILE) if settings.api_key_env else None
+    ) or [ApiKey(settings.default_api_key)]
+    strategy = get_env("LLM_KEY_STRATEGY", DOTENV_FILE) or "round_robin"
+
+    pool_key = (settings.name, settings.base_url, tuple(keys), strategy)
+    with _pools_lock:
+        if (pool := _pools.get(pool_key)) is None:
+            pool = _pools[pool_key] = ApiKeyPool(keys, strategy=strategy)
+            if len(keys) > 1:
+                Loggable.log().info(
+                    f"Spreading requests to '{settings.name}' over {len(keys)} API keys ({strategy})"
+                )
+        return pool
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Any, Literal
+from functools import lru_cache
+from typing import Any, Literal, Optional
 
 from pydantic import BaseModel, Field, create_model
 
@@ -8,9 +9,14 @@ from pydantic import BaseModel, Field, create_model
 class BaseAttributeModel(BaseModel):
     key: str
     value: Any
-    error: str | None = Field(default=None, description="Error message if any")
+    # Optional rather than `str | None`, instructor's Partial (used for streaming) can't wrap `types.UnionType`
+    error: Optional[str] = Field(default=None, description="Error message if any")  # noqa: UP007, UP045
 
 
+# bounds on the number of generated model classes kept alive, so memory stays flat in long-running servers
+ATTRIBUTE_MODEL_CACHE_SIZE: int = 1024
+RETURN_MODEL_CACHE_SIZE: int = 256
+
 ATTRIBUTE_TYPES: dict[str, Any] = {
     "str": str,
     "int": int,
@@ -47,6 +53,41 @@ def string_to_type(value: str, options: str | None = None) -> Any:
     return Literal.__getitem__(tuple(option_values))
 
 
+def create_attribute_model(
+    name: str,
+    attribute_type: str,
+    options: str | None = None,
+    description: str | None = None,
+    example: str | None = None,
+) -> type[BaseAttributeModel]:
+    """
+    Creates the model for a single attribute.
+    Identical definitions return the same (cached) class, so pydantic only builds the schema and validators once.
+    """
+    # always call with positional args, so the cache key is the canonical definition tuple
+    return _create_attribute_model(name, attribute_type, options, description, example)
+
+
+@lru_cache(maxsize=ATTRIBUTE_MODEL_CACHE_SIZE)
+def _create_attribute_model(
+    name: str,
+    attribute_type: str,
+    options: str | None,
+    description: str | None,
+    example: str | None,
+) -> type[BaseAttributeModel]:
+    return create_model(
+        f"{name}Model",
+        # force the "key" to be the name of the attribute
+        key=(Literal[name], Field(default=name, description="Attribute name")),
+        value=(
+            string_to_type(attribute_type, options=options),
+            Field(description=description, examples=[example]),
+        ),
+        __base__=BaseAttributeModel,
+    )
+
+
 class BaseAttributesModel(BaseModel):
     attributes: tuple[BaseAttributeModel, ...]
 
@@ -54,8 +95,104 @@ class BaseAttributesModel(BaseModel):
 def attributes_to_model(
     attributes: list[type[BaseAttributeModel]],
 ) -> type[BaseAttributesModel]:
-    # Bundles a list of attributes into a single model
+    # Bundles a list of attributes into a single model, the same attribute set returns the same (cached) class
+    return _attributes_to_model(tuple(attributes))
+
+
+@lru_cache(maxsize=RETURN_MODEL_CACHE_SIZE)
+def _attributes_to_model(
+    attributes: tuple[type[BaseAttributeModel], ...],
+) -> type[BaseAttributesModel]:
     return create_model(
         "ReturnModel",
-        **{attr.model_fields["key"].default: (attr, Field()) for attr in attributes},
+        **{attribute_name(attr): (attr, Field()) for attr in attributes},
     )
+
+
+def attribute_name(attribute: type[BaseAttributeModel]) -> str:
+    """Returns the name of the attribute, which is also its field name in a return model."""
+    return attribute.model_fields["key"].default
+
+
+@lru_cache(maxsize=ATTRIBUTE_MODEL_CACHE_SIZE)
+def namespaced_attribute_model(
+    attribute: type[BaseAttributeModel], group: int
+) -> type[BaseAttributeModel]:
+    """Returns the attribute renamed to `g<group>__<name>`, so it can be asked next to another attribute's name."""
+    name = f"g{group}__{attribute_name(attribute)}"
+    return create_model(
+        f"{name}Model",
+        key=(Literal[name], Field(default=name, description="Attribute name")),
+        __base__=attribute,
+    )
+
+
+def merge_attribute_groups(
+    groups: list[list[type[BaseAttributeModel]]],
+) -> tuple[list[type[BaseAttributeModel]], list[dict[str, str]]]:
+    """
+    Merges groups of attributes into one list, so a single request answers every group, see `split_attributes`.
+    An attribute in several groups is asked once if its definitions are identical. A name defined differently by
+    a later group is asked under the group's namespace, e.g. `g2__color`.
+
+    :return: The merged attributes, and for each group the field names of its attributes in the merged list
+    """
+    merged: dict[str, type[BaseAttributeModel]] = {}
+    field_names: list[dict[str, str]] = []
+    for group_index, group in enumerate(groups):
+        names: dict[str, str] = {}
+        for attribute in group:
+            name = attribute_name(attribute)
+            existing = merged.get(name)
+            if existing is not None and (
+                existing is not attribute
+                and model_json_schema(existing) != model_json_schema(attribute)
+            ):
+                attribute = namespaced_attribute_model(attribute, group_index + 1)
+                existing = merged.get(attribute_name(attribute))
+            if existing is None:
+                merged[attribute_name(attribute)] = attribute
+            names[name] = attribute_name(attribute)
+        field_names.append(names)
+    return list(merged.values()), field_names
+
+
+def split_attributes(
+    response: BaseAttributesModel,
+    attributes_model: type[BaseAttributesModel],
+    field_names: dict[str, str] | None = None,
+) -> BaseAttributesModel:
+    """
+    Returns the attributes of `attributes_model` from a response to merged attribute groups.
+
+    :param response: Response to the merged attributes
+    :param attributes_model: Return model of the group
+    :param field_names: Field names of the group's attributes in the response, see `merge_attribute_groups`,
+        attributes not in it have the same name
+    """
+    field_names = field_names or {}
+    values: dict[str, Any] = {}
+    for name in attributes_model.model_fields:
+        value = getattr(response, field_names.get(name, name))
+        if value.key != name:
+            # asked under the group's namespace
+            value = {**value.model_dump(), "key": name}
+        values[name] = value
+    return attributes_model.model_validate(values)
+
+
+@lru_cache(maxsize=RETURN_MODEL_CACHE_SIZE)
+def model_json_schema(model: type[BaseModel]) -> dict[str, Any]:
+    """
+    Returns the (cached) JSON schema of the model.
+    The returned dict is shared between callers, and must not be modified.
+    """
+    return model.model_json_schema()
+
+
+def clear_model_caches() -> None:
+    """Clears the cached attribute models, return models and JSON schemas."""
+    _create_attribute_model.cache_clear()
+    namespaced_attribute_model.cache_clear()
+    _attributes_to_model.cache_clear()
+    model_json_schema.cache_clear()
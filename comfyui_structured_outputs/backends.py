@@ -0,0 +1,247 @@
+"""
+Backends the structured output requests are sent to.
+
+A backend is an OpenAI-compatible chat completions API: OpenAI itself, a server running on the same host
+(e.g. vLLM or llama.cpp server), or the offline stub. Backends are selected per node, or through `.env`
+settings (`LLM_BACKEND`, `LLM_BASE_URL`, `LLM_MODEL`, `LLM_API_KEY`, `LLM_TIMEOUT_S`, `LLM_MODE`).
+Rate limits (`LLM_RPM`, `LLM_TPM`, `LLM_MAX_CONCURRENCY`, `LLM_TARGET_LATENCY_S`) are enforced by the
+backend's scheduler, see `scheduler.py`.
+"""
+
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel, ConfigDict
+
+from . import DOTENV_FILE
+from .api_keys import ApiKey, get_api_key_pool
+from .client_registry import CLIENT_REGISTRY, REQUEST_TIMEOUT_S, get_client
+from .scheduler import DEFAULT_MAX_CONCURRENCY
+from .stub_backend import STUB_BASE_URL, STUB_MODEL, stub_http_client
+from .utils.loggable import Loggable
+from .utils.utils import get_env, get_env_flag, lazy_import
+
+if TYPE_CHECKING:
+    import instructor
+    import openai
+    from instructor import Instructor
+else:
+    # imported on first use, see `lazy_import`
+    instructor = lazy_import("instructor")
+    openai = lazy_import("openai")
+
+# structured output strategies, tool calls or JSON mode, as values of `instructor.Mode`
+STRUCTURED_MODES: dict[str, str] = {
+    "tools": "tool_call",
+    "json": "json_mode",
+    "json_schema": "json_schema_mode",
+}
+
+# selects the backend named by `LLM_BACKEND` in the environment
+ENV_BACKEND: str = "env"
+
+
+class BackendSettings(BaseModel):
+    """Settings of a chat completions backend."""
+
+    model_config = ConfigDict(frozen=True)
+
+    name: str
+    base_url: str | None = None
+    model: str = "gpt-4o"
+    # environment variable holding the API key
+    api_key_env: str | None = "OPENAI_KEY"
+    # used if the API key environment variable is not set, local servers usually accept any key
+    default_api_key: str | None = None
+    timeout_s: float = REQUEST_TIMEOUT_S
+    mode: str = "tools"
+    # limits of the account, None for no limit
+    requests_per_minute: float | None = None
+    tokens_per_minute: float | None = None
+    # upper bound of the adaptive number of calls in flight
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    target_latency_s: float | None = None
+
+    @property
+    def instructor_mode(self) -> instructor.Mode:
+        return instructor.Mode(STRUCTURED_MODES[self.mode])
+
+    @property
+    def cache_id(self) -> str:
+        """Identifies the backend and model for response caching."""
+        return f"{self.name}|{self.base_url or ''}|{self.model}|{self.mode}"
+
+
+BACKENDS: dict[str, BackendSettings] = {
+    "openai": BackendSettings(name="openai"),
+    # e.g. vLLM (`vllm serve <model>`) or llama.cpp server on the same host
+    "openai_compatible": BackendSettings(
+        name="openai_compatible",
+        base_url="http://127.0.0.1:8000/v1",
+        model="default",
+        api_key_env="LLM_API_KEY",
+        default_api_key="local",
+        timeout_s=120.0,
+        mode="json_schema",
+    ),
+    # answers offline with placeholder values, see `stub_backend`
+    "stub": BackendSettings(
+        name="stub",
+        base_url=STUB_BASE_URL,
+        model=STUB_MODEL,
+        api_key_env=None,
+        default_api_key="stub",
+        timeout_s=10.0,
+    ),
+}
+
+
+def _get_float_env(key: str) -> float | None:
+    if (value := get_env(key, DOTENV_FILE)) is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        Loggable.log().error(f"Ignoring '{key}', '{value}' is not a number")
+        return None
+
+
+def resolve_backend(
+    name: str = ENV_BACKEND,
+    model: str | None = None,
+    base_url: str | None = None,
+    mode: str | None = None,
+) -> BackendSettings:
+    """
+    Returns the settings of the named backend, with `.env` settings and then the given overrides applied. The
+    `.env` settings describe the backend selected by `LLM_BACKEND`, so they only apply to that backend.
+
+    :param name: Backend name, or "env" to use `LLM_BACKEND` (default "openai")
+    :param model: Model name override
+    :param base_url: Base URL override
+    :param mode: Structured output strategy override, one of `STRUCTURED_MODES`
+    """
+    env_backend: str = get_env("LLM_BACKEND", DOTENV_FILE) or "openai"
+    if name == ENV_BACKEND:
+        name = env_backend
+    if name not in BACKENDS:
+        Loggable.log().error(
+            msg := f"Invalid backend: '{name}' is not in '{list(BACKENDS.keys())}'"
+        )
+        raise ValueError(msg)
+
+    overrides: dict = {}
+    if name == env_backend:
+        overrides = {
+            "base_url": get_env("LLM_BASE_URL", DOTENV_FILE),
+            "model": get_env("LLM_MODEL", DOTENV_FILE),
+            "timeout_s": _get_float_env("LLM_TIMEOUT_S"),
+            "mode": get_env("LLM_MODE", DOTENV_FILE),
+            "requests_per_minute": _get_float_env("LLM_RPM"),
+            "tokens_per_minute": _get_float_env("LLM_TPM"),
+            "max_concurrency": _get_float_env("LLM_MAX_CONCURRENCY"),
+            "target_latency_s": _get_float_env("LLM_TARGET_LATENCY_S"),
+        }
+    if overrides.get("max_concurrency") is not None:
+        overrides["max_concurrency"] = max(1, int(overrides["max_concurrency"]))
+    # the stub never leaves the process
+    if name == "stub":
+        overrides["base_url"] = None
+    overrides.update(
+        {
+            key: value
+            for key, value in {
+                "model": model,
+                "base_url": base_url,
+                "mode": mode,
+            }.items()
+            if value
+        }
+    )
+
+    settings = BACKENDS[name].model_copy(
+        update={key: value for key, value in overrides.items() if value is not None}
+    )
+    if settings.mode not in STRUCTURED_MODES:
+        Loggable.log().error(
+            msg
+            := f"Invalid mode: '{settings.mode}' is not in '{list(STRUCTURED_MODES.keys())}'"
+        )
+        raise ValueError(msg)
+    return settings
+
+
+_stub_clients: dict[instructor.Mode, Instructor] = {}
+_stub_clients_lock = threading.Lock()
+
+
+def get_backend_client(
+    settings: BackendSettings, api_key: ApiKey | None = None
+) -> Instructor:
+    """
+    Returns the (pooled) client for the backend.
+
+    :param settings: Backend settings
+    :param api_key: Key to authenticate with, defaults to the first key of the backend's key pool
+    """
+    if settings.name == "stub":
+        with _stub_clients_lock:
+            if (client := _stub_clients.get(settings.instructor_mode)) is None:
+                client = instructor.from_openai(
+                    openai.OpenAI(
+                        api_key=settings.default_api_key,
+                        base_url=STUB_BASE_URL,
+                        http_client=stub_http_client(),
+                        # retries are left to the scheduler
+                        max_retries=0,
+                    ),
+                    mode=settings.instructor_mode,
+                )
+                _stub_clients[settings.instructor_mode] = client
+            return client
+
+    if api_key is None:
+        api_key = get_api_key_pool(settings).keys[0]
+
+    return get_client(
+        api_key.key,
+        base_url=settings.base_url,
+        mode=settings.instructor_mode,
+        timeout_s=settings.timeout_s,
+        organization=api_key.organization,
+    )
+
+
+def prewarm_from_env(dotenv_path: Path = DOTENV_FILE) -> threading.Thread | None:
+    """
+    Pre-warms the client of the `.env` backend (see `resolve_backend`) in the background, if `PREWARM_CLIENT` is
+    enabled. With a pool of keys the connection pool is shared, so warming up the first key's client is enough.
+    """
+    if not get_env_flag("PREWARM_CLIENT", dotenv_path=dotenv_path):
+        return None
+
+    try:
+        settings = resolve_backend(ENV_BACKEND)
+    except ValueError:
+        # already logged, and reported again by the first run
+        return None
+    if settings.name == "stub":
+        # the stub never leaves the process, there is no connection to open
+        return None
+
+    api_key = get_api_key_pool(settings).keys[0]
+    if not api_key.key:
+        Loggable.log().warning(
+            f"PREWARM_CLIENT is set, but no {settings.api_key_env} was found"
+        )
+        return None
+    return CLIENT_REGISTRY.prewarm(
+        api_key.key,
+        base_url=settings.base_url,
+        mode=settings.instructor_mode,
+        timeout_s=settings.timeout_s,
+        organization=api_key.organization,
+    )
@@ -0,0 +1,153 @@
+"""
+Background execution of structured output requests.
+
+ComfyUI runs one node at a time, so a node waiting on the network holds up every node after it, including GPU
+sampling nodes that don't need its answer. In background mode, the Structured Output Node submits its requests
+to a process-wide executor and returns at once, with a `PendingResult` handle in place of each result. The
+requests run while ComfyUI executes the rest of the graph, and a consumer (e.g. the Attribute to Text Node) only
+waits when it resolves a handle, see `resolve`.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+from . import DOTENV_FILE
+from .utils.loggable import Loggable
+from .utils.utils import get_env
+
+DEFAULT_BACKGROUND_WORKERS: int = 4
+
+
+class BackgroundJob(Loggable):
+    """
+    A call running on the background executor, submitted on creation. ComfyUI keeps the handles of a node that
+    ran in its cache, so a failed job is submitted again by the next resolve instead of failing every later run.
+    """
+
+    def __init__(self, fn: Callable[[], list[Any]], executor: ThreadPoolExecutor):
+        """
+        :param fn: Makes the requests, returning one result per handle
+        :param executor: Executor to run `fn` on
+        """
+        self.fn = fn
+        self.executor = executor
+        self.submissions: int = 0
+
+        self._lock = threading.Lock()
+        self._future: Future | None = None
+        self.submit()
+
+    def submit(self) -> Future:
+        with self._lock:
+            if self._future is None:
+                self._future = self.executor.submit(self.fn)
+                self.submissions += 1
+            return self._future
+
+    def result(self, timeout_s: float | None = None) -> list[Any]:
+        """Waits for the results, raising the error of the call if it failed."""
+        future = self.submit()
+        try:
+            return future.result(timeout=timeout_s)
+        except BaseException:
+            # a timeout leaves the job running
+            if future.done():
+                with self._lock:
+                    if self._future is future:
+                        self._future = None
+                self.log().warning(
+                    "Background structured output request failed, it runs again on the next use"
+                )
+            raise
+
+    def done(self) -> bool:
+        with self._lock:
+            return self._future is not None and self._future.done()
+
+
+class PendingResult:
+    """
+    Handle to one result of a background job, passed between nodes in place of the result, optionally with a
+    `transform` applied to the result when it resolves.
+    """
+
+    __slots__ = ("job", "index", "transform")
+
+    def __init__(
+        self,
+        job: BackgroundJob,
+        index: int,
+        transform: Callable[[Any], Any] | None = None,
+    ):
+        self.job = job
+        self.index = index
+        self.transform = transform
+
+    def result(self, timeout_s: float | None = None) -> Any:
+        result = self.job.result(timeout_s)[self.index]
+        return self.transform(result) if self.transform is not None else result
+
+    def done(self) -> bool:
+        return self.job.done()
+
+    def __repr__(self) -> str:
+        return f"PendingResult(index={self.index}, done={self.done()})"
+
+
+def resolve(value: Any) -> Any:
+    """Returns the result of a `PendingResult`, waiting for it if needed, and any other value as is."""
+    if isinstance(value, PendingResult):
+        return value.result()
+    return value
+
+
+def then(value: Any, fn: Callable[[Any], Any]) -> Any:
+    """
+    Returns `fn` applied to the value. For a `PendingResult`, returns a new handle to the same result, that applies
+    `fn` when it resolves, without waiting.
+    """
+    if not isinstance(value, PendingResult):
+        return fn(value)
+    if (transform := value.transform) is not None:
+        return PendingResult(
+            value.job, value.index, lambda result: fn(transform(result))
+        )
+    return PendingResult(value.job, value.index, fn)
+
+
+_background_executor: ThreadPoolExecutor | None = None
+_background_executor_lock = threading.Lock()
+
+
+def get_background_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide executor of background jobs, creating it on first use.
+    It runs up to `LLM_BACKGROUND_WORKERS` node runs at once, each with its own request concurrency.
+    """
+    global _background_executor
+    with _background_executor_lock:
+        if _background_executor is None:
+            workers = int(
+                get_env("LLM_BACKGROUND_WORKERS", DOTENV_FILE)
+                or DEFAULT_BACKGROUND_WORKERS
+            )
+            _background_executor = ThreadPoolExecutor(
+                max_workers=max(1, workers),
+                thread_name_prefix="structured-output-background",
+            )
+        return _background_executor
+
+
+def run_in_background(fn: Callable[[], list[Any]], count: int) -> list[PendingResult]:
+    """
+    Submits `fn` to the background executor, returning a handle to each of its `count` results.
+
+    :param fn: Makes the requests, returning `count` results
+    :param count: Number of results of `fn`, known before it runs
+    """
+    job = BackgroundJob(fn, get_background_executor())
+    return [PendingResult(job, index) for index in range(count)]
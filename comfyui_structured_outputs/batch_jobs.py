@@ -0,0 +1,337 @@
+"""
+Asynchronous structured output jobs on the provider's Batch API.
+
+For large offline jobs, a batch is cheaper and has far higher throughput than real-time calls. The requests are
+built the same way instructor builds a real-time call (tools, JSON or JSON schema mode), written to a JSONL file,
+uploaded and submitted as a batch, which is then polled until it completes. Each output line is validated
+against the response model and mapped back to its input by `custom_id`.
+
+Jobs are resumable: the state of a job (uploaded file, batch id, status) is saved next to its request file,
+keyed by a fingerprint of the requests. Running the same requests again, e.g. after a restart, picks up the
+submitted batch instead of submitting a new one, and a downloaded output is read from disk. A batch that failed,
+expired or was cancelled isn't resumed, running its requests again submits a new batch.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+from . import CACHE_DIR
+from .utils.loggable import Loggable
+from .utils.utils import lazy_import
+
+if TYPE_CHECKING:
+    import instructor
+    from openai import OpenAI
+    from openai.types import chat as chat_types
+else:
+    # imported on first use, see `lazy_import`
+    instructor = lazy_import("instructor")
+    chat_types = lazy_import("openai.types.chat")
+
+BATCH_JOBS_DIR: Path = CACHE_DIR / "batch_jobs"
+BATCH_ENDPOINT: str = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW: str = "24h"
+DEFAULT_POLL_INTERVAL_S: float = 30.0
+# a batch in one of these states won't change anymore
+TERMINAL_STATUSES: tuple[str, ...] = ("completed", "failed", "expired", "cancelled")
+# a job whose batch ended in one of these states is submitted again
+RESUBMITTED_STATUSES: tuple[str, ...] = ("failed", "expired", "cancelled")
+
+
+@dataclass
+class BatchJobState:
+    """Progress of a job, saved after every step so the job can be resumed."""
+
+    fingerprint: str
+    model: str
+    size: int
+    input_file_id: str | None = None
+    batch_id: str | None = None
+    status: str = "new"
+    output_file_id: str | None = None
+    error_file_id: str | None = None
+    created_at: float = field(default_factory=time.time)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, so a restart never reads a partial file
+        temp_path = path.with_name(f".{path.name}.tmp")
+        temp_path.write_text(json.dumps(asdict(self), indent=2))
+        temp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> BatchJobState | None:
+        try:
+            return cls(**json.loads(path.read_text()))
+        except FileNotFoundError:
+            return None
+
+
+@dataclass
+class BatchResults:
+    """Validated responses in input order (None where a request failed), with the errors by input index."""
+
+    responses: list[BaseModel | None]
+    errors: dict[int, str]
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class BatchJob(Loggable):
+    """One batch of structured output requests, see the module docstring."""
+
+    def __init__(
+        self,
+        client: OpenAI,
+        response_model: type[BaseModel],
+        messages_list: list[list[dict]],
+        model: str,
+        mode: instructor.Mode | None = None,
+        jobs_dir: Path | None = None,
+    ):
+        """
+        :param client: OpenAI client of the backend (not the instructor client)
+        :param response_model: Model every response is validated against
+        :param messages_list: Chat messages of each request, results are returned in the same order
+        :param model: Model to request
+        :param mode: Instructor mode the requests are built with, defaults to tool calls
+        :param jobs_dir: Directory of the request, state and output files, defaults to `BATCH_JOBS_DIR`
+        """
+        if not messages_list:
+            Loggable.log().error(msg := "A batch job needs at least one request")
+            raise ValueError(msg)
+
+        self.client = client
+        self.model = model
+        self.mode = mode or instructor.Mode.TOOLS
+        self.messages_list = messages_list
+        self._response_model = response_model
+        # the model wrapped by instructor, to parse completions in the given mode
+        self.response_model = instructor.openai_schema(response_model)
+        self.fingerprint = self.make_fingerprint()
+        self.jobs_dir = jobs_dir or BATCH_JOBS_DIR
+        self.state = BatchJobState.load(self.state_path) or BatchJobState(
+            fingerprint=self.fingerprint, model=model, size=len(messages_list)
+        )
+
+    @property
+    def state_path(self) -> Path:
+        return self.jobs_dir / f"{self.fingerprint}.json"
+
+    @property
+    def requests_path(self) -> Path:
+        return self.jobs_dir / f"{self.fingerprint}.requests.jsonl"
+
+    @property
+    def output_path(self) -> Path:
+        return self.jobs_dir / f"{self.fingerprint}.output.jsonl"
+
+    def make_fingerprint(self) -> str:
+        """Hashes everything that determines the requests, so identical jobs resume the same batch."""
+        payload = json.dumps(
+            [
+                self.model,
+                self.mode.value,
+                self._response_model.model_json_schema(),
+                self.messages_list,
+            ],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+    @staticmethod
+    def custom_id(index: int) -> str:
+        return f"request-{index}"
+
+    def request_body(self, messages: list[dict]) -> dict:
+        """Builds the body of one chat completions request, as instructor would send it."""
+        # instructor may add a system message, so it gets a copy of the messages
+        _, kwargs = instructor.handle_response_model(
+            self._response_model,
+            mode=self.mode,
+            messages=[*messages],
+            model=self.model,
+        )
+        return kwargs
+
+    def write_requests(self) -> Path:
+        """Writes the requests to the JSONL batch file."""
+        self.requests_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.requests_path, "w") as file:
+            for index, messages in enumerate(self.messages_list):
+                line = {
+                    "custom_id": self.custom_id(index),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": self.request_body(messages),
+                }
+                file.write(json.dumps(line) + "\n")
+        return self.requests_path
+
+    def submit(self) -> str:
+        """
+        Uploads the requests and creates the batch, unless this job was already submitted. A job whose batch failed,
+        expired or was cancelled is submitted again, as a new batch. Returns the batch id.
+        """
+        if self.state.status in RESUBMITTED_STATUSES:
+            self.log().warning(
+                f"Batch '{self.state.batch_id}' of job '{self.fingerprint}' {self.state.status}, submitting it again"
+            )
+            self.output_path.unlink(missing_ok=True)
+            self.state = BatchJobState(
+                fingerprint=self.fingerprint,
+                model=self.model,
+                size=len(self.messages_list),
+            )
+            self.state.save(self.state_path)
+
+        if self.state.batch_id is not None:
+            self.log().info(
+                f"Resuming batch '{self.state.batch_id}' ({self.state.status}) of job '{self.fingerprint}'"
+            )
+            return self.state.batch_id
+
+        if self.state.input_file_id is None:
+            with open(self.write_requests(), "rb") as file:
+                uploaded = self.client.files.create(file=file, purpose="batch")
+            self.state.input_file_id = uploaded.id
+            self.state.save(self.state_path)
+
+        batch = self.client.batches.create(
+            input_file_id=self.state.input_file_id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+            metadata={"job": self.fingerprint},
+        )
+        self.state.batch_id = batch.id
+        self.state.status = batch.status
+        self.state.save(self.state_path)
+        self.log().info(
+            f"Submitted batch '{batch.id}' with {self.state.size} requests, job '{self.fingerprint}'"
+        )
+        return batch.id
+
+    def poll(self) -> str:
+        """Refreshes and returns the status of the batch."""
+        if self.state.status in TERMINAL_STATUSES:
+            return self.state.status
+
+        batch = self.client.batches.retrieve(self.state.batch_id or self.submit())
+        if batch.status != self.state.status:
+            counts = batch.request_counts
+            self.log().info(
+                f"Batch '{batch.id}' is {batch.status}"
+                + (f", {counts.completed}/{counts.total} done" if counts else "")
+            )
+        self.state.status = batch.status
+        self.state.output_file_id = batch.output_file_id
+        self.state.error_file_id = batch.error_file_id
+        self.state.save(self.state_path)
+        return batch.status
+
+    def wait(
+        self,
+        poll_interval_s: float = DEFAULT_POLL_INTERVAL_S,
+        timeout_s: float | None = None,
+    ) -> str:
+        """
+        Polls the batch until it reaches a terminal status, which is returned.
+
+        :param poll_interval_s: Seconds between polls
+        :param timeout_s: Raise a TimeoutError after this long, or None to wait for the batch's completion window
+        """
+        start = time.monotonic()
+        while (status := self.poll()) not in TERMINAL_STATUSES:
+            if timeout_s is not None and time.monotonic() - start > timeout_s:
+                Loggable.log().error(
+                    msg
+                    := f"Batch '{self.state.batch_id}' is still {status} after {timeout_s:.0f} s, "
+                    f"running the same requests again resumes it"
+                )
+                raise TimeoutError(msg)
+            time.sleep(poll_interval_s)
+        return status
+
+    def _output_lines(self) -> list[dict]:
+        if not self.output_path.exists():
+            content = ""
+            for file_id in (self.state.output_file_id, self.state.error_file_id):
+                if file_id is not None:
+                    content += self.client.files.content(file_id).text
+            self.output_path.write_text(content)
+        return [
+            json.loads(line)
+            for line in self.output_path.read_text().splitlines()
+            if line.strip()
+        ]
+
+    def results(self) -> BatchResults:
+        """Downloads (once) and validates the output of a finished batch."""
+        if self.state.status not in TERMINAL_STATUSES:
+            Loggable.log().error(
+                msg
+                := f"Batch '{self.state.batch_id}' is {self.state.status}, not finished"
+            )
+            raise ValueError(msg)
+        if self.state.output_file_id is None and self.state.error_file_id is None:
+            Loggable.log().error(
+                msg
+                := f"Batch '{self.state.batch_id}' {self.state.status} without any output, "
+                "running the same requests again submits a new batch"
+            )
+            raise ValueError(msg)
+
+        results = BatchResults(
+            responses=[None] * self.state.size,
+            errors={
+                index: "No response in the batch output"
+                for index in range(self.state.size)
+            },
+        )
+        indices = {self.custom_id(index): index for index in range(self.state.size)}
+        for line in self._output_lines():
+            if (index := indices.get(line.get("custom_id"))) is None:
+                continue
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                results.errors[index] = str(
+                    line.get("error") or response.get("body", {}).get("error")
+                )
+                continue
+            try:
+                completion = chat_types.ChatCompletion.model_validate(response["body"])
+                results.responses[index] = self.response_model.from_response(
+                    completion, mode=self.mode
+                )
+            except Exception as e:
+                results.errors[index] = f"Invalid response: {e}"
+                continue
+            del results.errors[index]
+            if completion.usage is not None:
+                results.prompt_tokens += completion.usage.prompt_tokens
+                results.completion_tokens += completion.usage.completion_tokens
+
+        if results.errors:
+            self.log().warning(
+                f"{len(results.errors)} of {self.state.size} requests of batch '{self.state.batch_id}' failed"
+            )
+        return results
+
+    def run(
+        self,
+        poll_interval_s: float = DEFAULT_POLL_INTERVAL_S,
+        timeout_s: float | None = None,
+    ) -> BatchResults:
+        """Submits (or resumes) the job, waits for the batch and returns its results."""
+        self.submit()
+        self.wait(poll_interval_s=poll_interval_s, timeout_s=timeout_s)
+        return self.results()
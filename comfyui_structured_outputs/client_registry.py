@@ -0,0 +1,202 @@
+"""
+Process-wide registry of pooled LLM clients.
+
+Creating an `OpenAI` client also creates a new HTTP connection pool, so building one per node run pays
+connection setup and the TLS handshake on every call. The registry hands out a single `Instructor` client
+per (api key, base url, mode) and backs all of them with one tuned, keep-alive `httpx` connection pool.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import TYPE_CHECKING, NamedTuple
+
+from .utils.loggable import Loggable
+from .utils.utils import lazy_import
+
+if TYPE_CHECKING:
+    import httpx
+    import instructor
+    import openai
+    from instructor import Instructor
+else:
+    # imported on first use, see `lazy_import`
+    httpx = lazy_import("httpx")
+    instructor = lazy_import("instructor")
+    openai = lazy_import("openai")
+
+# connection pool tuning, shared by every client in the registry
+MAX_CONNECTIONS: int = 64
+MAX_KEEPALIVE_CONNECTIONS: int = 32
+KEEPALIVE_EXPIRY_S: float = 120.0
+CONNECT_TIMEOUT_S: float = 10.0
+REQUEST_TIMEOUT_S: float = 600.0
+
+
+class ClientKey(NamedTuple):
+    """Identifies a client in the registry, clients with equal keys are shared."""
+
+    api_key: str | None
+    base_url: str | None
+    mode: instructor.Mode
+    timeout_s: float
+    organization: str | None = None
+
+
+class ClientRegistry(Loggable):
+    """Thread-safe registry of `Instructor` clients sharing one HTTP connection pool."""
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = KEEPALIVE_EXPIRY_S,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._http_client: httpx.Client | None = None
+        self._clients: dict[ClientKey, Instructor] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def http_client(self) -> httpx.Client:
+        """The pooled HTTP client shared by all registered clients, created on first use."""
+        with self._lock:
+            return self._get_http_client()
+
+    def _get_http_client(self) -> httpx.Client:
+        # caller must hold the lock
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(REQUEST_TIMEOUT_S, connect=CONNECT_TIMEOUT_S),
+            )
+        return self._http_client
+
+    def get(
+        self,
+        api_key: str | None,
+        base_url: str | None = None,
+        mode: instructor.Mode | None = None,
+        timeout_s: float = REQUEST_TIMEOUT_S,
+        organization: str | None = None,
+    ) -> Instructor:
+        """
+        Returns the client for the given settings, creating and registering it if necessary.
+
+        :param api_key: API key used to authenticate requests
+        :param base_url: Base URL of the API, or None for the OpenAI default
+        :param mode: Instructor mode used to produce structured outputs, defaults to tool calls
+        :param timeout_s: Request timeout in seconds
+        :param organization: OpenAI organization the requests are billed to, or None for the key's default
+        """
+        key = ClientKey(
+            api_key=api_key,
+            base_url=base_url,
+            mode=mode or instructor.Mode.TOOLS,
+            timeout_s=timeout_s,
+            organization=organization,
+        )
+
+        with self._lock:
+            if (client := self._clients.get(key)) is not None:
+                return client
+
+            self.log().debug(
+                f"Creating client for base url '{base_url or 'default'}' with mode '{key.mode.value}'"
+            )
+            client = instructor.from_openai(
+                openai.OpenAI(
+                    api_key=api_key,
+                    organization=organization,
+                    base_url=base_url,
+                    timeout=timeout_s,
+                    http_client=self._get_http_client(),
+                    # rate limited and failed calls are retried by the scheduler, see scheduler.py
+                    max_retries=0,
+                ),
+                mode=key.mode,
+            )
+            self._clients[key] = client
+            return client
+
+    def prewarm(
+        self,
+        api_key: str | None,
+        base_url: str | None = None,
+        mode: instructor.Mode | None = None,
+        timeout_s: float = REQUEST_TIMEOUT_S,
+        organization: str | None = None,
+        background: bool = True,
+    ) -> threading.Thread | None:
+        """
+        Creates the client and opens a keep-alive connection to the API, so the first real call skips
+        connection setup.
+
+        :param api_key: API key used to authenticate requests
+        :param base_url: Base URL of the API, or None for the OpenAI default
+        :param mode: Instructor mode used to produce structured outputs
+        :param timeout_s: Request timeout in seconds
+        :param organization: OpenAI organization the requests are billed to, or None for the key's default
+        :param background: If True, connect on a daemon thread and return it, otherwise connect inline
+        """
+        client: Instructor = self.get(
+            api_key,
+            base_url=base_url,
+            mode=mode,
+            timeout_s=timeout_s,
+            organization=organization,
+        )
+
+        def connect():
+            try:
+                # any cheap request works, we only want the pooled connection to be established
+                client.client.with_options(max_retries=0).models.list()
+                self.log().debug("Pre-warmed client connection")
+            except Exception as err:
+                self.log().debug(f"Pre-warming client connection failed: {err}")
+
+        if not background:
+            connect()
+            return None
+
+        thread = threading.Thread(target=connect, name="client-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self) -> None:
+        """Removes all registered clients and closes the shared connection pool."""
+        with self._lock:
+            self._clients.clear()
+            if self._http_client is not None:
+                self._http_client.close()
+                self._http_client = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+
+CLIENT_REGISTRY: ClientRegistry = ClientRegistry()
+
+
+def get_client(
+    api_key: str | None,
+    base_url: str | None = None,
+    mode: instructor.Mode | None = None,
+    timeout_s: float = REQUEST_TIMEOUT_S,
+    organization: str | None = None,
+) -> Instructor:
+    """Returns the shared client for the given settings from the process-wide registry."""
+    return CLIENT_REGISTRY.get(
+        api_key,
+        base_url=base_url,
+        mode=mode,
+        timeout_s=timeout_s,
+        organization=organization,
+    )
@@ -0,0 +1,159 @@
+"""
+Process-wide cache of encoded images.
+
+A workflow often sends one IMAGE to several Structured Output Nodes with different prompts or attributes, and
+each would resize and encode it again, which for a large PNG costs hundreds of milliseconds of CPU. Encoded
+payloads are kept in memory, keyed by the fingerprint of the tensor (see `tensor_fingerprint`) and the encoding
+options, so every node after the first reuses the payload. The cache is bounded by the size of the payloads it
+holds (`LLM_IMAGE_CACHE_MB`), least recently used first out, and identical encodes running at the same time are
+done once.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from . import DOTENV_FILE
+from .single_flight import SingleFlight
+from .utils.image_utils import EncodedImage, encode_image, tensor_fingerprint
+from .utils.loggable import Loggable
+from .utils.utils import get_env
+
+if TYPE_CHECKING:
+    import torch
+
+DEFAULT_MAX_MEGABYTES: float = 256.0
+
+
+class EncodedImageCache(Loggable):
+    """LRU cache of encoded images, bounded by the total size of their payloads. Safe to use from several threads."""
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: Maximum total size of the cached payloads, 0 to disable the cache
+        """
+        self.max_bytes = max_bytes
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.size_bytes: int = 0
+
+        self._entries: OrderedDict[tuple, EncodedImage] = OrderedDict()
+        self._lock = threading.Lock()
+        self._encodes = SingleFlight()
+
+    @staticmethod
+    def make_key(
+        fingerprint: str,
+        image_format: str = "PNG",
+        quality: int | None = None,
+        max_side: int | None = None,
+        detail: str | None = None,
+    ) -> tuple:
+        """Returns the cache key of an image encoded with the options of `encode_image`."""
+        return fingerprint, image_format.upper(), quality, max_side, detail
+
+    def get(self, key: tuple) -> EncodedImage | None:
+        """Returns the cached image for the key, or None."""
+        with self._lock:
+            if (encoded_image := self._entries.get(key)) is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return encoded_image
+
+    def put(self, key: tuple, encoded_image: EncodedImage) -> None:
+        """Caches the image, evicting the least recently used images until the payloads fit."""
+        if encoded_image.size_bytes > self.max_bytes:
+            # would evict everything, and not fit anyway
+            return
+        with self._lock:
+            if (previous := self._entries.pop(key, None)) is not None:
+                self.size_bytes -= previous.size_bytes
+            self._entries[key] = encoded_image
+            self.size_bytes += encoded_image.size_bytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= evicted.size_bytes
+                self.evictions += 1
+
+    def encode(
+        self,
+        image_tensor: torch.Tensor,
+        fingerprint: str | None = None,
+        **image_options,
+    ) -> EncodedImage:
+        """
+        Returns the image encoded by `encode_image`, from the cache if it was already encoded with the same options.
+        The `encode_s` of a cached image is the time of the lookup, so timings show the time spent.
+
+        :param image_tensor: Image of shape [B, H, W, C], the first image of the batch is encoded
+        :param fingerprint: `tensor_fingerprint` of the first image, if the caller already hashed it
+        :param image_options: Keyword arguments of `encode_image`
+        """
+        if self.max_bytes <= 0:
+            return encode_image(image_tensor, **image_options)
+
+        start = time.perf_counter()
+        if fingerprint is None:
+            fingerprint = tensor_fingerprint(image_tensor[:1])
+        key = self.make_key(fingerprint, **image_options)
+        if (encoded_image := self.get(key)) is None:
+            encoded_image, shared = self._encodes.do(
+                repr(key), lambda: encode_image(image_tensor, **image_options)
+            )
+            if not shared:
+                self.put(key, encoded_image)
+                return encoded_image
+        self.log().debug(
+            "Reused encoded %dx%d image (%.1f KiB)",
+            encoded_image.width,
+            encoded_image.height,
+            encoded_image.size_bytes / 1024,
+        )
+        return encoded_image._replace(encode_s=time.perf_counter() - start)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> dict[str, int | float]:
+        """Returns the hit/miss counters, the hit rate, and the number and total size of the cached images."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_encoded_image_cache: EncodedImageCache | None = None
+_encoded_image_cache_lock = threading.Lock()
+
+
+def get_encoded_image_cache() -> EncodedImageCache:
+    """
+    Returns the process-wide cache of encoded images, creating it on first use.
+    It holds up to `LLM_IMAGE_CACHE_MB` megabytes of payloads (default 256), 0 disables it.
+    """
+    global _encoded_image_cache
+    with _encoded_image_cache_lock:
+        if _encoded_image_cache is None:
+            megabytes = float(
+                get_env("LLM_IMAGE_CACHE_MB", DOTENV_FILE) or DEFAULT_MAX_MEGABYTES
+            )
+            _encoded_image_cache = EncodedImageCache(
+                max_bytes=max(0, int(megabytes * 1024 * 1024))
+            )
+        return _encoded_image_cache
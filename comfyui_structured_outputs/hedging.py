@@ -0,0 +1,313 @@
+"""
+Hedged API calls and per-call deadlines, to cut the tail latency of interactive runs.
+
+Provider latency has a long tail: most calls answer in a few seconds, and a few take many times longer. A hedged
+call waits for the first attempt up to a percentile of the backend's recent latency (see `LatencyHistogram`),
+then sends a duplicate, and returns whichever answers first. The other call is cancelled (see `CancelToken`): it
+gives back its concurrency slot and API key at once, and isn't retried. A running HTTP call can't be interrupted
+from another thread, so its answer is discarded, and it ends at its timeout at the latest.
+Hedges are only sent while the backend has spare capacity, so they don't add load to a congested backend.
+
+A deadline bounds a call, including its queueing, retries and hedges. It's passed on to the HTTP client as the
+call's timeout (see `deadline_kwargs`), so a stuck connection is closed instead of blocking the node.
+"""
+
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextvars import ContextVar
+from typing import Any
+
+from .metrics import RequestTimings, bind_timings
+from .utils.loggable import Loggable
+
+# log-spaced latency buckets, from 10 ms to 10 minutes (about 12% apart)
+HISTOGRAM_MIN_S: float = 0.01
+HISTOGRAM_MAX_S: float = 600.0
+HISTOGRAM_BUCKETS: int = 96
+# latencies older than the window are dropped, a slice at a time
+DEFAULT_WINDOW_S: float = 300.0
+WINDOW_SLICES: int = 10
+
+# calls observed before hedging, percentiles of fewer calls are noise
+MIN_HEDGE_SAMPLES: int = 20
+MIN_HEDGE_DELAY_S: float = 0.05
+# threads of the hedged calls, created as needed
+HEDGE_WORKERS: int = 64
+
+
+class LatencyHistogram:
+    """
+    Rolling histogram of call latencies over the last `window_s`, in log-spaced buckets, so percentiles cost a
+    pass over the buckets whatever the number of calls. Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        window_s: float = DEFAULT_WINDOW_S,
+        slices: int = WINDOW_SLICES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param window_s: Latencies observed longer ago than this are dropped
+        :param slices: Number of time slices of the window, the window moves by a slice at a time
+        :param clock: Returns the current time in seconds
+        """
+        self.window_s = window_s
+        self.slice_s = window_s / slices
+        self.clock = clock
+        # upper bounds, the last bucket also counts anything above HISTOGRAM_MAX_S
+        self.bounds: list[float] = [
+            HISTOGRAM_MIN_S
+            * (HISTOGRAM_MAX_S / HISTOGRAM_MIN_S) ** (index / (HISTOGRAM_BUCKETS - 1))
+            for index in range(HISTOGRAM_BUCKETS)
+        ]
+
+        # (slice start, counts per bucket), oldest first
+        self._slices: deque[tuple[float, list[int]]] = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        # caller must hold the lock
+        while self._slices and self._slices[0][0] <= now - self.window_s:
+            self._slices.popleft()
+
+    def observe(self, latency_s: float) -> None:
+        """Adds the latency of a call."""
+        index = min(bisect.bisect_left(self.bounds, latency_s), len(self.bounds) - 1)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            slice_start = now - now % self.slice_s
+            if not self._slices or self._slices[-1][0] != slice_start:
+                self._slices.append((slice_start, [0] * len(self.bounds)))
+            self._slices[-1][1][index] += 1
+
+    def _counts(self) -> list[int]:
+        # caller must hold the lock
+        self._expire(self.clock())
+        return [
+            sum(counts)
+            for counts in zip(*(counts for _, counts in self._slices), strict=True)
+        ]
+
+    def count(self) -> int:
+        """Returns the number of calls in the window."""
+        with self._lock:
+            return sum(self._counts())
+
+    def percentile(self, percentile: float) -> float | None:
+        """
+        Returns the latency that `percentile` % of the calls in the window were faster than (the upper bound of
+        its bucket), or None without any call.
+        """
+        with self._lock:
+            counts = self._counts()
+        if not (total := sum(counts)):
+            return None
+        rank = max(1, math.ceil(total * percentile / 100))
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts, strict=True):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.bounds[-1]
+
+
+def remaining_s(deadline: float | None) -> float | None:
+    """Returns the seconds left until the (monotonic) deadline, or None without a deadline."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def deadline_kwargs(deadline: float | None) -> dict[str, float]:
+    """Returns the `timeout` argument of an API call that ends by the deadline, none without a deadline."""
+    if deadline is None:
+        return {}
+    return {"timeout": remaining_s(deadline)}
+
+
+class CancelToken:
+    """
+    Cancels a call abandoned by `hedged_call`. What the call acquires is released through `once`, so it's released
+    when the call is done with it or when the call is cancelled, whichever is first. Safe to use from several
+    threads.
+    """
+
+    def __init__(self):
+        self.cancelled: bool = False
+        self._callbacks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        """Runs the registered callbacks that haven't run yet."""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def once(self, callback: Callable[..., None], *cancel_args) -> Callable[..., None]:
+        """
+        Returns `callback` wrapped to run at most once, also run (with `cancel_args`) if the token is cancelled
+        first. If it's already cancelled, the callback is run and a CancelledError raised.
+        """
+        done = False
+        done_lock = threading.Lock()
+
+        def run_once(*args) -> None:
+            nonlocal done
+            with done_lock:
+                if done:
+                    return
+                done = True
+            with self._lock:
+                if on_cancel in self._callbacks:
+                    self._callbacks.remove(on_cancel)
+            callback(*args)
+
+        def on_cancel() -> None:
+            run_once(*cancel_args)
+
+        with self._lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self._callbacks.append(on_cancel)
+        if cancelled:
+            on_cancel()
+            raise CancelledError("The call was abandoned")
+        return run_once
+
+
+_current_cancel_token: ContextVar[CancelToken | None] = ContextVar(
+    "current_cancel_token", default=None
+)
+
+
+def cancellable(callback: Callable[..., None], *cancel_args) -> Callable[..., None]:
+    """
+    Returns `callback` (e.g. releasing a concurrency slot) wrapped to run at most once, and to also run with
+    `cancel_args` if the current call is abandoned by `hedged_call`, see `CancelToken.once`.
+    """
+    if (token := _current_cancel_token.get()) is None:
+        return callback
+    return token.once(callback, *cancel_args)
+
+
+def raise_if_cancelled() -> None:
+    """Raises a CancelledError if the current call was abandoned by `hedged_call`, e.g. before retrying it."""
+    if (token := _current_cancel_token.get()) is not None and token.cancelled:
+        raise CancelledError("The call was abandoned")
+
+
+_hedge_executor: ThreadPoolExecutor | None = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Returns the process-wide executor of hedged calls, creating it on first use."""
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=HEDGE_WORKERS, thread_name_prefix="structured-output-hedge"
+            )
+        return _hedge_executor
+
+
+def hedged_call(
+    call: Callable[[RequestTimings], Any],
+    hedge_after_s: float,
+    can_hedge: Callable[[], bool] = lambda: True,
+    deadline: float | None = None,
+    timings: RequestTimings | None = None,
+) -> tuple[Any, bool]:
+    """
+    Runs `call`, and a duplicate if it hasn't answered after `hedge_after_s`, returning the first answer. If one
+    of them fails, the other is waited for, the error is raised if both fail. The calls still running when it
+    returns are cancelled, see `CancelToken`.
+
+    :param call: Makes the call, recording its stages in the given timings
+    :param hedge_after_s: Seconds to wait for the first call before sending the duplicate
+    :param can_hedge: Checked before sending the duplicate, e.g. that the backend has spare capacity
+    :param deadline: Monotonic time after which a TimeoutError is raised, or None to wait for the calls
+    :param timings: The stages of the answering call, and the attempts of both, are added to it
+    :return: The answer, and True if it came from the duplicate
+    """
+    executor = get_hedge_executor()
+    calls: list[tuple[Future, RequestTimings]] = []
+    tokens: list[CancelToken] = []
+
+    def submit() -> None:
+        call_timings = RequestTimings()
+        cancel_token = CancelToken()
+
+        def run() -> Any:
+            reset_token = _current_cancel_token.set(cancel_token)
+            try:
+                return call(call_timings)
+            finally:
+                _current_cancel_token.reset(reset_token)
+
+        # the API call hooks record the attempts of each call in its own timings
+        future = executor.submit(bind_timings(call_timings, run))
+        calls.append((future, call_timings))
+        tokens.append(cancel_token)
+
+    submit()
+    wait_s = hedge_after_s
+    if (left_s := remaining_s(deadline)) is not None:
+        wait_s = min(wait_s, left_s)
+    done, _ = wait([calls[0][0]], timeout=wait_s)
+    if not done and remaining_s(deadline) != 0.0 and can_hedge():
+        Loggable.log().debug(
+            "No answer after %.0f ms, sending a hedged request", hedge_after_s * 1000
+        )
+        submit()
+        if timings is not None:
+            timings.hedged = True
+
+    pending = {future for future, _ in calls}
+    error: BaseException | None = None
+    try:
+        while pending:
+            done, pending = wait(
+                pending, timeout=remaining_s(deadline), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                Loggable.log().error(
+                    msg
+                    := f"Request missed its deadline, abandoned after {len(calls)} calls"
+                )
+                raise TimeoutError(msg)
+            for future, call_timings in calls:
+                if future not in done:
+                    continue
+                if (error := future.exception()) is None:
+                    if timings is not None:
+                        for stage, seconds in call_timings.stages_s.items():
+                            timings.add(stage, seconds)
+                    return future.result(), future is not calls[0][0]
+        raise error
+    finally:
+        if timings is not None:
+            timings.attempts += sum(call_timings.attempts for _, call_timings in calls)
+        for (future, _), cancel_token in zip(calls, tokens, strict=True):
+            # stops calls still waiting for a thread, running calls release what they hold
+            future.cancel()
+            cancel_token.cancel()
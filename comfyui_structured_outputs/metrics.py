@@ -0,0 +1,458 @@
+"""
+Per-stage timings and token counts of structured output requests.
+
+Each request records a `RequestTimings` breakdown (schema build, cache lookup, image encode, network wait,
+validation, ...), which is also aggregated into a process-wide `MetricsRegistry` of counters and histograms.
+The registry can be written as Prometheus text or JSON, to a file (`METRICS_FILE` in .env) or served by the
+ComfyUI server at `/structured_outputs/metrics`.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+import time
+import weakref
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from .utils.loggable import Loggable
+
+if TYPE_CHECKING:
+    from instructor import Instructor
+
+METRICS_PREFIX: str = "structured_output"
+METRICS_ROUTE: str = "/structured_outputs/metrics"
+
+# upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS_S: tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    math.inf,
+)
+
+# request stages, in the order they run
+STAGES: tuple[str, ...] = (
+    "schema",
+    "cache_lookup",
+    "coalesced",
+    "encode",
+    "queue",
+    "network",
+    "stream",
+    "validation",
+    "cache_store",
+    "total",
+)
+
+# label names and values, sorted by name
+Labels = tuple[tuple[str, str], ...]
+
+
+def _escape(label_value: str) -> str:
+    return label_value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@dataclass
+class _Histogram:
+    bucket_counts: list[int]
+    count: int = 0
+    total: float = 0.0
+
+
+class MetricsRegistry(Loggable):
+    """Thread-safe counters and histograms, exportable as Prometheus text or JSON."""
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS_S):
+        """
+        :param buckets: Upper bounds of the histogram buckets, ending with infinity
+        """
+        self.buckets = buckets
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._gauges: dict[str, dict[Labels, float]] = {}
+        self._histograms: dict[str, dict[Labels, _Histogram]] = {}
+        self._help: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def describe(self, name: str, help_text: str) -> None:
+        """Sets the help text of a metric, shown in the Prometheus output."""
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        """Increments a counter."""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        """Sets a gauge, a value that can go up and down."""
+        key = self._labels(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Records a value in a histogram."""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if (histogram := series.get(key)) is None:
+                histogram = series[key] = _Histogram([0] * len(self.buckets))
+            histogram.count += 1
+            histogram.total += value
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram.bucket_counts[index] += 1
+                    break
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        """Returns the value of a counter, 0 if it was never incremented."""
+        with self._lock:
+            return self._counters.get(name, {}).get(self._labels(labels), 0.0)
+
+    def gauge_value(self, name: str, **labels: Any) -> float | None:
+        """Returns the value of a gauge, None if it was never set."""
+        with self._lock:
+            return self._gauges.get(name, {}).get(self._labels(labels))
+
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the metrics as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "counters": {
+                    name: [
+                        {"labels": dict(labels), "value": value}
+                        for labels, value in series.items()
+                    ]
+                    for name, series in self._counters.items()
+                },
+                "gauges": {
+                    name: [
+                        {"labels": dict(labels), "value": value}
+                        for labels, value in series.items()
+                    ]
+                    for name, series in self._gauges.items()
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(labels),
+                            "count": histogram.count,
+                            "sum": histogram.total,
+                            "buckets": {
+                                "+Inf" if math.isinf(bound) else str(bound): count
+                                for bound, count in zip(
+                                    self.buckets, histogram.bucket_counts, strict=True
+                                )
+                            },
+                        }
+                        for labels, histogram in series.items()
+                    ]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+        if not (labels := labels + extra):
+            return ""
+        return (
+            "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+        )
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines: list[str] = []
+        with self._lock:
+            for metric_type, metrics in (
+                ("counter", self._counters),
+                ("gauge", self._gauges),
+            ):
+                for name, series in metrics.items():
+                    if name in self._help:
+                        lines.append(f"# HELP {name} {self._help[name]}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    lines.extend(
+                        f"{name}{self._format_labels(labels)} {value:g}"
+                        for labels, value in series.items()
+                    )
+            for name, series in self._histograms.items():
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(
+                        self.buckets, histogram.bucket_counts, strict=True
+                    ):
+                        cumulative += count
+                        le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                        lines.append(
+                            f"{name}_bucket{self._format_labels(labels, (('le', le),))} {cumulative}"
+                        )
+                    lines.append(
+                        f"{name}_sum{self._format_labels(labels)} {histogram.total:g}"
+                    )
+                    lines.append(
+                        f"{name}_count{self._format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        """Writes the metrics to a file, as JSON for `.json` files, Prometheus text otherwise."""
+        content = (
+            json.dumps(self.to_dict(), indent=2)
+            if path.suffix == ".json"
+            else self.to_prometheus()
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, so scrapers never read a partial file
+        temp_path = path.with_name(
+            f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        temp_path.write_text(content)
+        temp_path.replace(path)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+METRICS: MetricsRegistry = MetricsRegistry()
+METRICS.describe(
+    f"{METRICS_PREFIX}_stage_seconds", "Time spent in each stage of a request"
+)
+METRICS.describe(f"{METRICS_PREFIX}_requests_total", "Requests, by outcome")
+METRICS.describe(f"{METRICS_PREFIX}_attempts_total", "API calls, including retries")
+METRICS.describe(f"{METRICS_PREFIX}_tokens_total", "Prompt and completion tokens")
+METRICS.describe(
+    f"{METRICS_PREFIX}_first_attribute_seconds",
+    "Time from a streamed call to its first complete attribute",
+)
+
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the process-wide metrics registry."""
+    return METRICS
+
+
+@dataclass
+class RequestTimings:
+    """Timing breakdown and token usage of a single structured output request."""
+
+    stages_s: dict[str, float] = field(default_factory=dict)
+    # API calls made, more than 1 if instructor retried after a validation error
+    attempts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # estimated prompt tokens of the JSON schema sent, see `schema_tokens`
+    schema_tokens: int = 0
+    cache_hit: bool = False
+    # shared the response of an identical request in flight
+    coalesced: bool = False
+    # sent a duplicate of a slow call, see `hedged_call`
+    hedged: bool = False
+    # streamed calls: seconds from the call to the first complete attribute, and to each attribute by name
+    first_attribute_s: float | None = None
+    attribute_s: dict[str, float] = field(default_factory=dict)
+    _attempt_start: float | None = field(default=None, repr=False)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """Adds the time spent in the block to the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages_s[stage] = self.stages_s.get(stage, 0.0) + seconds
+
+    def record_usage(self, usage: Any) -> None:
+        """Records the token usage of a completion (summed over retries by instructor)."""
+        if usage is None:
+            return
+        self.prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stages_ms": {
+                stage: round(seconds * 1000, 3)
+                for stage, seconds in sorted(
+                    self.stages_s.items(),
+                    key=lambda item: (
+                        STAGES.index(item[0]) if item[0] in STAGES else len(STAGES)
+                    ),
+                )
+            },
+            "attempts": self.attempts,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "schema_tokens": self.schema_tokens,
+            "cache_hit": self.cache_hit,
+            "coalesced": self.coalesced,
+            "hedged": self.hedged,
+            "first_attribute_ms": round(self.first_attribute_s * 1000, 3)
+            if self.first_attribute_s is not None
+            else None,
+            "attribute_ms": {
+                name: round(seconds * 1000, 3)
+                for name, seconds in self.attribute_s.items()
+            },
+        }
+
+
+# timings of the request running in the current thread, read by the instructor hooks
+_current_timings: ContextVar[RequestTimings | None] = ContextVar(
+    "current_timings", default=None
+)
+_instrumented_clients: weakref.WeakSet[Instructor] = weakref.WeakSet()
+_instrumented_clients_lock = threading.Lock()
+
+
+def _on_completion_kwargs(*args, **kwargs) -> None:
+    if (timings := _current_timings.get()) is not None:
+        timings.attempts += 1
+        timings._attempt_start = time.perf_counter()
+
+
+def _on_completion_done(*args, **kwargs) -> None:
+    if (timings := _current_timings.get()) is not None and (
+        timings._attempt_start is not None
+    ):
+        timings.add("network", time.perf_counter() - timings._attempt_start)
+        timings._attempt_start = None
+
+
+def bind_timings(
+    timings: RequestTimings | None, fn: Callable[[], Any]
+) -> Callable[[], Any]:
+    """Returns `fn`, calling it with `timings` as the timings of the current request, e.g. in another thread."""
+
+    def bound() -> Any:
+        token = _current_timings.set(timings)
+        try:
+            return fn()
+        finally:
+            _current_timings.reset(token)
+
+    return bound
+
+
+def instrument_client(instructor_client: Instructor) -> None:
+    """Registers the hooks timing each API call (including retries) of the client, once per client."""
+    with _instrumented_clients_lock:
+        if instructor_client in _instrumented_clients:
+            return
+        instructor_client.on("completion:kwargs", _on_completion_kwargs)
+        instructor_client.on("completion:response", _on_completion_done)
+        instructor_client.on("completion:error", _on_completion_done)
+        _instrumented_clients.add(instructor_client)
+
+
+@contextmanager
+def track_request(backend: str) -> Iterator[RequestTimings]:
+    """
+    Times a request, yielding its `RequestTimings`, which are added to the registry when the block exits.
+    API calls made by instrumented clients within the block are timed as the "network" stage.
+
+    :param backend: Backend name, used as a metric label
+    """
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    outcome = "error"
+    try:
+        with timings.span("total"):
+            yield timings
+        outcome = (
+            "cache_hit"
+            if timings.cache_hit
+            else "coalesced"
+            if timings.coalesced
+            else "success"
+        )
+    finally:
+        _current_timings.reset(token)
+        record_request(timings, backend, outcome)
+
+
+def record_request(timings: RequestTimings, backend: str, outcome: str) -> None:
+    """Adds a request's timings to the process-wide registry."""
+    METRICS.inc(f"{METRICS_PREFIX}_requests_total", backend=backend, outcome=outcome)
+    METRICS.inc(f"{METRICS_PREFIX}_attempts_total", timings.attempts, backend=backend)
+    for kind, tokens in (
+        ("prompt", timings.prompt_tokens),
+        ("completion", timings.completion_tokens),
+    ):
+        METRICS.inc(
+            f"{METRICS_PREFIX}_tokens_total", tokens, backend=backend, kind=kind
+        )
+    for stage, seconds in timings.stages_s.items():
+        METRICS.observe(
+            f"{METRICS_PREFIX}_stage_seconds", seconds, backend=backend, stage=stage
+        )
+    if timings.first_attribute_s is not None:
+        METRICS.observe(
+            f"{METRICS_PREFIX}_first_attribute_seconds",
+            timings.first_attribute_s,
+            backend=backend,
+        )
+
+
+def write_metrics_file(path: Path | None) -> None:
+    """Writes the registry to the file, if set. Errors are logged, metrics never fail a request."""
+    if path is None:
+        return
+    try:
+        METRICS.write(path)
+    except OSError as e:
+        Loggable.log().warning(f"Could not write metrics to '{path}': {e}")
+
+
+def register_metrics_route() -> bool:
+    """
+    Serves the registry at `METRICS_ROUTE` on the ComfyUI server, as Prometheus text, or as JSON with
+    `?format=json`. Returns False when not running inside ComfyUI.
+    """
+    try:
+        from server import PromptServer
+    except ImportError:
+        return False
+    # a dependency of the ComfyUI server, only imported when running inside it
+    from aiohttp import web
+
+    if getattr(PromptServer, "instance", None) is None:
+        return False
+
+    @PromptServer.instance.routes.get(METRICS_ROUTE)
+    async def metrics_route(request: web.Request) -> web.Response:
+        if request.query.get("format") == "json":
+            return web.json_response(METRICS.to_dict())
+        return web.Response(text=METRICS.to_prometheus(), content_type="text/plain")
+
+    return True
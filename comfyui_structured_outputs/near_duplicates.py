@@ -0,0 +1,179 @@
+"""
+Near-duplicate lookup of image requests, by perceptual hash.
+
+The response cache only answers byte-identical images. Workflows often send images that are almost identical:
+re-renders with another seed, slight crops, re-encodes. Their perceptual hashes (see `perceptual_hash`) differ
+in a few bits, so the index keeps the hash of every image request with its response cache key, in a BK-tree per
+request context (model, prompt, schema and image options). A lookup finds the cached responses of images within
+a Hamming distance of the image, nearest first, in far fewer comparisons than a scan of every hash.
+
+The index only holds keys, the responses stay in the response cache. It is kept in memory, so it starts empty
+after a restart.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+
+from .utils.image_utils import hamming_distance
+from .utils.loggable import Loggable
+
+DEFAULT_MAX_ENTRIES: int = 10_000
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance. Each child is stored under its distance to the
+    parent, so by the triangle inequality a search within distance d only descends into children whose distance
+    is within d of the query's distance to the parent.
+    """
+
+    __slots__ = ("hash_value", "keys", "children")
+
+    def __init__(self, hash_value: int, key: str):
+        self.hash_value = hash_value
+        self.keys: list[str] = [key]
+        self.children: dict[int, BKTree] = {}
+
+    def add(self, hash_value: int, key: str) -> None:
+        node = self
+        while (distance := hamming_distance(hash_value, node.hash_value)) != 0:
+            if (child := node.children.get(distance)) is None:
+                node.children[distance] = BKTree(hash_value, key)
+                return
+            node = child
+        node.keys.append(key)
+
+    def search(self, hash_value: int, max_distance: int) -> Iterator[tuple[int, str]]:
+        """Yields the (distance, key) of every hash within `max_distance`, in no particular order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node.hash_value)
+            if distance <= max_distance:
+                yield from ((distance, key) for key in node.keys)
+            for child_distance, child in node.children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+
+
+class NearDuplicateIndex(Loggable):
+    """
+    Index of image request hashes by context, see the module docstring. Holds at most `max_entries` keys, the
+    oldest are dropped first. Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        :param max_entries: Maximum number of indexed requests
+        """
+        self.max_entries = max_entries
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        # key -> (context, hash), in insertion order for eviction
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._trees: dict[str, BKTree] = {}
+        # evicted keys are only dropped from the trees when they are rebuilt
+        self._evicted: int = 0
+        self._lock = threading.Lock()
+
+    def add(self, context: str, hash_value: int, key: str) -> None:
+        """
+        Indexes the image hash of a request.
+
+        :param context: Fingerprint of the request without its image, only requests in the same context match
+        :param hash_value: Perceptual hash of the image
+        :param key: Response cache key of the request
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (context, hash_value)
+            if (tree := self._trees.get(context)) is None:
+                self._trees[context] = BKTree(hash_value, key)
+            else:
+                tree.add(hash_value, key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evicted += 1
+            if self._evicted > self.max_entries // 2:
+                self._rebuild()
+
+    def _rebuild(self) -> None:
+        # caller must hold the lock
+        self._trees = {}
+        for key, (context, hash_value) in self._entries.items():
+            if (tree := self._trees.get(context)) is None:
+                self._trees[context] = BKTree(hash_value, key)
+            else:
+                tree.add(hash_value, key)
+        self._evicted = 0
+
+    def find(
+        self, context: str, hash_value: int, max_distance: int
+    ) -> list[tuple[int, str]]:
+        """Returns the (distance, key) of the indexed requests within `max_distance` bits, nearest first."""
+        with self._lock:
+            if (tree := self._trees.get(context)) is None:
+                return []
+            return sorted(
+                (distance, key)
+                for distance, key in tree.search(hash_value, max_distance)
+                if key in self._entries
+            )
+
+    def get(
+        self,
+        context: str,
+        hash_value: int,
+        max_distance: int,
+        get_response: Callable[[str], str | None],
+    ) -> tuple[str, int] | None:
+        """
+        Returns the response of the nearest indexed request that has one, with its distance, or None.
+
+        :param context: Fingerprint of the request without its image
+        :param hash_value: Perceptual hash of the image
+        :param max_distance: Maximum number of differing bits, out of PERCEPTUAL_HASH_BITS
+        :param get_response: Returns the cached response of a key, e.g. `ResponseCache.get`
+        """
+        for distance, key in self.find(context, hash_value, max_distance):
+            # requests still in flight, or that failed, have no response
+            if (response := get_response(key)) is not None:
+                with self._lock:
+                    self.hits += 1
+                return response, distance
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def stats(self) -> dict[str, int | float]:
+        """Returns the hit/miss counters, the hit rate and the number of indexed requests."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "contexts": len(self._trees),
+            }
+
+
+_near_duplicate_index: NearDuplicateIndex | None = None
+_near_duplicate_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    """Returns the process-wide near-duplicate index, creating it on first use."""
+    global _near_duplicate_index
+    with _near_duplicate_index_lock:
+        if _near_duplicate_index is None:
+            _near_duplicate_index = NearDuplicateIndex()
+        return _near_duplicate_index
@@ -0,0 +1,110 @@
+"""
+Packing of several images into one structured output request.
+
+For small schemas over many images, the round-trip dominates the cost of each request. A packed request sends up
+to K images at once, numbered in the prompt, and asks for a wrapper schema: an array of per-image results, each
+with the index of its image. The results are unpacked by index, and images whose index is missing (or repeated)
+are left for the caller to request again on their own.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+
+from pydantic import BaseModel, Field, create_model
+
+from .attribute_utils import RETURN_MODEL_CACHE_SIZE, BaseAttributesModel
+from .utils.image_utils import EncodedImage
+from .utils.loggable import Loggable
+
+# images per request, a larger pack makes for a longer response and more room for the model to skip an image
+MAX_PACK_SIZE: int = 32
+
+
+class BasePackedResult(BaseModel):
+    index: int
+    attributes: BaseAttributesModel
+
+
+class BasePackedModel(BaseModel):
+    results: list[BasePackedResult]
+
+
+@lru_cache(maxsize=RETURN_MODEL_CACHE_SIZE)
+def packed_model(
+    attributes_model: type[BaseAttributesModel],
+) -> type[BasePackedModel]:
+    """Returns the (cached) wrapper model, with an indexed result of the attributes model per image."""
+    result_model = create_model(
+        "ImageResult",
+        index=(int, Field(description="Index of the image, as numbered in the prompt")),
+        attributes=(attributes_model, Field()),
+        __base__=BasePackedResult,
+    )
+    return create_model(
+        "PackedReturnModel",
+        results=(
+            list[result_model],
+            Field(description="One result per image, in the order of the images"),
+        ),
+        __base__=BasePackedModel,
+    )
+
+
+def build_packed_messages(
+    prompt: str, images: list[EncodedImage], detail: str = "auto"
+) -> list[dict]:
+    """Builds the chat messages for a prompt over several images, each labelled with its index."""
+    content: list[dict] = [
+        {
+            "type": "text",
+            "text": f"{prompt}\n\nThere are {len(images)} images, numbered from 0 to {len(images) - 1}. "
+            "Answer for each image separately, with one result per image and the image's index.",
+        }
+    ]
+    for index, image in enumerate(images):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append(
+            {
+                "type": "image_url",
+                "image_url": {"url": image.data_url, "detail": detail},
+            }
+        )
+    return [{"role": "user", "content": content}]
+
+
+def unpack_results(
+    packed: BasePackedModel, count: int
+) -> dict[int, BaseAttributesModel]:
+    """
+    Returns the attributes of each image by index. Indices out of range are dropped, and only the first result
+    of a repeated index is kept, so the missing images are those not in the returned dict.
+
+    :param packed: Response of a packed request
+    :param count: Number of images in the request
+    """
+    results: dict[int, BaseAttributesModel] = {}
+    for result in packed.results:
+        if not 0 <= result.index < count:
+            Loggable.log().debug(
+                "Dropped the result for image %d, out of range for %d images",
+                result.index,
+                count,
+            )
+            continue
+        if result.index in results:
+            Loggable.log().debug("Dropped a repeated result for image %d", result.index)
+            continue
+        results[result.index] = result.attributes
+    return results
+
+
+def pack(indices: list[int], pack_size: int) -> list[list[int]]:
+    """Splits the image indices into packs of at most `pack_size` images."""
+    if pack_size < 1:
+        Loggable.log().error(msg := f"pack_size must be at least 1, got {pack_size}")
+        raise ValueError(msg)
+    return [
+        indices[start : start + pack_size]
+        for start in range(0, len(indices), pack_size)
+    ]
@@ -0,0 +1,272 @@
+"""
+Content-addressed cache of structured output responses.
+
+Responses are keyed by a hash of everything that determines the answer: the model, the messages, the JSON schema
+of the response model and the raw image bytes. Lookups go to a bounded in-memory LRU first, then to a local SQLite
+store, so re-queued workflows don't wait on (or pay for) a request that was already answered.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from . import CACHE_DIR
+from .utils.loggable import Loggable
+
+RESPONSE_CACHE_FILE: Path = CACHE_DIR / "responses.sqlite3"
+
+DEFAULT_MAX_MEMORY_ENTRIES: int = 256
+DEFAULT_MAX_DISK_ENTRIES: int = 10_000
+# one week
+DEFAULT_TTL_S: float = 7 * 24 * 60 * 60
+# expired and least recently used entries are deleted every this many sets, or once the disk holds this
+# fraction more entries than its maximum, instead of on every set
+EVICTION_INTERVAL_SETS: int = 64
+EVICTION_HIGH_WATER: float = 0.1
+# access times of disk hits are written in batches, at the next set or once this many are pending
+ACCESS_FLUSH_SIZE: int = 64
+
+
+class ResponseCache(Loggable):
+    """
+    Two-level (memory LRU + SQLite) cache of serialized responses, with TTL and size-based eviction.
+    Eviction runs periodically, so the disk may briefly hold expired entries or up to `EVICTION_HIGH_WATER` more
+    entries than its maximum (expired entries are never returned). Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        path: Path | None = RESPONSE_CACHE_FILE,
+        max_memory_entries: int = DEFAULT_MAX_MEMORY_ENTRIES,
+        max_disk_entries: int = DEFAULT_MAX_DISK_ENTRIES,
+        ttl_s: float | None = DEFAULT_TTL_S,
+    ):
+        """
+        :param path: Path to the SQLite file, or None to only cache in memory
+        :param max_memory_entries: Maximum number of responses kept in memory
+        :param max_disk_entries: Maximum number of responses kept on disk
+        :param ttl_s: Time to live of a response in seconds, or None to never expire
+        """
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_s = ttl_s
+
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.RLock()
+        self._connection: sqlite3.Connection | None = None
+        # access times not written yet, by key
+        self._pending_accesses: dict[str, float] = {}
+        self._sets_since_eviction: int = 0
+        # upper bound of the entries on disk, exact after each eviction
+        self._disk_entries: int = 0
+
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+            self._connection.commit()
+            self._disk_entries = self._count_disk_entries()
+
+    @staticmethod
+    def make_key(
+        model: str,
+        messages: list[dict],
+        schema: dict,
+        image_bytes: bytes | memoryview | None = None,
+        image_shape: tuple[int, ...] | None = None,
+        image_options: dict | None = None,
+        image_fingerprint: str | None = None,
+    ) -> str:
+        """
+        Returns the cache key for a request.
+
+        :param model: Model name
+        :param messages: Chat messages, without any encoded image
+        :param schema: JSON schema of the response model
+        :param image_bytes: Raw bytes of the image, if any
+        :param image_shape: Shape of the image, if any
+        :param image_options: Options used to encode the image, if any
+        :param image_fingerprint: Fingerprint of the image, instead of its bytes, see `tensor_fingerprint`
+        """
+        hasher = hashlib.sha256()
+        hasher.update(
+            json.dumps(
+                {
+                    "model": model,
+                    "messages": messages,
+                    "schema": schema,
+                    "image_shape": image_shape,
+                    "image_options": image_options,
+                    "image_fingerprint": image_fingerprint,
+                },
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        if image_bytes is not None:
+            hasher.update(image_bytes)
+        return hasher.hexdigest()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_s is not None and now - created_at > self.ttl_s
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached value for the key, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            if (entry := self._memory.get(key)) is not None:
+                created_at, value = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._pending_accesses[key] = now
+                        if len(self._pending_accesses) >= ACCESS_FLUSH_SIZE:
+                            self._flush_accesses()
+                            self._connection.commit()
+                        self._remember(key, created_at, value)
+                        self.disk_hits += 1
+                        return value
+                    self._connection.execute(
+                        "DELETE FROM responses WHERE key = ?", (key,)
+                    )
+                    self._connection.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """Stores the value for the key, evicting expired and least recently used entries periodically."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+
+            if self._connection is None:
+                return
+
+            self._flush_accesses()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._disk_entries += 1
+            self._sets_since_eviction += 1
+            if (
+                self._sets_since_eviction >= EVICTION_INTERVAL_SETS
+                or self._disk_entries
+                > self.max_disk_entries * (1 + EVICTION_HIGH_WATER)
+            ):
+                self._evict(now)
+            self._connection.commit()
+
+    def _flush_accesses(self) -> None:
+        # caller must hold the lock, and commit
+        if self._pending_accesses:
+            self._connection.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                [
+                    (accessed_at, key)
+                    for key, accessed_at in self._pending_accesses.items()
+                ],
+            )
+            self._pending_accesses.clear()
+
+    def _evict(self, now: float) -> None:
+        # caller must hold the lock, and commit
+        if self.ttl_s is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_s,)
+            )
+        self._connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self._disk_entries = self._count_disk_entries()
+        self._sets_since_eviction = 0
+
+    def _count_disk_entries(self) -> int:
+        # caller must hold the lock
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _remember(self, key: str, created_at: float, value: str) -> None:
+        # caller must hold the lock
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all entries from memory and disk, and resets the counters."""
+        with self._lock:
+            self._memory.clear()
+            self._pending_accesses.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM responses")
+                self._connection.commit()
+                self._disk_entries = 0
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit/miss counters and current sizes."""
+        with self._lock:
+            disk_entries = 0
+            if self._connection is not None:
+                disk_entries = self._count_disk_entries()
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+    def close(self) -> None:
+        """Writes the pending access times and closes the SQLite connection, the in-memory entries stay usable."""
+        with self._lock:
+            if self._connection is not None:
+                self._flush_accesses()
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
+
+
+_response_cache: ResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the process-wide response cache, creating it on first use."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
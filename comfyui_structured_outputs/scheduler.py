@@ -0,0 +1,542 @@
+"""
+Process-wide scheduling of API calls, to run at the provider's rate limits instead of hitting them.
+
+Every call to a backend goes through the backend's `RequestScheduler`, shared by all nodes and batch requests:
+- token buckets keep the requests and tokens per minute under the configured limits
+- the number of calls in flight adapts (AIMD): it grows while calls succeed, and halves on a 429 or when the
+  latency goes over a target
+- rate limited and transient errors are retried after the `Retry-After` delay (or an exponential backoff), and
+  a 429 pauses every call to the backend, not just the one that was limited
+- calls can have a deadline, and slow calls can be hedged with a duplicate, see `hedging.py`
+"""
+
+from __future__ import annotations
+
+import email.utils
+import math
+import random
+import threading
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+from .hedging import (
+    MIN_HEDGE_DELAY_S,
+    MIN_HEDGE_SAMPLES,
+    LatencyHistogram,
+    cancellable,
+    hedged_call,
+    raise_if_cancelled,
+    remaining_s,
+)
+from .metrics import METRICS, METRICS_PREFIX, RequestTimings
+from .utils.image_utils import EncodedImage, provider_image_size
+from .utils.loggable import Loggable
+from .utils.utils import lazy_import
+
+if TYPE_CHECKING:
+    import openai
+    from instructor import exceptions as instructor_exceptions
+
+    from .backends import BackendSettings
+else:
+    # imported on first use, see `lazy_import`
+    openai = lazy_import("openai")
+    instructor_exceptions = lazy_import("instructor.exceptions")
+
+DEFAULT_MAX_CONCURRENCY: int = 16
+DEFAULT_MAX_RETRIES: int = 5
+# exponential backoff, when the response has no Retry-After
+BACKOFF_BASE_S: float = 0.5
+BACKOFF_MAX_S: float = 60.0
+# concurrent 429s are one congestion signal, the limit is only decreased once per cooldown
+DECREASE_COOLDOWN_S: float = 1.0
+# multiplicative decrease on a 429, and on a call slower than the target latency
+RATE_LIMITED_DECREASE: float = 0.5
+SLOW_DECREASE: float = 0.9
+
+# image tokens, as billed by OpenAI for 512px tiles
+IMAGE_BASE_TOKENS: int = 85
+IMAGE_TILE_TOKENS: int = 170
+IMAGE_TILE_SIZE: int = 512
+# rough characters per token of English text and JSON
+CHARS_PER_TOKEN: int = 4
+
+
+class TokenBucket:
+    """
+    Refills at `rate_per_minute`, up to `capacity`. Takes may overdraw a full bucket, so a request larger than
+    the capacity waits for the bucket to fill instead of forever, and the debt delays later takes.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        """
+        :param rate_per_minute: Refill rate
+        :param capacity: Maximum burst, defaults to 10 seconds of refill (providers enforce limits over
+            windows shorter than a minute)
+        """
+        if rate_per_minute <= 0:
+            Loggable.log().error(msg := f"Invalid rate: {rate_per_minute}")
+            raise ValueError(msg)
+        self.rate_per_s = rate_per_minute / 60
+        self.capacity = (
+            capacity if capacity is not None else max(1.0, rate_per_minute / 6)
+        )
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        # caller must hold the lock
+        now = time.monotonic()
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.rate_per_s
+        )
+        self._updated = now
+
+    def try_take(self, amount: float) -> float:
+        """Takes `amount` if available and returns 0, otherwise returns the seconds to wait before retrying."""
+        with self._lock:
+            self._refill()
+            needed = min(amount, self.capacity)
+            if self._level >= needed:
+                self._level -= amount
+                return 0.0
+            return (needed - self._level) / self.rate_per_s
+
+    def take(self, amount: float, deadline: float | None = None) -> float:
+        """
+        Blocks until `amount` is taken, returning the seconds waited. Raises a TimeoutError, without taking
+        anything, if it can't be taken by the (monotonic) deadline.
+        """
+        waited = 0.0
+        while (wait_s := self.try_take(amount)) > 0:
+            if (left_s := remaining_s(deadline)) is not None and wait_s > left_s:
+                raise TimeoutError(
+                    f"Taking {amount:.0f} needs a {wait_s:.2f} s wait, {left_s:.2f} s left"
+                )
+            time.sleep(wait_s)
+            waited += wait_s
+        return waited
+
+    def adjust(self, amount: float) -> None:
+        """Takes (or, if negative, returns) `amount`, e.g. the difference between estimated and used tokens."""
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level - amount)
+
+    @property
+    def level(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._level
+
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase, multiplicative-decrease limit on calls in flight.
+    The limit grows by about one per round of successful calls, and is cut on congestion signals.
+    """
+
+    def __init__(
+        self, max_limit: int, initial_limit: int | None = None, min_limit: int = 1
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(
+            min(max_limit, initial_limit if initial_limit is not None else max_limit)
+        )
+        self.in_flight = 0
+        self._last_decrease = -math.inf
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline: float | None = None) -> None:
+        """Waits for a free slot, raising a TimeoutError if none is free by the (monotonic) deadline."""
+        with self._condition:
+            while self.in_flight >= max(self.min_limit, math.floor(self.limit)):
+                if remaining_s(deadline) == 0.0:
+                    raise TimeoutError(f"All {self.in_flight} slots are in use")
+                self._condition.wait(timeout=remaining_s(deadline))
+            self.in_flight += 1
+
+    def release(self) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_congestion(self, factor: float) -> bool:
+        """Cuts the limit by `factor`, once per cooldown. Returns True if the limit was cut."""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < DECREASE_COOLDOWN_S:
+                return False
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * factor)
+            return True
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Returns True for rate limits, connection errors and server errors, which are retried."""
+    return isinstance(
+        error,
+        openai.RateLimitError | openai.APIConnectionError | openai.InternalServerError,
+    )
+
+
+def unwrap_error(error: BaseException) -> BaseException:
+    """Returns the API error behind instructor's retry exception, if any."""
+    if isinstance(error, instructor_exceptions.InstructorRetryException) and (
+        error.args and isinstance(error.args[0], BaseException)
+    ):
+        return unwrap_error(error.args[0])
+    return error
+
+
+def retry_after_s(error: BaseException) -> float | None:
+    """Returns the delay requested by the response headers (`retry-after-ms` or `retry-after`), if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if (value := headers.get("retry-after-ms")) is not None:
+            return float(value) / 1000
+        if (value := headers.get("retry-after")) is not None:
+            try:
+                return float(value)
+            except ValueError:
+                # an HTTP date
+                retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+                return max(0.0, retry_at - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def backoff_s(attempt: int) -> float:
+    """Exponential backoff with full jitter, for the (0-based) attempt."""
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2**attempt))
+
+
+def estimate_tokens(
+    text: str, image: EncodedImage | None = None, detail: str = "auto"
+) -> int:
+    """
+    Estimates the tokens used by a request, to take from the tokens-per-minute bucket before it's sent.
+
+    :param text: Text of the request, e.g. the prompt and the JSON schema
+    :param image: Encoded image sent with the request
+    :param detail: Image detail level
+    """
+    tokens = len(text) // CHARS_PER_TOKEN
+    if image is not None:
+        tokens += IMAGE_BASE_TOKENS
+        if detail != "low":
+            width, height = provider_image_size(image.width, image.height, detail)
+            tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(
+                height / IMAGE_TILE_SIZE
+            )
+            tokens += IMAGE_TILE_TOKENS * tiles
+    return tokens
+
+
+class RequestScheduler(Loggable):
+    """Schedules the API calls to one backend, see the module docstring."""
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        target_latency_s: float | None = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        pause_on_rate_limit: bool = True,
+    ):
+        """
+        :param name: Name used as the metrics label
+        :param requests_per_minute: Requests per minute limit, or None for no limit
+        :param tokens_per_minute: Tokens per minute limit, or None for no limit
+        :param max_concurrency: Upper bound of the adaptive limit on calls in flight
+        :param target_latency_s: Cut the concurrency when a call takes longer than this, or None to only
+            react to 429s
+        :param max_retries: Retries of rate limited and transient errors, before the error is raised
+        :param pause_on_rate_limit: Hold back every call after a 429. Disabled for backends with several API
+            keys, where only the limited key cools down (see `api_keys`)
+        """
+        self.name = name
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.target_latency_s = target_latency_s
+        self.max_retries = max_retries
+        self.pause_on_rate_limit = pause_on_rate_limit
+        # latency of the successful calls, for hedging
+        self.latency = LatencyHistogram()
+
+        self._queued = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _update_gauges(self) -> None:
+        METRICS.set_gauge(
+            f"{METRICS_PREFIX}_queue_depth", self._queued, backend=self.name
+        )
+        METRICS.set_gauge(
+            f"{METRICS_PREFIX}_in_flight",
+            self.concurrency.in_flight,
+            backend=self.name,
+        )
+        METRICS.set_gauge(
+            f"{METRICS_PREFIX}_concurrency_limit",
+            math.floor(self.concurrency.limit),
+            backend=self.name,
+        )
+
+    def _wait_for_pause(self, deadline: float | None = None) -> None:
+        while (wait_s := self._paused_until - time.monotonic()) > 0:
+            if (left_s := remaining_s(deadline)) is not None and wait_s > left_s:
+                raise TimeoutError(f"Paused for another {wait_s:.2f} s")
+            time.sleep(wait_s)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every call to the backend for `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _acquire(self, deadline: float | None = None) -> None:
+        """
+        Waits until an attempt can be made. Raises a TimeoutError if it can't be made by the deadline, giving back
+        whatever was taken.
+        """
+        with self._lock:
+            self._queued += 1
+            self._update_gauges()
+        acquired = False
+        taken_request = False
+        try:
+            self._wait_for_pause(deadline)
+            self.concurrency.acquire(deadline)
+            acquired = True
+            if self.requests is not None:
+                self.requests.take(1, deadline)
+                taken_request = True
+            # a 429 may have paused the backend while waiting for the bucket
+            self._wait_for_pause(deadline)
+        except TimeoutError as e:
+            if acquired:
+                self._release()
+            if taken_request:
+                self.requests.adjust(-1)
+            self.log().error(
+                msg := f"Request to '{self.name}' can't be sent by its deadline: {e}"
+            )
+            raise TimeoutError(msg) from e
+        finally:
+            with self._lock:
+                self._queued -= 1
+                self._update_gauges()
+
+    def _release(self) -> None:
+        self.concurrency.release()
+        self._update_gauges()
+
+    def hedge_after_s(self, percentile: float) -> float | None:
+        """
+        Returns the percentile of the recent call latency, after which a call is hedged, or None until enough
+        calls were observed.
+        """
+        if self.latency.count() < MIN_HEDGE_SAMPLES:
+            return None
+        return max(MIN_HEDGE_DELAY_S, self.latency.percentile(percentile))
+
+    def can_hedge(self) -> bool:
+        """Returns True if a duplicate call would run at once, without queueing behind other calls."""
+        with self._lock:
+            queued = self._queued
+        return (
+            queued == 0
+            and self._paused_until <= time.monotonic()
+            and self.concurrency.in_flight < math.floor(self.concurrency.limit)
+        )
+
+    def run(
+        self,
+        fn: Callable[[], Any],
+        estimated_tokens: int = 0,
+        timings: RequestTimings | None = None,
+        deadline: float | None = None,
+        hedge_percentile: float | None = None,
+    ) -> Any:
+        """
+        Calls `fn` once the limits allow it, retrying rate limited and transient errors.
+
+        :param fn: The API call, which should end by the deadline, see `deadline_kwargs`
+        :param estimated_tokens: Tokens taken from the tokens-per-minute bucket, once for the call whatever its
+            retries and hedges, given back if it fails, see `settle_tokens`
+        :param timings: The time spent waiting is added to its "queue" stage
+        :param deadline: Monotonic time after which no call is started or retried, and a TimeoutError is raised,
+            including while waiting for the rate limits and concurrency
+        :param hedge_percentile: Send a duplicate of a call still running after this percentile of the recent
+            latency, returning the first answer, or None to never hedge
+        """
+        take_tokens = self.tokens is not None and estimated_tokens > 0
+        if take_tokens:
+            queue_start = time.perf_counter()
+            try:
+                self.tokens.take(estimated_tokens, deadline)
+            except TimeoutError as e:
+                self.log().error(
+                    msg
+                    := f"Request to '{self.name}' can't be sent by its deadline: {e}"
+                )
+                raise TimeoutError(msg) from e
+            if timings is not None:
+                timings.add("queue", time.perf_counter() - queue_start)
+
+        try:
+            if hedge_percentile and (
+                hedge_after_s := self.hedge_after_s(hedge_percentile)
+            ):
+                result, from_hedge = hedged_call(
+                    lambda call_timings: self._run(fn, call_timings, deadline),
+                    hedge_after_s,
+                    can_hedge=self.can_hedge,
+                    deadline=deadline,
+                    timings=timings,
+                )
+                if timings is not None and timings.hedged:
+                    METRICS.inc(f"{METRICS_PREFIX}_hedges_total", backend=self.name)
+                if from_hedge:
+                    METRICS.inc(f"{METRICS_PREFIX}_hedge_wins_total", backend=self.name)
+                return result
+            return self._run(fn, timings, deadline)
+        except BaseException:
+            if take_tokens:
+                # the failed call's tokens aren't known, they are given back
+                self.tokens.adjust(-estimated_tokens)
+            raise
+
+    def _run(
+        self,
+        fn: Callable[[], Any],
+        timings: RequestTimings | None,
+        deadline: float | None,
+    ) -> Any:
+        for attempt in range(self.max_retries + 1):
+            queue_start = time.perf_counter()
+            self._acquire(deadline)
+            if timings is not None:
+                timings.add("queue", time.perf_counter() - queue_start)
+            # an abandoned hedge gives its slot back at once
+            release = cancellable(self._release)
+            if remaining_s(deadline) == 0.0:
+                release()
+                self.log().error(
+                    msg
+                    := f"Request to '{self.name}' missed its deadline after {attempt} attempts"
+                )
+                raise TimeoutError(msg)
+
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                release()
+                # an abandoned hedge isn't retried
+                raise_if_cancelled()
+                error = unwrap_error(e)
+                if not is_retryable(error) or attempt == self.max_retries:
+                    raise
+                delay_s = retry_after_s(error)
+                if delay_s is None:
+                    delay_s = backoff_s(attempt)
+                if (left_s := remaining_s(deadline)) is not None and delay_s >= left_s:
+                    # the retry would start after the deadline
+                    raise
+
+                if isinstance(error, openai.RateLimitError):
+                    METRICS.inc(
+                        f"{METRICS_PREFIX}_rate_limited_total", backend=self.name
+                    )
+                    if self.pause_on_rate_limit:
+                        self.pause(delay_s)
+                        retry_text = f"retrying in {delay_s:.2f} s"
+                    else:
+                        # only the limited key cools down, the retry leases another one
+                        retry_text = "retrying with the next API key"
+                    if self.concurrency.on_congestion(RATE_LIMITED_DECREASE):
+                        self.log().warning(
+                            f"Rate limited by '{self.name}', {retry_text}, "
+                            f"concurrency limit now {math.floor(self.concurrency.limit)}"
+                        )
+                else:
+                    self.log().warning(
+                        f"Request to '{self.name}' failed ({error}), retrying in {delay_s:.2f} s"
+                    )
+                    time.sleep(delay_s)
+                METRICS.inc(f"{METRICS_PREFIX}_retries_total", backend=self.name)
+                continue
+
+            latency_s = time.perf_counter() - start
+            release()
+            self.latency.observe(latency_s)
+            if self.target_latency_s is not None and latency_s > self.target_latency_s:
+                self.concurrency.on_congestion(SLOW_DECREASE)
+            else:
+                self.concurrency.on_success()
+            return result
+
+        # unreachable, the last attempt either returns or raises
+        raise AssertionError("No attempts made")
+
+    def settle_tokens(self, estimated_tokens: int, used_tokens: int | None) -> None:
+        """Corrects the tokens-per-minute bucket with the tokens a call actually used."""
+        if self.tokens is not None and used_tokens:
+            self.tokens.adjust(used_tokens - estimated_tokens)
+
+
+_schedulers: dict[tuple, RequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(settings: BackendSettings, key_count: int = 1) -> RequestScheduler:
+    """
+    Returns the process-wide scheduler for the backend and model, created on first use.
+
+    :param settings: Backend settings, the rate limits are per API key
+    :param key_count: Number of API keys the calls are spread over, which multiplies the rate limits
+    """
+    key = (
+        key_count,
+        settings.name,
+        settings.base_url,
+        settings.model,
+        settings.requests_per_minute,
+        settings.tokens_per_minute,
+        settings.max_concurrency,
+        settings.target_latency_s,
+    )
+    with _schedulers_lock:
+        if (scheduler := _schedulers.get(key)) is None:
+            scheduler = RequestScheduler(
+                settings.name,
+                requests_per_minute=settings.requests_per_minute * key_count
+                if settings.requests_per_minute
+                else None,
+                tokens_per_minute=settings.tokens_per_minute * key_count
+                if settings.tokens_per_minute
+                else None,
+                max_concurrency=settings.max_concurrency,
+                target_latency_s=settings.target_latency_s,
+                pause_on_rate_limit=key_count == 1,
+            )
+            _schedulers[key] = scheduler
+        return scheduler
@@ -0,0 +1,88 @@
+"""
+Cached settings from the `.env` file.
+
+The file is parsed once and kept in memory. Each lookup only checks the file's modification time (a `stat`),
+and the file is parsed again when it has changed, so edits apply to the next run without restarting ComfyUI.
+Environment variables take precedence over the file.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+
+from dotenv import dotenv_values
+
+from . import DOTENV_FILE
+from .utils.loggable import Loggable
+
+
+class Settings(Loggable):
+    """Settings of one `.env` file, reloaded when the file changes. Safe to use from several threads."""
+
+    def __init__(self, dotenv_path: Path = DOTENV_FILE):
+        """
+        :param dotenv_path: Path to the `.env` file, which may not exist (yet)
+        """
+        self.dotenv_path = dotenv_path
+        self.loads: int = 0
+
+        self._values: dict[str, str] = {}
+        # (modification time, size) of the loaded file, None if it didn't exist
+        self._file_state: tuple[int, int] | None = None
+        self._checked = False
+        self._lock = threading.Lock()
+
+    def _current_file_state(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.dotenv_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _reload_if_changed(self) -> None:
+        file_state = self._current_file_state()
+        with self._lock:
+            if self._checked and file_state == self._file_state:
+                return
+
+            if file_state is None:
+                # logged once, not on every lookup
+                self.log().error(f"File '{self.dotenv_path}' does not exist")
+                self._values = {}
+            else:
+                self._values = {
+                    key: value
+                    for key, value in dotenv_values(self.dotenv_path).items()
+                    if value is not None
+                }
+                self.loads += 1
+                self.log().debug(
+                    f"Loaded {len(self._values)} settings from '{self.dotenv_path}'"
+                )
+            self._file_state = file_state
+            self._checked = True
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        """Returns the value of the environment variable, or of the `.env` file setting."""
+        if value := os.getenv(key):
+            return value
+        self._reload_if_changed()
+        return self._values.get(key) or default
+
+    def file_exists(self) -> bool:
+        self._reload_if_changed()
+        return self._file_state is not None
+
+
+_settings: dict[Path, Settings] = {}
+_settings_lock = threading.Lock()
+
+
+def get_settings(dotenv_path: Path = DOTENV_FILE) -> Settings:
+    """Returns the process-wide settings of the `.env` file, creating them on first use."""
+    with _settings_lock:
+        if (settings := _settings.get(dotenv_path)) is None:
+            settings = _settings[dotenv_path] = Settings(dotenv_path)
+        return settings
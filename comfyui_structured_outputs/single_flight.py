@@ -0,0 +1,103 @@
+"""
+Coalescing of identical in-flight requests.
+
+When several callers make the same request at the same time (several graph branches or queued prompts with the
+same prompt, schema and image), only the first makes the call, and the others wait for its result, up to their own
+deadline. The response cache can't do this, since nothing is cached until the first answer arrives.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any
+
+from .hedging import remaining_s
+from .utils.loggable import Loggable
+
+
+class SingleFlight(Loggable):
+    """Runs at most one call per key at a time, sharing its result (or error) with concurrent callers."""
+
+    def __init__(self):
+        self.leaders: int = 0
+        self.followers: int = 0
+
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self, key: str, fn: Callable[[], Any], deadline: float | None = None
+    ) -> tuple[Any, bool]:
+        """
+        Returns the result of `fn`, or of the call with the same key that is already in flight.
+        Errors are raised in every caller.
+
+        :param key: Fingerprint of the request
+        :param fn: Makes the request
+        :param deadline: Monotonic time after which a caller waiting for another caller's call raises a
+            TimeoutError, or None to wait for the call
+        :return: The result, and True if it was shared from another caller's call
+        """
+        with self._lock:
+            if (future := self._in_flight.get(key)) is not None:
+                self.followers += 1
+                is_leader = False
+            else:
+                future = self._in_flight[key] = Future()
+                self.leaders += 1
+                is_leader = True
+
+        if not is_leader:
+            self.log().debug("Waiting for in-flight request '%s'", key[:12])
+            try:
+                return future.result(timeout=remaining_s(deadline)), True
+            except FutureTimeoutError as e:
+                # only this caller gives up, the call goes on for the others
+                self.log().error(
+                    msg
+                    := f"In-flight request '{key[:12]}' didn't answer by the deadline"
+                )
+                raise TimeoutError(msg) from e
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            # later callers make a new call (or hit the response cache)
+            with self._lock:
+                del self._in_flight[key]
+
+    def in_flight(self) -> int:
+        """Returns the number of calls in flight."""
+        with self._lock:
+            return len(self._in_flight)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of calls made and shared."""
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "in_flight": len(self._in_flight),
+            }
+
+
+_request_coalescer: SingleFlight | None = None
+_request_coalescer_lock = threading.Lock()
+
+
+def get_request_coalescer() -> SingleFlight:
+    """Returns the process-wide coalescer of structured output requests, creating it on first use."""
+    global _request_coalescer
+    with _request_coalescer_lock:
+        if _request_coalescer is None:
+            _request_coalescer = SingleFlight()
+        return _request_coalescer
@@ -0,0 +1,162 @@
+"""
+Streaming of structured outputs, using instructor's partial response models.
+
+Attributes are generated in schema order, so an attribute is complete once the next attribute (or its own
+`error` field) has started. This gives the time to each attribute, and lets the stream be closed as soon as
+every attribute has validated, instead of waiting for the trailing tokens of the response.
+"""
+
+from __future__ import annotations
+
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any
+
+from pydantic import BaseModel, ValidationError, create_model
+
+from .attribute_utils import RETURN_MODEL_CACHE_SIZE, BaseAttributesModel
+from .utils.loggable import Loggable
+from .utils.utils import lazy_import
+
+if TYPE_CHECKING:
+    from instructor import Instructor
+    from instructor.dsl import partial as instructor_partial
+else:
+    instructor_partial = lazy_import("instructor.dsl.partial")
+
+
+@dataclass
+class StreamStats:
+    """Timings of a streamed structured output, in seconds since the request was made."""
+
+    first_chunk_s: float | None = None
+    first_attribute_s: float | None = None
+    total_s: float = 0.0
+    chunks: int = 0
+    stopped_early: bool = False
+    # attribute name -> time it completed
+    attribute_s: dict[str, float] = field(default_factory=dict)
+
+
+@lru_cache(maxsize=RETURN_MODEL_CACHE_SIZE)
+def streaming_model(
+    attributes_model: type[BaseAttributesModel],
+) -> type[BaseAttributesModel]:
+    """
+    Returns the response model to stream with.
+    Without `PartialLiteralMixin`, partial strings are parsed as they are generated, and a partial attribute
+    `key` (e.g. "col" for "color") fails its Literal validation.
+    """
+    return create_model(
+        attributes_model.__name__,
+        __base__=(attributes_model, instructor_partial.PartialLiteralMixin),
+    )
+
+
+def completed_attributes(partial: BaseModel, field_names: list[str]) -> list[str]:
+    """
+    Returns the names of the attributes in a partial response that are complete, in schema order.
+
+    :param partial: Partial response, as yielded by `create_partial`
+    :param field_names: Attribute names of the response model, in schema order
+    """
+    completed: list[str] = []
+    for index, name in enumerate(field_names):
+        attribute = getattr(partial, name, None)
+        # attributes that haven't started yet are empty dicts
+        if (
+            not isinstance(attribute, BaseModel)
+            or "value" not in attribute.model_fields_set
+        ):
+            continue
+
+        next_started = any(
+            later in partial.model_fields_set for later in field_names[index + 1 :]
+        )
+        if next_started or "error" in attribute.model_fields_set:
+            completed.append(name)
+    return completed
+
+
+def stream_structured_output(
+    instructor_client: Instructor,
+    attributes_model: type[BaseAttributesModel],
+    messages: list[dict],
+    model: str,
+    on_attribute: Callable[[str, Any, float], None] | None = None,
+    stop_early: bool = True,
+    **kwargs,
+) -> tuple[BaseAttributesModel, StreamStats]:
+    """
+    Streams a structured output, returning the validated response and the stream timings.
+
+    :param instructor_client: Client to make the request with
+    :param attributes_model: Response model
+    :param messages: Chat messages
+    :param model: Model name
+    :param on_attribute: Called with (name, value, seconds since start) as each attribute completes
+    :param stop_early: Close the stream as soon as every attribute has validated
+    :param kwargs: Passed on to `create_partial`
+    """
+    stats = StreamStats()
+    field_names: list[str] = list(attributes_model.model_fields)
+    completed: set[str] = set()
+    partial: BaseModel | None = None
+    response: BaseAttributesModel | None = None
+
+    start = time.perf_counter()
+    stream = instructor_client.chat.completions.create_partial(
+        model=model,
+        response_model=streaming_model(attributes_model),
+        messages=messages,
+        **kwargs,
+    )
+    try:
+        for partial in stream:
+            elapsed = time.perf_counter() - start
+            stats.chunks += 1
+            if stats.first_chunk_s is None:
+                stats.first_chunk_s = elapsed
+
+            for name in completed_attributes(partial, field_names):
+                if name in completed:
+                    continue
+                completed.add(name)
+                stats.attribute_s[name] = elapsed
+                if stats.first_attribute_s is None:
+                    stats.first_attribute_s = elapsed
+                if on_attribute is not None:
+                    on_attribute(name, getattr(partial, name).value, elapsed)
+
+            if stop_early and len(completed) == len(field_names):
+                try:
+                    response = attributes_model.model_validate(partial.model_dump())
+                except ValidationError:
+                    continue
+                stats.stopped_early = True
+                break
+    finally:
+        # stops reading the rest of the response when stopping early
+        if hasattr(stream, "close"):
+            stream.close()
+
+    if partial is None:
+        Loggable.log().error(msg := "Stream ended without a response")
+        raise ValueError(msg)
+
+    if response is None:
+        response = attributes_model.model_validate(partial.model_dump())
+
+    stats.total_s = time.perf_counter() - start
+    # the last attribute(s) only complete when the stream ends
+    for name in field_names:
+        if name not in completed:
+            stats.attribute_s[name] = stats.total_s
+            if on_attribute is not None:
+                on_attribute(name, getattr(response, name).value, stats.total_s)
+    if stats.first_attribute_s is None and field_names:
+        stats.first_attribute_s = stats.total_s
+
+    return response, stats
@@ -0,0 +1,334 @@
+"""
+In-process stand-in for an OpenAI-compatible chat completions server.
+
+The stub answers requests through an `httpx.MockTransport`, so the full client stack (openai, instructor, the
+nodes) can be exercised offline. Responses are placeholder instances of the requested JSON schema, returned as
+a tool call or as message content depending on the request, and streamed if requested. Batch API jobs are
+answered by the same stub, so batch mode can be tested offline as well.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+import uuid
+from typing import TYPE_CHECKING, Any
+
+from .utils.loggable import Loggable
+from .utils.utils import lazy_import
+
+if TYPE_CHECKING:
+    import httpx
+else:
+    httpx = lazy_import("httpx")
+
+STUB_BASE_URL: str = "http://stub.local/v1"
+STUB_MODEL: str = "stub"
+# number of characters of the response per streamed chunk
+STUB_STREAM_CHUNK_SIZE: int = 8
+
+
+def placeholder_for_schema(schema: dict, defs: dict | None = None) -> Any:
+    """
+    Returns a placeholder value that validates against the JSON schema.
+    Prefers constants, defaults, enum values and examples over generic values.
+
+    :param schema: JSON schema, or a sub-schema
+    :param defs: The `$defs` of the root schema, used to resolve references
+    """
+    defs = defs if defs is not None else schema.get("$defs", {})
+
+    if "$ref" in schema:
+        return placeholder_for_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    if "const" in schema:
+        return schema["const"]
+    if "default" in schema:
+        return schema["default"]
+    if schema.get("enum"):
+        return schema["enum"][0]
+    if "anyOf" in schema:
+        return placeholder_for_schema(schema["anyOf"][0], defs)
+
+    schema_type = schema.get("type")
+    examples = [example for example in schema.get("examples", []) if example]
+    if schema_type == "object":
+        return {
+            name: placeholder_for_schema(property_schema, defs)
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        item_schema = schema.get("items", {})
+        return [
+            placeholder_for_schema(item_schema, defs)
+            for _ in range(schema.get("minItems", 1))
+        ]
+    if schema_type == "string":
+        return examples[0] if examples and isinstance(examples[0], str) else "stub"
+    if schema_type == "integer":
+        return 0
+    if schema_type == "number":
+        return 0.0
+    if schema_type == "boolean":
+        return False
+    return None
+
+
+def _request_schema(body: dict) -> dict:
+    # tool calls carry the schema as the function parameters
+    if tools := body.get("tools"):
+        return tools[0]["function"]["parameters"]
+    if schema := (body.get("response_format") or {}).get("schema"):
+        return schema
+    # JSON mode puts the schema in the system message
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content)
+        if (
+            message.get("role") == "system"
+            and isinstance(content, str)
+            and "json_schema:" in content
+        ):
+            schema_text = content[content.index("json_schema:") :]
+            schema, _ = json.JSONDecoder().raw_decode(
+                schema_text[schema_text.index("{") :]
+            )
+            return schema
+    return {"type": "object", "properties": {}}
+
+
+class StubChatCompletions(Loggable):
+    """Handles `POST /chat/completions` requests, as an `httpx.MockTransport` handler."""
+
+    def __init__(self, latency_s: float = 0.0):
+        """
+        :param latency_s: Seconds to wait before answering, to simulate a real server
+        """
+        self.latency_s = latency_s
+        self.requests: list[dict] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if not request.url.path.endswith("/chat/completions"):
+            return httpx.Response(404, json={"error": {"message": "Not found"}})
+
+        body: dict = json.loads(request.content)
+        self.requests.append(body)
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+        arguments: str = json.dumps(placeholder_for_schema(_request_schema(body)))
+        use_tools: bool = bool(body.get("tools"))
+        tool_name: str = body["tools"][0]["function"]["name"] if use_tools else ""
+        model: str = body.get("model", STUB_MODEL)
+
+        if body.get("stream"):
+            chunks = [
+                arguments[start : start + STUB_STREAM_CHUNK_SIZE]
+                for start in range(0, len(arguments), STUB_STREAM_CHUNK_SIZE)
+            ]
+            events = [
+                self._chunk(
+                    model, self._delta(chunk, tool_name, use_tools, first=index == 0)
+                )
+                for index, chunk in enumerate(chunks)
+            ]
+            events.append(self._chunk(model, {}, finish_reason="stop"))
+            content = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+            return httpx.Response(
+                200,
+                content=(content + "data: [DONE]\n\n").encode(),
+                headers={"content-type": "text/event-stream"},
+            )
+
+        message: dict = {"role": "assistant", "content": None}
+        if use_tools:
+            message["tool_calls"] = [self._tool_call(tool_name, arguments)]
+        else:
+            message["content"] = arguments
+        return httpx.Response(
+            200,
+            json={
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "tool_calls" if use_tools else "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(request.content) // 4,
+                    "completion_tokens": len(arguments) // 4,
+                    "total_tokens": (len(request.content) + len(arguments)) // 4,
+                },
+            },
+        )
+
+    @staticmethod
+    def _tool_call(name: str, arguments: str) -> dict:
+        return {
+            "id": f"call_{uuid.uuid4().hex}",
+            "type": "function",
+            "function": {"name": name, "arguments": arguments},
+        }
+
+    @classmethod
+    def _delta(cls, text: str, tool_name: str, use_tools: bool, first: bool) -> dict:
+        if not use_tools:
+            return {"content": text}
+
+        tool_call: dict = {"index": 0, "function": {"arguments": text}}
+        if first:
+            tool_call = {**cls._tool_call(tool_name, text), "index": 0}
+        return {"tool_calls": [tool_call]}
+
+    @staticmethod
+    def _chunk(model: str, delta: dict, finish_reason: str | None = None) -> dict:
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+
+class StubBatchApi(Loggable):
+    """
+    Handles the Files and Batches endpoints, as an `httpx.MockTransport` handler. A batch completes after it has
+    been retrieved `polls_to_complete` times, each line answered by the chat completions stub. Other requests go
+    to the chat completions stub.
+    """
+
+    def __init__(
+        self, chat: StubChatCompletions | None = None, polls_to_complete: int = 1
+    ):
+        """
+        :param chat: Answers the chat completion requests, and the lines of each batch
+        :param polls_to_complete: Number of times a batch is retrieved before it completes
+        """
+        self.chat = chat or StubChatCompletions()
+        self.polls_to_complete = polls_to_complete
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self._polls: dict[str, int] = {}
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+        if path == "/files" and request.method == "POST":
+            return self._upload(request)
+        if path.startswith("/files/") and path.endswith("/content"):
+            if (content := self.files.get(path.split("/")[2])) is None:
+                return httpx.Response(404, json={"error": {"message": "Not found"}})
+            return httpx.Response(200, content=content)
+        if path == "/batches" and request.method == "POST":
+            return self._create_batch(json.loads(request.content))
+        if path.startswith("/batches/"):
+            if (batch := self.batches.get(path.split("/")[2])) is None:
+                return httpx.Response(404, json={"error": {"message": "Not found"}})
+            return httpx.Response(200, json=self._poll(batch))
+        return self.chat(request)
+
+    def _upload(self, request: httpx.Request) -> httpx.Response:
+        # the file is the part of the multipart body with a filename
+        boundary = request.headers["content-type"].split("boundary=")[1].encode()
+        content = b""
+        for part in request.content.split(b"--" + boundary):
+            headers, _, body = part.partition(b"\r\n\r\n")
+            if b"filename=" in headers:
+                content = body.removesuffix(b"\r\n")
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = content
+        return httpx.Response(200, json=self._file(file_id, content))
+
+    @staticmethod
+    def _file(file_id: str, content: bytes) -> dict:
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        }
+
+    def _create_batch(self, body: dict) -> httpx.Response:
+        if body["input_file_id"] not in self.files:
+            return httpx.Response(404, json={"error": {"message": "File not found"}})
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "validating",
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata"),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self._polls[batch_id] = 0
+        return httpx.Response(200, json=self.batches[batch_id])
+
+    def _poll(self, batch: dict) -> dict:
+        self._polls[batch["id"]] += 1
+        # e.g. a batch failed by a test stays failed
+        if batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+            if self._polls[batch["id"]] < self.polls_to_complete:
+                batch["status"] = "in_progress"
+            else:
+                self._complete(batch)
+        return batch
+
+    def _complete(self, batch: dict) -> None:
+        lines = self.files[batch["input_file_id"]].decode().splitlines()
+        output: list[str] = []
+        for line in filter(None, lines):
+            item = json.loads(line)
+            response = self.chat(
+                httpx.Request(
+                    item["method"],
+                    f"{STUB_BASE_URL}/chat/completions",
+                    json=item["body"],
+                )
+            )
+            output.append(
+                json.dumps(
+                    {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": item["custom_id"],
+                        "response": {
+                            "status_code": response.status_code,
+                            "body": response.json(),
+                        },
+                        "error": None,
+                    }
+                )
+            )
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        self.files[output_file_id] = ("\n".join(output) + "\n").encode()
+        batch["status"] = "completed"
+        batch["output_file_id"] = output_file_id
+        batch["request_counts"] = {
+            "total": len(output),
+            "completed": len(output),
+            "failed": 0,
+        }
+
+
+def stub_http_client(
+    handler: StubChatCompletions | StubBatchApi | None = None,
+) -> httpx.Client:
+    """
+    Returns an HTTP client whose requests are answered by the stub, without any network access.
+    Files and Batches requests are answered too, with the lines of a batch answered by the chat completions stub.
+    """
+    if not isinstance(handler, StubBatchApi):
+        handler = StubBatchApi(handler)
+    return httpx.Client(transport=httpx.MockTransport(handler))
@@ -0,0 +1,133 @@
+"""
+Compiled format templates, to build text from structured outputs.
+
+Templates use `str.format` syntax, with attribute names as placeholders, e.g. "A photo of {subject} at {time}".
+A template is parsed once and cached. Its placeholders are checked against the attributes up front, and
+rendering reads only the referenced attribute values, so rendering a batch of results costs microseconds each.
+"""
+
+from __future__ import annotations
+
+import string
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any
+
+from pydantic import BaseModel
+
+from .utils.loggable import Loggable
+
+TEMPLATE_CACHE_SIZE: int = 256
+
+_FORMATTER = string.Formatter()
+
+
+class CompiledTemplate:
+    """A parsed format template, rendered from attribute results."""
+
+    def __init__(self, format_text: str):
+        """
+        :param format_text: Template in `str.format` syntax, with attribute names as placeholders
+        """
+        self.format_text = format_text
+        # literal text, then the placeholder (if any) that follows it
+        self._parts: list[tuple[str, Callable[[dict[str, Any]], str] | None]] = []
+        self.field_names: frozenset[str] = frozenset()
+
+        names: set[str] = set()
+        try:
+            parsed = list(_FORMATTER.parse(format_text))
+        except ValueError as e:
+            Loggable.log().error(msg := f"Invalid format text '{format_text}': {e}")
+            raise ValueError(msg) from e
+
+        for literal, field_name, format_spec, conversion in parsed:
+            if field_name is None:
+                self._parts.append((literal, None))
+                continue
+
+            names.add(self._attribute_name(field_name))
+            # placeholders nested in the format spec, e.g. the width of "{subject:>{count}}"
+            if format_spec and "{" in format_spec:
+                names.update(
+                    self._attribute_name(nested_name)
+                    for _, nested_name, _, _ in _FORMATTER.parse(format_spec)
+                    if nested_name is not None
+                )
+            self._parts.append(
+                (literal, self._field_renderer(field_name, format_spec, conversion))
+            )
+        self.field_names = frozenset(names)
+
+    @staticmethod
+    def _attribute_name(field_name: str) -> str:
+        # attribute name, before any `.attr` or `[key]` access
+        name = field_name.split(".", 1)[0].split("[", 1)[0]
+        if not name or name.isdigit():
+            Loggable.log().error(
+                msg
+                := f"Invalid placeholder '{{{field_name}}}' in format text, use an attribute name"
+            )
+            raise ValueError(msg)
+        return name
+
+    @staticmethod
+    def _field_renderer(
+        field_name: str, format_spec: str | None, conversion: str | None
+    ) -> Callable[[dict[str, Any]], str]:
+        if format_spec and "{" in format_spec:
+            # nested placeholders in the format spec are resolved by the standard formatter
+            template = f"{{{field_name}{'!' + conversion if conversion else ''}:{format_spec}}}"
+            return lambda values: template.format_map(values)
+
+        if field_name.isidentifier() and not conversion:
+            # the common case, a plain `{name}` or `{name:spec}`
+            return lambda values: format(values[field_name], format_spec or "")
+
+        def render(values: dict[str, Any]) -> str:
+            value, _ = _FORMATTER.get_field(field_name, (), values)
+            if conversion:
+                value = _FORMATTER.convert_field(value, conversion)
+            return format(value, format_spec or "")
+
+        return render
+
+    def validate(self, attributes_model: type[BaseModel]) -> None:
+        """Raises a ValueError if a placeholder isn't an attribute of the model."""
+        if missing := sorted(self.field_names - set(attributes_model.model_fields)):
+            Loggable.log().error(
+                msg
+                := f"Format text placeholders {missing} are not attributes, expected any of "
+                f"{list(attributes_model.model_fields)}"
+            )
+            raise ValueError(msg)
+
+    def render(self, attributes: BaseModel) -> str:
+        """Renders the template with the values of the attributes."""
+        values = {name: getattr(attributes, name).value for name in self.field_names}
+        return "".join(
+            [
+                literal + render(values) if render is not None else literal
+                for literal, render in self._parts
+            ]
+        )
+
+    def render_batch(self, attributes_list: list[BaseModel]) -> list[str]:
+        """Renders the template once per attribute result, validating each result type only once."""
+        for model in {type(attributes) for attributes in attributes_list}:
+            validate_template(self, model)
+        return [self.render(attributes) for attributes in attributes_list]
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(format_text: str) -> CompiledTemplate:
+    """Returns the compiled template, parsing it only once."""
+    return CompiledTemplate(format_text)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def validate_template(
+    template: CompiledTemplate, attributes_model: type[BaseModel]
+) -> None:
+    """Checks the template against the attributes model, once per template and model."""
+    template.validate(attributes_model)
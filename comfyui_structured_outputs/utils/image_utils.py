@@ -1,9 +1,282 @@
+from __future__ import annotations
+
 import base64
+import hashlib
+import math
+import struct
+import time
+import zlib
 from io import BytesIO
+from typing import TYPE_CHECKING, NamedTuple
+
+from .utils import lazy_import, map_concurrently
+
+if TYPE_CHECKING:
+    import numpy as np
+    import torch
+    from PIL import Image
+else:
+    # imported on first use, see `lazy_import`
+    np = lazy_import("numpy")
+    torch = lazy_import("torch")
+    Image = lazy_import("PIL.Image")
+
+IMAGE_FORMATS: tuple[str, ...] = ("PNG", "JPEG", "WEBP")
+IMAGE_MIME_TYPES: dict[str, str] = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+IMAGE_DETAILS: tuple[str, ...] = ("auto", "high", "low")
+
+# OpenAI vision image tiling, larger images are downscaled by the provider anyway
+# see https://platform.openai.com/docs/guides/vision#calculating-costs
+HIGH_DETAIL_MAX_SIDE: int = 2048
+HIGH_DETAIL_MAX_SHORT_SIDE: int = 768
+LOW_DETAIL_MAX_SIDE: int = 512
+
+
+class EncodedImage(NamedTuple):
+    """A base64-encoded image, with the stats of the encoding."""
+
+    data: str
+    mime_type: str
+    width: int
+    height: int
+    encode_s: float
+
+    @property
+    def size_bytes(self) -> int:
+        """Size of the base64 payload in bytes."""
+        return len(self.data)
+
+    @property
+    def data_url(self) -> str:
+        """The image as a data URL, as expected by the chat completions API."""
+        return f"data:{self.mime_type};base64,{self.data}"
+
+
+# float -> uint8 conversion is done in chunks of at most this many values, bounding the float scratch memory
+CONVERSION_CHUNK_VALUES: int = 1 << 22
+
+# PIL modes whose memory layout matches a uint8 [H, W, C] array, so the buffer can be shared without a copy
+SHARED_BUFFER_MODES: dict[int, str] = {1: "L", 4: "RGBA"}
+
+
+def tensor_to_uint8(
+    image_tensor: torch.Tensor, out: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Converts a whole torch.Tensor image batch of shape [B, H, W, C] to a uint8 numpy array.
+    uint8 CPU tensors are returned as a view without copying. Float tensors (values in [0,1]) are scaled,
+    clipped and cast in fixed-size chunks, so no full-size float temporaries are created. Other integer
+    tensors are taken as values in [0,255] and clipped. Tensors on other devices are converted there, so only
+    uint8 data is transferred.
+
+    Args:
+        image_tensor (torch.Tensor): Image tensor with shape [B, H, W, C].
+        out (np.ndarray | None): Optional preallocated uint8 array with the same shape to write into.
+
+    Returns:
+        np.ndarray: The uint8 image array with shape [B, H, W, C].
+
+    Raises:
+        TypeError: If the tensor is boolean or complex.
+    """
+    if image_tensor.ndim != 4:
+        raise ValueError("Expected image tensor with 4 dimensions [B, H, W, C]")
+    if out is not None and (
+        out.dtype != np.uint8 or out.shape != tuple(image_tensor.shape)
+    ):
+        raise ValueError(
+            f"Expected out array of dtype uint8 and shape {tuple(image_tensor.shape)}, "
+            f"got {out.dtype} and {out.shape}"
+        )
+
+    if image_tensor.dtype == torch.bool or image_tensor.is_complex():
+        raise TypeError(f"Unsupported image tensor dtype {image_tensor.dtype}")
+
+    image_tensor = image_tensor.detach()
+    if image_tensor.dtype == torch.uint8:
+        # used as is
+        array = image_tensor.cpu().numpy()
+    elif not image_tensor.is_floating_point():
+        # clipped, casting alone would wrap out of range values around
+        array = image_tensor.clamp(0, 255).to(torch.uint8).cpu().numpy()
+    elif image_tensor.device.type != "cpu" or image_tensor.dtype == torch.bfloat16:
+        # convert on the device, so only a quarter of the data is copied back
+        array = image_tensor.mul(255).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+    else:
+        return _float_array_to_uint8(image_tensor.numpy(), out)
+
+    if out is None:
+        return array
+    np.copyto(out, array, casting="unsafe")
+    return out
+
+
+def _float_array_to_uint8(array: np.ndarray, out: np.ndarray | None) -> np.ndarray:
+    if out is None:
+        out = np.empty(array.shape, dtype=np.uint8)
+
+    batch_size, height, width, channels = array.shape
+    rows_per_chunk = max(1, CONVERSION_CHUNK_VALUES // max(1, width * channels))
+    # at least float32, so float16 images don't lose precision while scaling
+    scratch_dtype = np.result_type(array.dtype, np.float32)
+    scratch = np.empty(
+        (min(rows_per_chunk, height), width, channels), dtype=scratch_dtype
+    )
+    for index in range(batch_size):
+        for row in range(0, height, rows_per_chunk):
+            chunk = array[index, row : row + rows_per_chunk]
+            buffer = scratch[: len(chunk)]
+            np.multiply(chunk, 255, out=buffer, dtype=scratch_dtype)
+            np.clip(buffer, 0, 255, out=buffer)
+            # truncates like astype(np.uint8)
+            np.copyto(out[index, row : row + rows_per_chunk], buffer, casting="unsafe")
+    return out
+
+
+# the buffer is hashed in blocks, split into lanes that each get their own CRC, for a 128-bit fingerprint
+FINGERPRINT_BLOCK_BYTES: int = 1 << 16
+FINGERPRINT_LANES: int = 4
+# zlib releases the GIL while hashing, so the lanes of a larger buffer are hashed on several threads
+FINGERPRINT_PARALLEL_BYTES: int = 1 << 24
+
+
+def _crc32_blocks(blocks: np.ndarray) -> int:
+    crc = 0
+    for block in blocks:
+        crc = zlib.crc32(block, crc)
+    return crc
+
+
+def tensor_fingerprint(image_tensor: torch.Tensor, sample_stride: int = 1) -> str:
+    """
+    Returns a fingerprint of a tensor's content, shape and dtype, for cache keys.
+    The raw buffer is hashed in place with CRC32 (non-cryptographic, over 1 GB/s per thread), so a contiguous CPU
+    tensor is never copied. Other tensors are made contiguous first, on their device, and only the hashed blocks
+    are transferred to the CPU.
+
+    Args:
+        image_tensor (torch.Tensor): The tensor to fingerprint, usually an image batch [B, H, W, C].
+        sample_stride (int): Hash one block out of every `sample_stride`, 1 hashes the whole buffer. Sampling
+            is faster on large tensors, but misses changes that fall between the sampled blocks.
+
+    Returns:
+        str: The fingerprint, as 32 hex characters.
+    """
+    if sample_stride < 1:
+        raise ValueError(f"sample_stride must be at least 1, got {sample_stride}")
+
+    tensor = image_tensor.detach().contiguous()
+    # a flat byte view of the same buffer, e.g. bfloat16 has no numpy dtype
+    flat = tensor.reshape(-1).view(torch.uint8)
+    block_count = len(flat) // FINGERPRINT_BLOCK_BYTES
+    blocks = flat[: block_count * FINGERPRINT_BLOCK_BYTES].view(
+        block_count, FINGERPRINT_BLOCK_BYTES
+    )[::sample_stride]
+    tail = flat[block_count * FINGERPRINT_BLOCK_BYTES :]
+    if tensor.device.type != "cpu":
+        blocks, tail = blocks.cpu(), tail.cpu()
+
+    lanes = np.array_split(blocks.numpy(), FINGERPRINT_LANES)
+    parallel = blocks.numel() >= FINGERPRINT_PARALLEL_BYTES
+    crcs = map_concurrently(
+        _crc32_blocks, lanes, max_concurrency=FINGERPRINT_LANES if parallel else 1
+    )
+    crcs.append(zlib.crc32(tail.numpy()))
+
+    header = f"{tuple(tensor.shape)}|{tensor.dtype}|{sample_stride}".encode()
+    return hashlib.blake2b(
+        header + struct.pack(f"<{len(crcs)}I", *crcs), digest_size=16
+    ).hexdigest()
+
+
+# the difference hash compares neighbouring pixels of a (size + 1) x size grayscale thumbnail, size^2 bits
+PERCEPTUAL_HASH_SIZE: int = 8
+PERCEPTUAL_HASH_BITS: int = PERCEPTUAL_HASH_SIZE**2
+# larger images are sampled on a grid with about this many pixels along the short side before averaging,
+# plenty for an 8x9 thumbnail
+PERCEPTUAL_HASH_SAMPLES: int = 256
+# ITU-R BT.601 luma
+LUMA_WEIGHTS: tuple[float, float, float] = (0.299, 0.587, 0.114)
+
+
+def perceptual_hash(image_tensor: torch.Tensor) -> int:
+    """
+    Returns the difference hash (dHash) of an image tensor of shape [B, H, W, C], as a 64-bit integer.
+    The image is sampled on a grid, then averaged down to a 9x8 grayscale thumbnail on its device, and each bit
+    tells if a pixel is brighter than its right neighbour. Near-duplicates (re-encodes, slight crops or edits, re-renders with
+    another seed) differ in a few bits, see `hamming_distance`. If batch size > 1, the first image is used.
+
+    Args:
+        image_tensor (torch.Tensor): Image tensor with shape [B, H, W, C].
+
+    Returns:
+        int: The hash, with PERCEPTUAL_HASH_BITS bits.
+    """
+    if image_tensor.ndim != 4:
+        raise ValueError("Expected image tensor with 4 dimensions [B, H, W, C]")
+
+    image = image_tensor[0].detach()
+    step = max(1, min(image.shape[:2]) // PERCEPTUAL_HASH_SAMPLES)
+    image = image[::step, ::step]
+    if not image.is_floating_point():
+        image = image.float()
+    if image.shape[-1] >= 3:
+        weights = torch.tensor(LUMA_WEIGHTS, dtype=image.dtype, device=image.device)
+        gray = image[..., :3] @ weights
+    else:
+        gray = image[..., 0]
+
+    thumbnail = torch.nn.functional.adaptive_avg_pool2d(
+        gray[None, None].float(), (PERCEPTUAL_HASH_SIZE, PERCEPTUAL_HASH_SIZE + 1)
+    )[0, 0]
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten().tolist()
+    return sum(1 << index for index, bit in enumerate(bits) if bit)
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    """Returns the number of bits that differ between two hashes."""
+    return (hash_a ^ hash_b).bit_count()
+
+
+def uint8_to_pil_image(array: np.ndarray) -> Image.Image:
+    """
+    Converts a uint8 numpy image of shape [H, W, C] to a PIL Image.
+    Single channel and RGBA images share the array's buffer instead of copying it, the array must then
+    not be modified while the image is in use.
+
+    Args:
+        array (np.ndarray): The uint8 image array with shape [H, W, C].
+
+    Returns:
+        PIL.Image.Image: The converted image.
+    """
+    height, width, channels = array.shape
+    if channels in SHARED_BUFFER_MODES and array.flags.c_contiguous:
+        mode = SHARED_BUFFER_MODES[channels]
+        return Image.frombuffer(mode, (width, height), array, "raw", mode, 0, 1)
+
+    # If the image has a single channel with shape (H, W, 1), squeeze it to (H, W)
+    if channels == 1:
+        array = array.squeeze(-1)
+    return Image.fromarray(array)
+
+
+def tensor_to_pil_images(image_tensor: torch.Tensor) -> list[Image.Image]:
+    """
+    Converts a torch.Tensor image batch of shape [B, H, W, C] to a list of PIL Images.
 
-import numpy as np
-import torch
-from PIL import Image
+    Args:
+        image_tensor (torch.Tensor): Image tensor with shape [B, H, W, C].
+
+    Returns:
+        list[PIL.Image.Image]: The converted images, in batch order.
+    """
+    batch = tensor_to_uint8(image_tensor)
+    return [uint8_to_pil_image(image) for image in batch]
 
 
 def tensor_to_pil_image(image_tensor: torch.Tensor) -> Image.Image:
@@ -20,33 +293,97 @@ def tensor_to_pil_image(image_tensor: torch.Tensor) -> Image.Image:
     if image_tensor.ndim != 4:
         raise ValueError("Expected image tensor with 4 dimensions [B, H, W, C]")
 
-    # Use the first image in the batch.
-    img = image_tensor[0].detach().cpu().numpy()
+    # Use the first image in the batch, only that image is converted.
+    return uint8_to_pil_image(tensor_to_uint8(image_tensor[:1])[0])
 
-    # If the image has a single channel with shape (H, W, 1), squeeze it to (H, W)
-    if img.shape[-1] == 1:
-        img = img.squeeze(-1)
 
-    # If the image is a float type, assume the values are in [0,1] and convert them to [0,255]
-    if np.issubdtype(img.dtype, np.floating):
-        img = (img * 255).clip(0, 255).astype(np.uint8)
+def provider_image_size(
+    width: int, height: int, detail: str = "auto"
+) -> tuple[int, int]:
+    """
+    Returns the size the provider would scale the image to for the given detail level.
+    Images are never upscaled.
+
+    Args:
+        width (int): The image width.
+        height (int): The image height.
+        detail (str): The detail level, one of 'auto', 'high' or 'low' (default 'auto').
+
+    Returns:
+        tuple[int, int]: The scaled (width, height).
+    """
+    if detail not in IMAGE_DETAILS:
+        raise ValueError(f"Invalid detail: '{detail}' is not in '{IMAGE_DETAILS}'")
+
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_MAX_SIDE / max(width, height))
+    else:
+        # fit within a square, then fit the shortest side
+        scale = min(
+            1.0,
+            HIGH_DETAIL_MAX_SIDE / max(width, height),
+            HIGH_DETAIL_MAX_SHORT_SIDE / min(width, height),
+        )
 
-    return Image.fromarray(img)
+    return max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
 
 
-def pil_image_to_base64(pil_img: Image.Image, image_format: str = "PNG") -> str:
+def resize_image(
+    pil_img: Image.Image, max_side: int | None = None, detail: str | None = None
+) -> Image.Image:
+    """
+    Downscales a PIL Image to fit the provider's image tiling, and optionally a maximum side length.
+    The aspect ratio is preserved, and the image is returned unchanged if it already fits.
+
+    Args:
+        pil_img (PIL.Image.Image): The image to resize.
+        max_side (int | None): The maximum length of the longest side, or None for no limit.
+        detail (str | None): The detail level to fit, or None to skip fitting to the provider's tiling.
+
+    Returns:
+        PIL.Image.Image: The resized image.
+    """
+    width, height = pil_img.size
+    if detail is not None:
+        width, height = provider_image_size(width, height, detail)
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        width, height = (
+            max(1, math.floor(width * scale)),
+            max(1, math.floor(height * scale)),
+        )
+
+    if (width, height) == pil_img.size:
+        return pil_img
+
+    # reducing_gap first shrinks by an integer factor, which is much faster for large downscales
+    return pil_img.resize((width, height), Image.Resampling.BICUBIC, reducing_gap=3.0)
+
+
+def pil_image_to_base64(
+    pil_img: Image.Image, image_format: str = "PNG", quality: int | None = None
+) -> str:
     """
     Converts a PIL Image to a base64-encoded string.
 
     Args:
         pil_img (PIL.Image.Image): The image to convert.
         image_format (str): The format to use when saving the image (default 'PNG').
+        quality (int | None): The quality for lossy formats (JPEG, WEBP), or None for the PIL default.
 
     Returns:
         str: The base64-encoded string of the image.
     """
+    image_format = image_format.upper()
+    save_kwargs = {}
+    if image_format in ("JPEG", "WEBP") and quality is not None:
+        save_kwargs["quality"] = quality
+    if image_format == "JPEG" and pil_img.mode not in ("RGB", "L"):
+        # JPEG has no alpha channel
+        pil_img = pil_img.convert("RGB")
+
     buffered = BytesIO()
-    pil_img.save(buffered, format=image_format)
+    pil_img.save(buffered, format=image_format, **save_kwargs)
     img_bytes = buffered.getvalue()
     base64_str = base64.b64encode(img_bytes).decode("utf-8")
     return base64_str
@@ -67,6 +404,48 @@ def tensor_to_base64(image_tensor: torch.Tensor, image_format: str = "PNG") -> s
     return pil_image_to_base64(pil_img, image_format)
 
 
+def encode_image(
+    image_tensor: torch.Tensor,
+    image_format: str = "PNG",
+    quality: int | None = None,
+    max_side: int | None = None,
+    detail: str | None = None,
+) -> EncodedImage:
+    """
+    Encodes a torch.Tensor image of shape [B, H, W, C] for a VLM request.
+    The image is first downscaled to what the provider would use, since sending more pixels only costs
+    encode time and bandwidth. If batch size > 1, the first image in the batch is used.
+
+    Args:
+        image_tensor (torch.Tensor): The image tensor to encode.
+        image_format (str): The image format, one of 'PNG', 'JPEG' or 'WEBP' (default 'PNG').
+        quality (int | None): The quality for lossy formats (JPEG, WEBP), or None for the PIL default.
+        max_side (int | None): The maximum length of the longest side, or None for no limit.
+        detail (str | None): The detail level to fit, or None to skip fitting to the provider's tiling.
+
+    Returns:
+        EncodedImage: The base64-encoded image, with its MIME type, size and encode time.
+    """
+    image_format = image_format.upper()
+    if image_format not in IMAGE_MIME_TYPES:
+        raise ValueError(
+            f"Invalid image format: '{image_format}' is not in '{IMAGE_FORMATS}'"
+        )
+
+    start = time.perf_counter()
+    pil_img = resize_image(
+        tensor_to_pil_image(image_tensor), max_side=max_side, detail=detail
+    )
+    data = pil_image_to_base64(pil_img, image_format, quality=quality)
+    return EncodedImage(
+        data=data,
+        mime_type=IMAGE_MIME_TYPES[image_format],
+        width=pil_img.width,
+        height=pil_img.height,
+        encode_s=time.perf_counter() - start,
+    )
+
+
 def base64_to_pil(base64_str: str) -> Image.Image:
     """
     Converts a base64-encoded string back to a PIL Image.
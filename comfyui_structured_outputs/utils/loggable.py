@@ -2,14 +2,118 @@
 Provides logging utilities.
 
 Inherit from `Loggable` to get a `log()` classmethod that returns a logger for the parent class.
+
+`Loggable.setup_logs` logs through a queue: a log call only puts the record on a queue, and a background thread
+writes it to the console and the rotating log file, so file I/O and rotation never block the caller. Wrap
+expensive log arguments in `lazy` to only compute them when the level is enabled.
 """
 
 from __future__ import annotations
 
+import atexit
+import copy
+import json
 import logging
+import queue
 import sys
+import threading
+from collections.abc import Callable
 from logging import handlers
 from pathlib import Path
+from typing import Any
+
+# attributes of every log record, anything else was passed as `extra`
+RECORD_ATTRIBUTES: frozenset[str] = frozenset(
+    logging.LogRecord("", 0, "", 0, "", None, None).__dict__
+) | {"message", "asctime", "taskName"}
+
+
+class lazy:
+    """
+    A log argument computed only if the record is emitted, e.g.
+    `log().debug("Cache stats: %s", lazy(cache.stats))` doesn't query the cache when debug logs are disabled.
+    """
+
+    __slots__ = ("fn", "args", "_value")
+
+    def __init__(self, fn: Callable[..., Any], *args: Any):
+        self.fn = fn
+        self.args = args
+        self._value: str | None = None
+
+    def __str__(self) -> str:
+        # computed once, even if several handlers format the record
+        if self._value is None:
+            self._value = str(self.fn(*self.args))
+        return self._value
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines, with the fields passed as `extra` to the log call."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            {
+                key: value
+                for key, value in record.__dict__.items()
+                if key not in RECORD_ATTRIBUTES
+            }
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(handlers.QueueHandler):
+    """
+    Puts records on the queue with their message formatted, like `QueueHandler`, but keeps their exception
+    apart (as its formatted text), so the formatters on the other side of the queue can place it, e.g. in the
+    "exception" field of the JSON logs.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatted in the calling thread, the arguments may change once the call returns
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        # tracebacks hold on to the frames of the caller
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+
+# the queue logging installed by `Loggable.setup_logs`
+_queue_handler: handlers.QueueHandler | None = None
+_queue_listener: handlers.QueueListener | None = None
+_setup_lock = threading.Lock()
+
+
+def _stop_queue_logging() -> None:
+    # caller must hold the setup lock
+    global _queue_handler, _queue_listener
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _queue_listener is not None:
+        # writes the records still in the queue
+        _queue_listener.stop()
+        for handler in _queue_listener.handlers:
+            handler.close()
+        _queue_listener = None
 
 
 class Loggable:
@@ -22,42 +126,68 @@ class Loggable:
         file_log_level: int = logging.DEBUG,
         format: str = "[%(asctime)s] [%(levelname)s] %(message)s",
         date_format: str = "%Y-%m-%d %H:%M:%S",
+        json_file: bool = False,
     ) -> None:
         """
         Setup logging to file and console.
         Uses a rotating file handler to limit log file size.
         Optionally, configure the logging levels for the console and file handlers.
-
+        Records are written by a background thread, see the module docstring. Calling this again replaces the
+        previous setup, instead of adding more handlers. The root logger is set to DEBUG, so other handlers on it
+        still get every record, the levels these handlers don't write are dropped before they are formatted.
 
         :param log_path: Path to log directory
         :param console_log_level: Log level for console logging
         :param file_log_level: log level for file logging
         :param format: Log format
         :param date_format: Log date format
-
+        :param json_file: Write JSON lines to the log file, with the `extra` fields of each record
         """
-        root_logger = logging.getLogger()
-        root_logger.setLevel(logging.DEBUG)
-
         formatter = logging.Formatter(
             fmt=format,
             datefmt=date_format,
         )
 
+        # setup logging to console
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(console_log_level)
+        console_handler.setFormatter(formatter)
+        target_handlers: list[logging.Handler] = [console_handler]
+
         if log_path is not None:
             # setup logging to file
             file_handler = handlers.RotatingFileHandler(
                 log_path, maxBytes=1000000, backupCount=5
             )
             file_handler.setLevel(file_log_level)
-            file_handler.setFormatter(formatter)
-            root_logger.addHandler(file_handler)
+            file_handler.setFormatter(
+                JsonFormatter(datefmt=date_format) if json_file else formatter
+            )
+            target_handlers.append(file_handler)
 
-        # setup logging to console
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(console_log_level)
-        console_handler.setFormatter(formatter)
-        root_logger.addHandler(console_handler)
+        global _queue_handler, _queue_listener
+        with _setup_lock:
+            _stop_queue_logging()
+
+            log_queue: queue.SimpleQueue = queue.SimpleQueue()
+            queue_handler = _QueueHandler(log_queue)
+            # disabled levels are dropped before the message is formatted
+            queue_handler.setLevel(min(handler.level for handler in target_handlers))
+            listener = handlers.QueueListener(
+                log_queue, *target_handlers, respect_handler_level=True
+            )
+            listener.start()
+
+            root_logger = logging.getLogger()
+            root_logger.setLevel(logging.DEBUG)
+            root_logger.addHandler(queue_handler)
+            _queue_handler, _queue_listener = queue_handler, listener
+
+    @staticmethod
+    def shutdown_logs() -> None:
+        """Writes the queued records, then removes the handlers installed by `setup_logs`."""
+        with _setup_lock:
+            _stop_queue_logging()
 
     @property
     def logger(self) -> logging.Logger:
@@ -68,3 +198,7 @@ class Loggable:
     def log(cls) -> logging.Logger:
         """Returns a logger for the parent class."""
         return logging.getLogger(cls.__name__)
+
+
+# don't lose the last records at exit
+atexit.register(Loggable.shutdown_logs)
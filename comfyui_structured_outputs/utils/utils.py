@@ -4,16 +4,65 @@ General Utilities
 
 from __future__ import annotations
 
+import importlib
 import os
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
-
-from dotenv import load_dotenv
+from types import ModuleType
+from typing import Any
 
 from .. import DOTENV_FILE
+from ..settings import get_settings
 from ..utils.loggable import Loggable
 
 
+class LazyModule:
+    """
+    Stands in for a module, importing it when one of its attributes is first used.
+    Safe to use from several threads, the module is imported once.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: Full name of the module, e.g. "PIL.Image"
+        """
+        self._name = name
+        self._module: ModuleType | None = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    Loggable.log().debug(f"Importing '{self._name}'")
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self._load(), attribute)
+
+    def __repr__(self) -> str:
+        return (
+            f"<lazy module '{self._name}'{'' if self.is_loaded else ' (not loaded)'}>"
+        )
+
+
+def lazy_import(name: str) -> Any:
+    """
+    Returns a stand-in for the module, which imports it on first use.
+    Heavy dependencies (torch, numpy, PIL, instructor, openai) are imported this way, so loading the plugin (and
+    registering its nodes) doesn't pay for them, only the first node execution does.
+    """
+    return LazyModule(name)
+
+
 @contextmanager
 def change_dir(new_dir: Path):
     """
@@ -40,14 +89,44 @@ def dotenv_file_exists(dotenv_path: Path = DOTENV_FILE) -> bool:
 
 def get_env(key: str, dotenv_path: Path = DOTENV_FILE) -> str | None:
     """
-    Returns the value of the specified environment variable key, loading it from the .env file if necessary.
+    Returns the value of the specified environment variable key, or of the setting in the .env file.
+    The .env file is cached, and only parsed again when it changes, see `settings.py`.
+    """
+    return get_settings(dotenv_path).get(key)
+
+
+def get_env_flag(
+    key: str, default: bool = False, dotenv_path: Path = DOTENV_FILE
+) -> bool:
+    """
+    Returns the specified environment variable key as a boolean, e.g. "true", "1", "yes" are truthy.
+    """
+    if (value := get_env(key, dotenv_path)) is None:
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def map_concurrently(
+    fn: Callable[[Any], Any], items: Iterable[Any], max_concurrency: int = 8
+) -> list[Any]:
+    """
+    Applies `fn` to every item using a thread pool, returning the results in the same order as `items`.
+    If any call raises, the first exception (in item order) is re-raised.
+
+    :param fn: Function to apply to each item
+    :param items: Items to process
+    :param max_concurrency: Maximum number of calls in flight at once
     """
-    if value := os.getenv(key):
-        return value
+    items = list(items)
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
 
-    if not dotenv_file_exists():
-        Loggable.log().error(f"File '{dotenv_path}' does not exist")
-        return None
+    if max_concurrency == 1 or len(items) <= 1:
+        return [fn(item) for item in items]
 
-    load_dotenv(dotenv_path)
-    return os.getenv(key)
+    with ThreadPoolExecutor(
+        max_workers=min(max_concurrency, len(items)),
+        thread_name_prefix="structured-output",
+    ) as executor:
+        return list(executor.map(fn, items))
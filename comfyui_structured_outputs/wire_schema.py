@@ -0,0 +1,130 @@
+"""
+Compact wire schema of the return models.
+
+The return model nests an attribute model (`key`, `value`, `error`) per attribute, so its JSON schema has a
+`$defs` entry and titles for each, and the model has to repeat every `key` in its output. The wire model sent to
+the provider is flat, `{name: value}`, with the descriptions, examples and options of the attributes, and without
+titles. Its responses are expanded back into the return model after validation, so nodes get the same results.
+"""
+
+from __future__ import annotations
+
+import json
+from functools import lru_cache
+from typing import Any
+
+from pydantic import BaseModel, Field, create_model
+
+from .attribute_utils import (
+    RETURN_MODEL_CACHE_SIZE,
+    BaseAttributesModel,
+    model_json_schema,
+)
+from .scheduler import estimate_tokens
+from .utils.loggable import Loggable, lazy
+
+# keywords whose values are data rather than sub-schemas, copied as is
+DATA_KEYWORDS: tuple[str, ...] = ("default", "examples", "const", "enum")
+
+
+def _compact(node: Any, renames: dict[str, str]) -> Any:
+    if isinstance(node, list):
+        return [_compact(item, renames) for item in node]
+    if not isinstance(node, dict):
+        return node
+
+    compacted: dict[str, Any] = {}
+    for key, value in node.items():
+        if key == "title" and isinstance(value, str):
+            continue
+        if key == "examples" and all(example in (None, "") for example in value):
+            continue
+        if key == "$ref":
+            compacted[key] = renames.get(value, value)
+        elif key in DATA_KEYWORDS:
+            compacted[key] = value
+        elif key in ("properties", "$defs"):
+            # maps names to sub-schemas, a property may well be called "title"
+            compacted[key] = {
+                name: _compact(sub_schema, renames)
+                for name, sub_schema in value.items()
+            }
+        else:
+            compacted[key] = _compact(value, renames)
+    return compacted
+
+
+def compact_json_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns a copy of the JSON schema without the titles of its sub-schemas and without empty examples, with
+    identical `$defs` merged into one. The root title is kept, it names the tool call.
+    """
+    renames: dict[str, str] = {}
+    if defs := schema.get("$defs"):
+        # the first definition of each distinct sub-schema is kept
+        canonical: dict[str, str] = {}
+        for name, definition in defs.items():
+            body = json.dumps(_compact(definition, {}), sort_keys=True)
+            kept_name = canonical.setdefault(body, name)
+            if kept_name != name:
+                renames[f"#/$defs/{name}"] = f"#/$defs/{kept_name}"
+
+    compacted = _compact(schema, renames)
+    if renames:
+        removed = {ref.rsplit("/", 1)[-1] for ref in renames}
+        compacted["$defs"] = {
+            name: definition
+            for name, definition in compacted["$defs"].items()
+            if name not in removed
+        }
+    if "title" in schema:
+        compacted = {"title": schema["title"], **compacted}
+    return compacted
+
+
+class BaseWireModel(BaseModel):
+    """Flat model of the attribute values, whose JSON schema is compacted, see `compact_json_schema`."""
+
+    @classmethod
+    def model_json_schema(cls, *args, **kwargs) -> dict[str, Any]:
+        return compact_json_schema(super().model_json_schema(*args, **kwargs))
+
+
+def schema_tokens(model: type[BaseModel]) -> int:
+    """Estimates the prompt tokens of the model's JSON schema."""
+    return estimate_tokens(json.dumps(model_json_schema(model)))
+
+
+@lru_cache(maxsize=RETURN_MODEL_CACHE_SIZE)
+def wire_model(attributes_model: type[BaseAttributesModel]) -> type[BaseWireModel]:
+    """Returns the (cached) flat wire model of a return model, with a field per attribute value."""
+    fields: dict[str, Any] = {}
+    for name, field_info in attributes_model.model_fields.items():
+        value_field = field_info.annotation.model_fields["value"]
+        examples = [
+            example
+            for example in value_field.examples or []
+            if example not in (None, "")
+        ]
+        fields[name] = (
+            value_field.annotation,
+            Field(description=value_field.description, examples=examples or None),
+        )
+    model = create_model(attributes_model.__name__, __base__=BaseWireModel, **fields)
+
+    Loggable.log().info(
+        "Compact schema of %d attributes: %s -> %s tokens",
+        len(fields),
+        lazy(schema_tokens, attributes_model),
+        lazy(schema_tokens, model),
+    )
+    return model
+
+
+def expand_response(
+    response: BaseWireModel, attributes_model: type[BaseAttributesModel]
+) -> BaseAttributesModel:
+    """Expands a response of the wire model into the return model."""
+    return attributes_model.model_validate(
+        {name: {"key": name, "value": value} for name, value in response}
+    )
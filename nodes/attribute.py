@@ -1,13 +1,9 @@
 from __future__ import annotations
 
-from typing import Literal
-
-from pydantic import Field, create_model
-
 from ..comfyui_structured_outputs.attribute_utils import (
     ATTRIBUTE_TYPES,
     BaseAttributeModel,
-    string_to_type,
+    create_attribute_model,
 )
 from ..comfyui_structured_outputs.utils.loggable import Loggable
 
@@ -82,15 +78,13 @@ class AttributeNode(Loggable):
         if not attributes_in:
             attributes_in = []
 
-        attribute_model = create_model(
-            f"{name}Model",
-            # force the "key" to be the name of the attribute
-            key=(Literal[name], Field(default=name, description="Attribute name")),
-            value=(
-                string_to_type(attribute_type, options=options),
-                Field(description=description, examples=[example]),
-            ),
-            __base__=BaseAttributeModel,
+        # identical definitions share a cached model class
+        attribute_model = create_attribute_model(
+            name,
+            attribute_type,
+            options=options,
+            description=description,
+            example=example,
         )
 
         # concat the attributes_in and the new attribute_model
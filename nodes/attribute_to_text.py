@@ -1,4 +1,6 @@
-from ..comfyui_structured_outputs.attribute_utils import BaseAttributeModel
+from ..comfyui_structured_outputs.attribute_utils import BaseAttributesModel
+from ..comfyui_structured_outputs.background import resolve
+from ..comfyui_structured_outputs.templates import compile_template
 
 
 class AttributeToTextNode:
@@ -10,6 +12,8 @@ class AttributeToTextNode:
     OUTPUT_NODE: bool = True
 
     INPUT_IS_LIST: bool = True
+    # one text per attribute result in batch mode, otherwise a single text
+    OUTPUT_IS_LIST = (True,)
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -23,6 +27,10 @@ class AttributeToTextNode:
                     },
                 ),
             },
+            "optional": {
+                # render every attribute result (e.g. of a batch), not just the first
+                "batch_mode": ("BOOLEAN", {"default": False}),
+            },
             "hidden": {
                 "unique_id": "UNIQUE_ID",
                 "extra_pnginfo": "EXTRA_PNGINFO",
@@ -31,21 +39,24 @@ class AttributeToTextNode:
 
     def get_text(
         self,
-        attributes: [BaseAttributeModel],
+        attributes: [BaseAttributesModel],
         format_text: [str],
         extra_pnginfo,
         unique_id,
+        batch_mode: [bool] = None,
     ):
         # handle padded input lists
         format_text: str = format_text[0]
         if format_text is None:
             format_text = ""
+        batch_mode: bool = batch_mode[0] if batch_mode else False
 
-        # convert attribute to key value pairs
-        mapping: dict[str, str] = {
-            key: value["value"] for key, value in attributes[0].model_dump().items()
-        }
+        # the template is parsed once, and checked against the attributes before rendering
+        template = compile_template(format_text)
+        if not batch_mode:
+            attributes = attributes[:1]
+        # results of a Structured Output Node in background mode are waited for here
+        attributes = [resolve(attribute) for attribute in attributes]
 
         # replace {key} with value
-        formatted_text: str = format_text.format(**mapping)
-        return (formatted_text,)
+        return (template.render_batch(attributes),)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from functools import partial
+
+from ..comfyui_structured_outputs.attribute_utils import (
+    BaseAttributeModel,
+    attributes_to_model,
+    merge_attribute_groups,
+    split_attributes,
+)
+from ..comfyui_structured_outputs.background import then
+from .structured_output import StructuredOutputNode
+
+# attribute inputs (and outputs) of the node
+FUSED_GROUP_COUNT: int = 4
+
+
+class FusedStructuredOutputNode(StructuredOutputNode):
+    """
+    Answers several attribute groups with the requests of a single Structured Output Node, e.g. the groups of
+    nodes that would each send the same image and prompt. The groups are merged into one return model, and each
+    result is split back into one output per group. A name defined differently by two groups is asked under the
+    later group's namespace (e.g. `g2__color`), and returned under its own name. Unconnected groups get an
+    empty result for each result of the connected ones, so every output has the same length.
+    """
+
+    NAME: str = "FusedStructuredOutputNode"
+    RETURN_TYPES = ("ATTRIBUTE",) * FUSED_GROUP_COUNT + ("STRING",)
+    RETURN_NAMES = tuple(
+        f"attributes_{group}" for group in range(1, FUSED_GROUP_COUNT + 1)
+    ) + ("timings",)
+    FUNCTION = "get_fused_structured_output"
+
+    # one result per image in batch mode for each group, otherwise a single result
+    OUTPUT_IS_LIST = (True,) * (FUSED_GROUP_COUNT + 1)
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        input_types = super().INPUT_TYPES()
+        required = dict(input_types["required"])
+        del required["attributes"]
+        required["attributes_1"] = ("ATTRIBUTE", {})
+        return {
+            "required": required,
+            "optional": {
+                **{
+                    f"attributes_{group}": ("ATTRIBUTE", {})
+                    for group in range(2, FUSED_GROUP_COUNT + 1)
+                },
+                **input_types["optional"],
+            },
+        }
+
+    def get_fused_structured_output(
+        self,
+        prompt: [str],
+        attributes_1: [type[BaseAttributeModel]],
+        attributes_2: [type[BaseAttributeModel]] = None,
+        attributes_3: [type[BaseAttributeModel]] = None,
+        attributes_4: [type[BaseAttributeModel]] = None,
+        **kwargs,
+    ):
+        groups = [attributes_1, attributes_2, attributes_3, attributes_4]
+        groups = [group or [] for group in groups]
+        merged, field_names = merge_attribute_groups(groups)
+        self.log().debug(
+            "Answering %d attribute groups (%d attributes) in one request",
+            sum(1 for group in groups if group),
+            len(merged),
+        )
+
+        results, timings = self.get_structured_output(prompt, merged, **kwargs)
+
+        outputs = []
+        for group, group_field_names in zip(groups, field_names, strict=True):
+            # results in background mode are split when they resolve
+            split = partial(
+                split_attributes,
+                attributes_model=attributes_to_model(group),
+                field_names=group_field_names,
+            )
+            outputs.append([then(result, split) for result in results])
+        return (*outputs, timings)
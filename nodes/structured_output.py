@@ -1,26 +1,101 @@
-import instructor
-from instructor import Instructor
-from openai import OpenAI
+from __future__ import annotations
 
-from ..comfyui_structured_outputs import DOTENV_FILE
+import json
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from ..comfyui_structured_outputs.api_keys import get_api_key_pool
 from ..comfyui_structured_outputs.attribute_utils import (
     BaseAttributeModel,
     BaseAttributesModel,
     attributes_to_model,
+    model_json_schema,
+)
+from ..comfyui_structured_outputs.backends import (
+    BACKENDS,
+    ENV_BACKEND,
+    STRUCTURED_MODES,
+    BackendSettings,
+    get_backend_client,
+    resolve_backend,
+)
+from ..comfyui_structured_outputs.background import run_in_background
+from ..comfyui_structured_outputs.batch_jobs import DEFAULT_POLL_INTERVAL_S, BatchJob
+from ..comfyui_structured_outputs.encoded_image_cache import (
+    get_encoded_image_cache,
+)
+from ..comfyui_structured_outputs.hedging import deadline_kwargs
+from ..comfyui_structured_outputs.metrics import (
+    RequestTimings,
+    instrument_client,
+    track_request,
+    write_metrics_file,
+)
+from ..comfyui_structured_outputs.near_duplicates import get_near_duplicate_index
+from ..comfyui_structured_outputs.packing import (
+    MAX_PACK_SIZE,
+    build_packed_messages,
+    pack,
+    packed_model,
+    unpack_results,
+)
+from ..comfyui_structured_outputs.response_cache import (
+    ResponseCache,
+    get_response_cache,
 )
-from ..comfyui_structured_outputs.utils.image_utils import tensor_to_base64
-from ..comfyui_structured_outputs.utils.loggable import Loggable
-from ..comfyui_structured_outputs.utils.utils import get_env
+from ..comfyui_structured_outputs.scheduler import estimate_tokens, get_scheduler
+from ..comfyui_structured_outputs.single_flight import get_request_coalescer
+from ..comfyui_structured_outputs.streaming import (
+    StreamStats,
+    stream_structured_output,
+)
+from ..comfyui_structured_outputs.utils.image_utils import (
+    IMAGE_DETAILS,
+    IMAGE_FORMATS,
+    PERCEPTUAL_HASH_BITS,
+    EncodedImage,
+    perceptual_hash,
+    tensor_fingerprint,
+)
+from ..comfyui_structured_outputs.utils.loggable import Loggable, lazy
+from ..comfyui_structured_outputs.utils.utils import (
+    get_env,
+    lazy_import,
+    map_concurrently,
+)
+from ..comfyui_structured_outputs.wire_schema import (
+    expand_response,
+    schema_tokens,
+    wire_model,
+)
+
+if TYPE_CHECKING:
+    import torch
+    from instructor import Instructor
+    from pydantic import BaseModel
+else:
+    # imported on the first run, so registering the node stays fast, see `lazy_import`
+    torch = lazy_import("torch")
 
 
 class StructuredOutputNode(Loggable):
     NAME: str = "StructuredOutputNode"
-    RETURN_TYPES = ("ATTRIBUTE",)
-    RETURN_NAMES = ("attributes",)
+    RETURN_TYPES = ("ATTRIBUTE", "STRING")
+    # timings is a JSON breakdown of each request's stages (ms) and token usage
+    RETURN_NAMES = ("attributes", "timings")
     CATEGORY = "structured_output"
     FUNCTION = "get_structured_output"
 
     INPUT_IS_LIST = True
+    # one result per image in batch mode, otherwise a single result
+    OUTPUT_IS_LIST = (True, True)
+
+    DEFAULT_MAX_CONCURRENCY: int = 8
+    DEFAULT_BATCH_MAX_WAIT_S: float = 600.0
+    # use the backend's (or the .env) structured output mode
+    DEFAULT_MODE: str = "default"
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -31,51 +106,995 @@ class StructuredOutputNode(Loggable):
             },
             "optional": {
                 "image_in": ("IMAGE", {}),
+                "batch_mode": ("BOOLEAN", {"default": False}),
+                # in batch mode, images answered by one request, 1 sends each image on its own
+                "pack_size": ("INT", {"default": 1, "min": 1, "max": MAX_PACK_SIZE}),
+                # submit the requests as a job on the provider's Batch API and wait for it, for large offline runs
+                "batch_api": ("BOOLEAN", {"default": False}),
+                # stop waiting for the Batch API job after this many seconds, failing with its batch id, running the
+                # node again resumes the job, 0 waits for the batch's completion window (24 h)
+                "batch_max_wait_s": (
+                    "FLOAT",
+                    {
+                        "default": cls.DEFAULT_BATCH_MAX_WAIT_S,
+                        "min": 0.0,
+                        "max": 86400.0,
+                        "step": 60.0,
+                    },
+                ),
+                # return at once and make the requests while ComfyUI runs the rest of the graph, the results are
+                # waited for by the nodes that use them
+                "background": ("BOOLEAN", {"default": False}),
+                "max_concurrency": (
+                    "INT",
+                    {"default": cls.DEFAULT_MAX_CONCURRENCY, "min": 1, "max": 64},
+                ),
+                "use_cache": ("BOOLEAN", {"default": True}),
+                # reuse the cached response of a near-duplicate image, whose perceptual hash differs in at most
+                # this many of 64 bits, 0 only reuses identical images
+                "near_duplicate_distance": (
+                    "INT",
+                    {"default": 0, "min": 0, "max": PERCEPTUAL_HASH_BITS},
+                ),
+                "image_format": (list(IMAGE_FORMATS), {"default": "PNG"}),
+                # only used for lossy formats (JPEG, WEBP)
+                "image_quality": ("INT", {"default": 90, "min": 1, "max": 100}),
+                # 0 only fits the image to the provider's tiling for the detail level
+                "image_max_side": ("INT", {"default": 0, "min": 0, "max": 8192}),
+                "image_detail": (list(IMAGE_DETAILS), {"default": "auto"}),
+                # identical requests in flight at the same time share one API call
+                "coalesce": ("BOOLEAN", {"default": True}),
+                # stream partial outputs, logging attributes as they complete
+                "streaming": ("BOOLEAN", {"default": False}),
+                # send a flat {name: value} schema, expanded back into the attributes, for fewer tokens
+                "compact_schema": ("BOOLEAN", {"default": True}),
+                # give up on an API call after this many seconds, including its retries, 0 waits for the client
+                # timeout
+                "deadline_s": (
+                    "FLOAT",
+                    {"default": 0.0, "min": 0.0, "max": 3600.0, "step": 1.0},
+                ),
+                # send a duplicate of a call still running after this percentile of the backend's recent latency,
+                # and use the first answer, 0 never hedges
+                "hedge_percentile": ("INT", {"default": 0, "min": 0, "max": 99}),
+                # "env" uses LLM_BACKEND from the .env file, see backends.py
+                "backend": ([ENV_BACKEND, *BACKENDS.keys()], {"default": ENV_BACKEND}),
+                # empty uses the backend's model and base url
+                "model": ("STRING", {"default": ""}),
+                "base_url": ("STRING", {"default": ""}),
+                "structured_mode": (
+                    [cls.DEFAULT_MODE, *STRUCTURED_MODES.keys()],
+                    {"default": cls.DEFAULT_MODE},
+                ),
             },
         }
 
+    @classmethod
+    def IS_CHANGED(
+        cls,
+        backend: [str] = None,
+        model: [str] = None,
+        base_url: [str] = None,
+        structured_mode: [str] = None,
+        **kwargs,
+    ):
+        """
+        ComfyUI runs the node again when the returned value changes. Its cache already tracks the node's inputs,
+        this adds what it can't see: the backend settings resolved from the `.env` file. Only widget values are
+        passed to it, linked inputs such as the images never are.
+        """
+        structured_mode: str | None = structured_mode[0] if structured_mode else None
+        try:
+            settings_id = resolve_backend(
+                backend[0] if backend else ENV_BACKEND,
+                model=model[0] if model else None,
+                base_url=base_url[0] if base_url else None,
+                mode=structured_mode if structured_mode != cls.DEFAULT_MODE else None,
+            ).cache_id
+        except ValueError as e:
+            # the run itself reports the invalid settings
+            settings_id = str(e)
+        return settings_id
+
     def get_structured_output(
-        self, prompt: [str], attributes: [type[BaseAttributeModel]], image_in=None
+        self,
+        prompt: [str],
+        attributes: [type[BaseAttributeModel]],
+        image_in: [torch.Tensor] = None,
+        batch_mode: [bool] = None,
+        max_concurrency: [int] = None,
+        use_cache: [bool] = None,
+        image_format: [str] = None,
+        image_quality: [int] = None,
+        image_max_side: [int] = None,
+        image_detail: [str] = None,
+        coalesce: [bool] = None,
+        streaming: [bool] = None,
+        backend: [str] = None,
+        model: [str] = None,
+        base_url: [str] = None,
+        structured_mode: [str] = None,
+        pack_size: [int] = None,
+        batch_api: [bool] = None,
+        batch_max_wait_s: [float] = None,
+        near_duplicate_distance: [int] = None,
+        background: [bool] = None,
+        compact_schema: [bool] = None,
+        deadline_s: [float] = None,
+        hedge_percentile: [int] = None,
     ):
         prompt: str = prompt[0]
+        schema_start = time.perf_counter()
         attributes_model: type[BaseAttributesModel] = attributes_to_model(attributes)
-        image_in = image_in[0] if image_in else None
-
-        self.log().debug("Setting up Instructor client")
-        openai_key: str = get_env("OPENAI_KEY", DOTENV_FILE)
-        instructor_client: Instructor = instructor.from_openai(
-            OpenAI(api_key=openai_key)
-        )
-
-        image_b64 = None
-        if image_in is not None:
-            self.log().debug("Converting tensor to base64")
-            image_b64 = tensor_to_base64(image_in)
-
-        response = instructor_client.chat.completions.create(
-            model="gpt-4o",
-            response_model=attributes_model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        # if an image is provided, include
-                        *(
-                            [
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{image_b64}"
-                                    },
-                                }
-                            ]
-                            if image_b64 is not None
-                            else []
-                        ),
-                    ],
-                }
-            ],
-        )
-
-        return [response]
+        model_json_schema(attributes_model)
+        schema_s = time.perf_counter() - schema_start
+        batch_mode: bool = batch_mode[0] if batch_mode else False
+        max_concurrency: int = (
+            max_concurrency[0] if max_concurrency else self.DEFAULT_MAX_CONCURRENCY
+        )
+        # the cache is on unless bypassed on this node
+        use_cache: bool = use_cache[0] if use_cache else True
+        image_options: dict = {
+            "image_format": image_format[0] if image_format else "PNG",
+            "quality": image_quality[0] if image_quality else None,
+            "max_side": image_max_side[0] if image_max_side else None,
+            "detail": image_detail[0] if image_detail else "auto",
+        }
+        coalesce: bool = coalesce[0] if coalesce else True
+        streaming: bool = streaming[0] if streaming else False
+        pack_size: int = pack_size[0] if pack_size else 1
+        batch_api: bool = batch_api[0] if batch_api else False
+        batch_max_wait_s: float = (
+            batch_max_wait_s[0] if batch_max_wait_s else self.DEFAULT_BATCH_MAX_WAIT_S
+        )
+        near_duplicate_distance: int = (
+            near_duplicate_distance[0] if near_duplicate_distance else 0
+        )
+        background: bool = background[0] if background else False
+        compact_schema: bool = compact_schema[0] if compact_schema else True
+        deadline_s: float = deadline_s[0] if deadline_s else 0.0
+        hedge_percentile: int = hedge_percentile[0] if hedge_percentile else 0
+
+        structured_mode: str | None = structured_mode[0] if structured_mode else None
+        backend_settings: BackendSettings = resolve_backend(
+            backend[0] if backend else ENV_BACKEND,
+            model=model[0] if model else None,
+            base_url=base_url[0] if base_url else None,
+            mode=structured_mode if structured_mode != self.DEFAULT_MODE else None,
+        )
+
+        self.log().debug(
+            "Using backend '%s', model '%s'",
+            backend_settings.name,
+            backend_settings.model,
+        )
+
+        # slicing keeps the [1, H, W, C] shape, without batch mode only the first image is used
+        images: list[torch.Tensor | None] = [None]
+        if image_in and batch_mode:
+            # each image of every batch becomes its own request
+            images = [
+                batch[index : index + 1]
+                for batch in image_in
+                for index in range(len(batch))
+            ]
+            self.log().debug(
+                "Batch mode: sending %d requests, at most %d at once",
+                len(images),
+                max_concurrency,
+            )
+        elif image_in:
+            images = [image_in[0][:1]]
+
+        # fingerprints of the images, each hashed once per run for the response cache, request coalescing and
+        # the encoded image cache
+        fingerprints: list[str | None] = [None] * len(images)
+
+        def timed_request(index: int) -> tuple[BaseAttributesModel, RequestTimings]:
+            with track_request(backend_settings.name) as timings:
+                timings.add("schema", schema_s)
+                response = self.request(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    images[index],
+                    image_fingerprint=fingerprints[index],
+                    use_cache=use_cache,
+                    image_options=image_options,
+                    streaming=streaming,
+                    timings=timings,
+                    coalesce=coalesce,
+                    near_duplicate_distance=near_duplicate_distance,
+                    compact_schema=compact_schema,
+                    deadline_s=deadline_s,
+                    hedge_percentile=hedge_percentile,
+                )
+            return response, timings
+
+        def run() -> tuple[list[BaseAttributesModel], list[str]]:
+            fingerprints[:] = [
+                tensor_fingerprint(image) if image is not None else None
+                for image in images
+            ]
+            if batch_api:
+                results = self.request_batch_api(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    images,
+                    fingerprints,
+                    use_cache=use_cache,
+                    image_options=image_options,
+                    schema_s=schema_s,
+                    max_concurrency=max_concurrency,
+                    single_request=timed_request,
+                    near_duplicate_distance=near_duplicate_distance,
+                    compact_schema=compact_schema,
+                    max_wait_s=batch_max_wait_s,
+                )
+            elif batch_mode and pack_size > 1 and len(images) > 1:
+                results = self.request_packed(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    images,
+                    fingerprints,
+                    pack_size=pack_size,
+                    use_cache=use_cache,
+                    image_options=image_options,
+                    schema_s=schema_s,
+                    max_concurrency=max_concurrency,
+                    single_request=timed_request,
+                    near_duplicate_distance=near_duplicate_distance,
+                    compact_schema=compact_schema,
+                    deadline_s=deadline_s,
+                    hedge_percentile=hedge_percentile,
+                )
+            else:
+                results = map_concurrently(
+                    timed_request, range(len(images)), max_concurrency=max_concurrency
+                )
+            # the stats are only gathered when debug logs are enabled
+            if use_cache:
+                self.log().debug(
+                    "Response cache stats: %s", lazy(get_response_cache().stats)
+                )
+            if use_cache and near_duplicate_distance:
+                self.log().debug(
+                    "Near-duplicate cache stats: %s",
+                    lazy(get_near_duplicate_index().stats),
+                )
+            if coalesce:
+                self.log().debug(
+                    "Request coalescing stats: %s", lazy(get_request_coalescer().stats)
+                )
+            self.log().debug(
+                "Encoded image cache stats: %s", lazy(get_encoded_image_cache().stats)
+            )
+
+            timings_out: list[str] = []
+            for _, timings in results:
+                timings_dict = timings.to_dict()
+                self.log().debug("Request timings: %s", timings_dict)
+                timings_out.append(json.dumps(timings_dict))
+            # optionally export the process-wide metrics, see `METRICS_FILE` in .env.example
+            if metrics_file := get_env("METRICS_FILE"):
+                write_metrics_file(Path(metrics_file))
+            return ([response for response, _ in results], timings_out)
+
+        if background:
+            self.log().debug("Running %d requests in the background", len(images))
+            # the timings are only known once the requests are done, they are logged and in the metrics
+            return (
+                run_in_background(lambda: run()[0], count=len(images)),
+                [json.dumps({"background": True})] * len(images),
+            )
+        return run()
+
+    @staticmethod
+    def build_messages(
+        prompt: str, image: EncodedImage | None = None, detail: str = "auto"
+    ) -> list[dict]:
+        """Builds the chat messages for a prompt, with an optional encoded image."""
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    # if an image is provided, include
+                    *(
+                        [
+                            {
+                                "type": "image_url",
+                                "image_url": {"url": image.data_url, "detail": detail},
+                            }
+                        ]
+                        if image is not None
+                        else []
+                    ),
+                ],
+            }
+        ]
+
+    def request_key(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        image: torch.Tensor | None = None,
+        image_options: dict | None = None,
+        image_fingerprint: str | None = None,
+    ) -> str:
+        """
+        Returns the fingerprint of a request, the key of the response cache and of request coalescing.
+        The image is hashed (see `tensor_fingerprint`) unless its `image_fingerprint` is given.
+        """
+        if image is not None and image_fingerprint is None:
+            # hashes the buffer in place, without a bytes copy
+            image_fingerprint = tensor_fingerprint(image)
+        return ResponseCache.make_key(
+            model=backend_settings.cache_id,
+            messages=self.build_messages(prompt),
+            schema=model_json_schema(attributes_model),
+            image_options=image_options if image is not None else None,
+            image_fingerprint=image_fingerprint if image is not None else None,
+        )
+
+    def request(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        image: torch.Tensor | None = None,
+        image_fingerprint: str | None = None,
+        use_cache: bool = True,
+        image_options: dict | None = None,
+        streaming: bool = False,
+        timings: RequestTimings | None = None,
+        coalesce: bool = True,
+        near_duplicate_distance: int = 0,
+        compact_schema: bool = True,
+        deadline_s: float = 0.0,
+        hedge_percentile: int = 0,
+    ) -> BaseAttributesModel:
+        """
+        Makes a single structured output request, for the prompt and an optional image, hashed once (unless its
+        `image_fingerprint` is given) for the cache keys of the request and the encoded image.
+        `image_options` are passed to `encode_image`, and the time of each stage is added to `timings`.
+        With `coalesce`, concurrent identical requests share one API call, and each gets its own copy of the result.
+        With a `near_duplicate_distance`, the cached response of a near-duplicate image is used, see
+        `near_duplicate_response`. With `compact_schema`, the flat wire model is requested, see `wire_schema.py`.
+        `deadline_s` and `hedge_percentile` bound and hedge the API call, see `hedging.py`.
+        """
+        image_options = image_options or {}
+        timings = timings if timings is not None else RequestTimings()
+        if image is not None and image_fingerprint is None:
+            image_fingerprint = tensor_fingerprint(image)
+
+        def fetch(cache_key: str | None = None) -> BaseAttributesModel:
+            return self.fetch(
+                backend_settings,
+                prompt,
+                attributes_model,
+                image,
+                image_fingerprint=image_fingerprint,
+                image_options=image_options,
+                streaming=streaming,
+                timings=timings,
+                cache_key=cache_key,
+                compact_schema=compact_schema,
+                deadline_s=deadline_s,
+                hedge_percentile=hedge_percentile,
+            )
+
+        if not use_cache and not coalesce:
+            return fetch()
+
+        def cached_response(cached: str) -> BaseAttributesModel:
+            self.log().debug("Response cache hit")
+            timings.cache_hit = True
+            with timings.span("validation"):
+                return attributes_model.model_validate_json(cached)
+
+        cache_lookup_start = time.perf_counter()
+        request_key = self.request_key(
+            backend_settings,
+            prompt,
+            attributes_model,
+            image,
+            image_options,
+            image_fingerprint=image_fingerprint,
+        )
+        if use_cache:
+            cached = get_response_cache().get(request_key)
+            if cached is None and image is not None and near_duplicate_distance:
+                cached = self.near_duplicate_response(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    image,
+                    image_options,
+                    request_key,
+                    near_duplicate_distance,
+                )
+            timings.add("cache_lookup", time.perf_counter() - cache_lookup_start)
+            if cached is not None:
+                return cached_response(cached)
+
+        cache_key = request_key if use_cache else None
+        if not coalesce:
+            return fetch(cache_key)
+
+        def fetch_once() -> BaseAttributesModel:
+            # an identical request may have been answered (and cached) since the lookup, just before this call
+            # became the one in flight
+            if (
+                cache_key is not None
+                and (cached := get_response_cache().get(cache_key)) is not None
+            ):
+                return cached_response(cached)
+            return fetch(cache_key)
+
+        wait_start = time.perf_counter()
+        response, shared = get_request_coalescer().do(
+            request_key,
+            fetch_once,
+            deadline=time.monotonic() + deadline_s if deadline_s else None,
+        )
+        if not shared:
+            return response
+        self.log().debug("Shared the response of an identical request in flight")
+        timings.coalesced = True
+        timings.add("coalesced", time.perf_counter() - wait_start)
+        return response.model_copy(deep=True)
+
+    def near_duplicate_response(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        image: torch.Tensor,
+        image_options: dict,
+        request_key: str,
+        max_distance: int,
+    ) -> str | None:
+        """
+        Returns the cached response of a near-duplicate image in the same request context (backend, prompt,
+        schema and image options), one whose perceptual hash is within `max_distance` bits of the image's.
+        On a miss, the image is indexed under `request_key`, so near-duplicates find its response once cached.
+        """
+        index = get_near_duplicate_index()
+        hash_value = perceptual_hash(image)
+        context = ResponseCache.make_key(
+            model=backend_settings.cache_id,
+            messages=self.build_messages(prompt),
+            schema=model_json_schema(attributes_model),
+            image_options=image_options,
+        )
+        if (
+            match := index.get(
+                context, hash_value, max_distance, get_response_cache().get
+            )
+        ) is None:
+            index.add(context, hash_value, request_key)
+            return None
+        response, distance = match
+        self.log().debug("Near-duplicate cache hit, %d bits from the image", distance)
+        return response
+
+    def cached_results(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        images: list[torch.Tensor | None],
+        fingerprints: list[str | None],
+        use_cache: bool,
+        image_options: dict,
+        near_duplicate_distance: int = 0,
+    ) -> tuple[
+        list[tuple[BaseAttributesModel, RequestTimings] | None], list[str | None]
+    ]:
+        """
+        Looks up the response of each image in the cache, the same as a single image request.
+        Returns the results (None for images not in the cache) and the cache key of each image.
+        """
+        results: list[tuple[BaseAttributesModel, RequestTimings] | None] = [None] * len(
+            images
+        )
+        cache_keys: list[str | None] = [None] * len(images)
+        if not use_cache:
+            return results, cache_keys
+
+        for index, image in enumerate(images):
+            lookup_start = time.perf_counter()
+            cache_keys[index] = self.request_key(
+                backend_settings,
+                prompt,
+                attributes_model,
+                image,
+                image_options,
+                image_fingerprint=fingerprints[index],
+            )
+            cached = get_response_cache().get(cache_keys[index])
+            if cached is None and image is not None and near_duplicate_distance:
+                cached = self.near_duplicate_response(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    image,
+                    image_options,
+                    cache_keys[index],
+                    near_duplicate_distance,
+                )
+            if cached is not None:
+                with track_request(backend_settings.name) as timings:
+                    timings.add("cache_lookup", time.perf_counter() - lookup_start)
+                    timings.cache_hit = True
+                    with timings.span("validation"):
+                        response = attributes_model.model_validate_json(cached)
+                results[index] = (response, timings)
+        return results, cache_keys
+
+    def request_missing(
+        self,
+        results: list[tuple[BaseAttributesModel, RequestTimings] | None],
+        single_request: Callable[[int], tuple[BaseAttributesModel, RequestTimings]],
+        max_concurrency: int,
+        reason: str,
+    ) -> list[tuple[BaseAttributesModel, RequestTimings]]:
+        """Fills in the missing results with single image requests, made by image index."""
+        if missing := [index for index, result in enumerate(results) if result is None]:
+            self.log().warning(
+                f"{len(missing)} images were {reason}, requesting them on their own"
+            )
+            for index, result in zip(
+                missing,
+                map_concurrently(
+                    single_request, missing, max_concurrency=max_concurrency
+                ),
+                strict=True,
+            ):
+                results[index] = result
+        return results
+
+    def request_batch_api(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        images: list[torch.Tensor | None],
+        fingerprints: list[str | None],
+        use_cache: bool,
+        image_options: dict,
+        schema_s: float,
+        max_concurrency: int,
+        single_request: Callable[[int], tuple[BaseAttributesModel, RequestTimings]],
+        near_duplicate_distance: int = 0,
+        compact_schema: bool = True,
+        max_wait_s: float = 0.0,
+    ) -> list[tuple[BaseAttributesModel, RequestTimings]]:
+        """
+        Answers the images with one job on the backend's Batch API, waiting for it to complete.
+        The job resumes if it was already submitted (e.g. before a restart), images with a cached response
+        aren't sent, and failed requests are made again in real time with `single_request`.
+        Every image of the job gets the timings of the job. A job still running after `max_wait_s` (if not 0)
+        raises a TimeoutError with its batch id, and is resumed by the next run.
+        """
+        results, cache_keys = self.cached_results(
+            backend_settings,
+            prompt,
+            attributes_model,
+            images,
+            fingerprints,
+            use_cache,
+            image_options,
+            near_duplicate_distance=near_duplicate_distance,
+        )
+        if not (
+            pending := [index for index, result in enumerate(results) if result is None]
+        ):
+            return results
+
+        detail = image_options.get("detail", "auto")
+        with track_request(backend_settings.name) as timings:
+            timings.add("schema", schema_s)
+            with timings.span("encode"):
+                messages_list = [
+                    self.build_messages(
+                        prompt,
+                        get_encoded_image_cache().encode(
+                            images[index],
+                            fingerprint=fingerprints[index],
+                            **image_options,
+                        )
+                        if images[index] is not None
+                        else None,
+                        detail=detail,
+                    )
+                    for index in pending
+                ]
+            # batches are billed to a single key, the first of the pool
+            client = get_backend_client(backend_settings).client
+            response_model = (
+                wire_model(attributes_model) if compact_schema else attributes_model
+            )
+            timings.schema_tokens = schema_tokens(response_model)
+            job = BatchJob(
+                client,
+                response_model,
+                messages_list,
+                model=backend_settings.model,
+                mode=backend_settings.instructor_mode,
+            )
+            with timings.span("queue"):
+                batch_results = job.run(
+                    poll_interval_s=float(
+                        get_env("LLM_BATCH_POLL_S") or DEFAULT_POLL_INTERVAL_S
+                    ),
+                    timeout_s=max_wait_s or None,
+                )
+            timings.prompt_tokens += batch_results.prompt_tokens
+            timings.completion_tokens += batch_results.completion_tokens
+
+        for index, response in zip(pending, batch_results.responses, strict=True):
+            if response is None:
+                continue
+            response = (
+                expand_response(response, attributes_model)
+                if compact_schema
+                else attributes_model.model_validate(response.model_dump())
+            )
+            results[index] = (response, timings)
+            if cache_keys[index] is not None:
+                get_response_cache().set(cache_keys[index], response.model_dump_json())
+
+        return self.request_missing(
+            results,
+            single_request,
+            max_concurrency,
+            reason="failed in the batch",
+        )
+
+    def request_packed(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        images: list[torch.Tensor],
+        fingerprints: list[str | None],
+        pack_size: int,
+        use_cache: bool,
+        image_options: dict,
+        schema_s: float,
+        max_concurrency: int,
+        single_request: Callable[[int], tuple[BaseAttributesModel, RequestTimings]],
+        near_duplicate_distance: int = 0,
+        compact_schema: bool = True,
+        deadline_s: float = 0.0,
+        hedge_percentile: int = 0,
+    ) -> list[tuple[BaseAttributesModel, RequestTimings]]:
+        """
+        Answers the images with packed requests of up to `pack_size` images each.
+        Images with a cached response aren't sent, and images missing from a packed response are requested
+        again on their own with `single_request`. Every image of a pack gets the timings of the pack.
+        """
+        results, cache_keys = self.cached_results(
+            backend_settings,
+            prompt,
+            attributes_model,
+            images,
+            fingerprints,
+            use_cache,
+            image_options,
+            near_duplicate_distance=near_duplicate_distance,
+        )
+        pending = [index for index, result in enumerate(results) if result is None]
+        packs = pack(pending, pack_size)
+        self.log().debug(
+            "Packing %d images into %d requests (%d cached)",
+            len(pending),
+            len(packs),
+            len(images) - len(pending),
+        )
+
+        def timed_pack(
+            indices: list[int],
+        ) -> tuple[dict[int, BaseAttributesModel], RequestTimings]:
+            with track_request(backend_settings.name) as timings:
+                timings.add("schema", schema_s)
+                responses = self.fetch_packed(
+                    backend_settings,
+                    prompt,
+                    attributes_model,
+                    [images[index] for index in indices],
+                    [fingerprints[index] for index in indices],
+                    image_options=image_options,
+                    timings=timings,
+                    compact_schema=compact_schema,
+                    deadline_s=deadline_s,
+                    hedge_percentile=hedge_percentile,
+                )
+            return responses, timings
+
+        for indices, (responses, timings) in zip(
+            packs,
+            map_concurrently(timed_pack, packs, max_concurrency=max_concurrency),
+            strict=True,
+        ):
+            for position, index in enumerate(indices):
+                if (response := responses.get(position)) is None:
+                    continue
+                results[index] = (response, timings)
+                if cache_keys[index] is not None:
+                    get_response_cache().set(
+                        cache_keys[index], response.model_dump_json()
+                    )
+
+        return self.request_missing(
+            results,
+            single_request,
+            max_concurrency,
+            reason="missing from the packed responses",
+        )
+
+    def call_backend(
+        self,
+        backend_settings: BackendSettings,
+        call: Callable[[Instructor, dict], tuple[BaseModel, Any]],
+        estimated_tokens: int,
+        timings: RequestTimings,
+        deadline_s: float = 0.0,
+        hedge_percentile: int = 0,
+        stage: str = "validation",
+    ) -> BaseModel:
+        """
+        Makes an API call through the backend's scheduler, returning its response. Each attempt leases a key from
+        the backend's API key pool, so retries rotate keys. The tokens taken for the call are settled with its
+        usage, estimated from the request and response when it isn't known (e.g. streamed calls).
+        Whatever of the call isn't waiting for the API or the limits is added to `stage`.
+
+        :param call: Makes an attempt with the client and the request arguments of the deadline (see
+            `deadline_kwargs`), returning the response and the completion's usage, or None if it isn't known
+        :param estimated_tokens: Estimated prompt tokens of the call, see `estimate_tokens`
+        :param deadline_s: Seconds the call (and its retries) may take, 0 for no deadline
+        :param hedge_percentile: Latency percentile after which the call is hedged, 0 never hedges
+        :param stage: Stage of the time spent parsing and validating the response
+        """
+        key_pool = get_api_key_pool(backend_settings)
+        scheduler = get_scheduler(backend_settings, key_count=len(key_pool))
+        deadline = time.monotonic() + deadline_s if deadline_s else None
+
+        def attempt() -> tuple[BaseModel, Any]:
+            with key_pool.lease(deadline) as api_key:
+                client = get_backend_client(backend_settings, api_key)
+                instrument_client(client)
+                return call(client, deadline_kwargs(deadline))
+
+        # the hooks registered by `instrument_client` time the API calls as the "network" stage,
+        # and the scheduler adds its waits as the "queue" stage
+        waited_s = timings.stages_s.get("network", 0.0) + timings.stages_s.get(
+            "queue", 0.0
+        )
+        request_start = time.perf_counter()
+        response, completion = scheduler.run(
+            attempt,
+            estimated_tokens=estimated_tokens,
+            timings=timings,
+            deadline=deadline,
+            hedge_percentile=hedge_percentile,
+        )
+
+        if (usage := getattr(completion, "usage", None)) is not None:
+            timings.record_usage(usage)
+        else:
+            timings.prompt_tokens = estimated_tokens
+            timings.completion_tokens = estimate_tokens(response.model_dump_json())
+        scheduler.settle_tokens(
+            estimated_tokens, timings.prompt_tokens + timings.completion_tokens
+        )
+
+        # whatever isn't waiting is parsing and validating (including instructor's retries)
+        timings.add(
+            stage,
+            max(
+                0.0,
+                time.perf_counter()
+                - request_start
+                - (
+                    timings.stages_s.get("network", 0.0)
+                    + timings.stages_s.get("queue", 0.0)
+                    - waited_s
+                ),
+            ),
+        )
+        return response
+
+    @staticmethod
+    def completion_call(
+        backend_settings: BackendSettings,
+        response_model: type[BaseModel],
+        messages: list[dict],
+    ) -> Callable[[Instructor, dict], tuple[BaseModel, Any]]:
+        """Returns the `call_backend` call of a structured output completion, without streaming."""
+        return lambda client, request_kwargs: (
+            client.chat.completions.create_with_completion(
+                model=backend_settings.model,
+                response_model=response_model,
+                messages=messages,
+                **request_kwargs,
+            )
+        )
+
+    def fetch_packed(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        images: list[torch.Tensor],
+        fingerprints: list[str | None] | None = None,
+        image_options: dict | None = None,
+        timings: RequestTimings | None = None,
+        compact_schema: bool = True,
+        deadline_s: float = 0.0,
+        hedge_percentile: int = 0,
+    ) -> dict[int, BaseAttributesModel]:
+        """
+        Encodes the images (with their `fingerprints`, if known) and makes one API call for all of them, returning
+        the attributes by image position. Positions missing from the response are missing from the returned dict.
+        """
+        image_options = image_options or {}
+        timings = timings if timings is not None else RequestTimings()
+        detail = image_options.get("detail", "auto")
+
+        with timings.span("encode"):
+            encoded_images = [
+                get_encoded_image_cache().encode(
+                    image, fingerprint=fingerprint, **image_options
+                )
+                for image, fingerprint in zip(
+                    images, fingerprints or [None] * len(images), strict=True
+                )
+            ]
+        messages = build_packed_messages(prompt, encoded_images, detail=detail)
+        response_model = packed_model(
+            wire_model(attributes_model) if compact_schema else attributes_model
+        )
+        timings.schema_tokens = schema_tokens(response_model)
+
+        estimated_tokens = estimate_tokens(
+            prompt + json.dumps(model_json_schema(response_model))
+        ) + sum(
+            estimate_tokens("", encoded_image, detail=detail)
+            for encoded_image in encoded_images
+        )
+        packed = self.call_backend(
+            backend_settings,
+            self.completion_call(backend_settings, response_model, messages),
+            estimated_tokens,
+            timings,
+            deadline_s=deadline_s,
+            hedge_percentile=hedge_percentile,
+        )
+
+        responses = unpack_results(packed, len(images))
+        if compact_schema:
+            responses = {
+                position: expand_response(response, attributes_model)
+                for position, response in responses.items()
+            }
+        self.log().info(
+            "Packed request answered %d of %d images", len(responses), len(images)
+        )
+        return responses
+
+    def fetch(
+        self,
+        backend_settings: BackendSettings,
+        prompt: str,
+        attributes_model: type[BaseAttributesModel],
+        image: torch.Tensor | None = None,
+        image_fingerprint: str | None = None,
+        image_options: dict | None = None,
+        streaming: bool = False,
+        timings: RequestTimings | None = None,
+        cache_key: str | None = None,
+        compact_schema: bool = True,
+        deadline_s: float = 0.0,
+        hedge_percentile: int = 0,
+    ) -> BaseAttributesModel:
+        """
+        Encodes the image and makes the API call (see `call_backend`), storing the response in the cache if
+        `cache_key` is given. Streamed calls have a deadline, but aren't hedged, a stream already returns as soon
+        as it's complete.
+        """
+        image_options = image_options or {}
+        timings = timings if timings is not None else RequestTimings()
+
+        encoded_image = None
+        if image is not None:
+            with timings.span("encode"):
+                encoded_image = get_encoded_image_cache().encode(
+                    image, fingerprint=image_fingerprint, **image_options
+                )
+            self.log().info(
+                "Encoded %dx%d %s image in %.1f ms, payload %.1f KiB",
+                encoded_image.width,
+                encoded_image.height,
+                encoded_image.mime_type,
+                encoded_image.encode_s * 1000,
+                encoded_image.size_bytes / 1024,
+            )
+
+        messages = self.build_messages(
+            prompt, encoded_image, detail=image_options.get("detail", "auto")
+        )
+        # streaming tracks the completion of each attribute on the nested return model
+        response_model = (
+            wire_model(attributes_model)
+            if compact_schema and not streaming
+            else attributes_model
+        )
+        timings.schema_tokens = schema_tokens(response_model)
+        estimated_tokens = estimate_tokens(
+            prompt + json.dumps(model_json_schema(response_model)),
+            encoded_image,
+            detail=image_options.get("detail", "auto"),
+        )
+
+        if streaming:
+            stream_stats: list[StreamStats] = []
+
+            def stream(
+                client: Instructor, request_kwargs: dict
+            ) -> tuple[BaseAttributesModel, None]:
+                response, stats = stream_structured_output(
+                    client,
+                    attributes_model,
+                    messages,
+                    model=backend_settings.model,
+                    on_attribute=lambda name, value, elapsed: self.log().debug(
+                        "Attribute '%s' completed after %.0f ms", name, elapsed * 1000
+                    ),
+                    **request_kwargs,
+                )
+                # the stats of the last attempt
+                stream_stats[:] = [stats]
+                # instructor's partial stream doesn't expose the usage chunk, see `call_backend`
+                return response, None
+
+            # partial responses are parsed as they are read, so streaming and validating aren't separable
+            response = self.call_backend(
+                backend_settings,
+                stream,
+                estimated_tokens,
+                timings,
+                deadline_s=deadline_s,
+                stage="stream",
+            )
+            (stats,) = stream_stats
+            self.log().info(
+                "Streamed %d attributes in %.0f ms, first attribute after %.0f ms%s",
+                len(stats.attribute_s),
+                stats.total_s * 1000,
+                (stats.first_attribute_s or 0) * 1000,
+                ", stopped early" if stats.stopped_early else "",
+            )
+            timings.first_attribute_s = stats.first_attribute_s
+            timings.attribute_s = dict(stats.attribute_s)
+        else:
+            response = self.call_backend(
+                backend_settings,
+                self.completion_call(backend_settings, response_model, messages),
+                estimated_tokens,
+                timings,
+                deadline_s=deadline_s,
+                hedge_percentile=hedge_percentile,
+            )
+            if response_model is not attributes_model:
+                response = expand_response(response, attributes_model)
+
+        if cache_key is not None:
+            with timings.span("cache_store"):
+                get_response_cache().set(cache_key, response.model_dump_json())
+        return response
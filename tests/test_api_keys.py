@@ -0,0 +1,201 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from comfyui_structured_outputs.api_keys import (
+    ApiKey,
+    ApiKeyPool,
+    get_api_key_pool,
+    parse_api_keys,
+)
+from comfyui_structured_outputs.backends import resolve_backend
+from comfyui_structured_outputs.scheduler import RequestScheduler
+
+
+def status_error(
+    status_code: int, headers: dict | None = None
+) -> openai.APIStatusError:
+    response = httpx.Response(
+        status_code,
+        headers=headers or {},
+        request=httpx.Request("POST", "http://test/v1/chat/completions"),
+    )
+    error_class = {
+        401: openai.AuthenticationError,
+        429: openai.RateLimitError,
+        500: openai.InternalServerError,
+    }[status_code]
+    return error_class("Error", response=response, body=None)
+
+
+def test_parse_api_keys():
+    assert parse_api_keys("sk-1, sk-2@org-a ,,") == [
+        ApiKey("sk-1"),
+        ApiKey("sk-2", "org-a"),
+    ]
+    assert parse_api_keys(None) == []
+    assert ApiKey("sk-secret1234", "org").label == "...1234@org"
+
+
+def test_invalid_pool():
+    with pytest.raises(ValueError):
+        ApiKeyPool([])
+    with pytest.raises(ValueError):
+        ApiKeyPool([ApiKey("a")], strategy="random")
+
+
+def test_round_robin():
+    keys = parse_api_keys("a,b,c")
+    pool = ApiKeyPool(keys)
+
+    leased = []
+    for _ in range(6):
+        with pool.lease() as key:
+            leased.append(key.key)
+    assert leased == ["a", "b", "c", "a", "b", "c"]
+    assert pool.stats()["...a"]["successes"] == 2
+
+
+def test_least_loaded():
+    pool = ApiKeyPool(parse_api_keys("a,b"), strategy="least_loaded")
+
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first.key, second.key} == {"a", "b"}
+    pool.release(second)
+    # the released key has nothing in flight
+    assert pool.acquire() == second
+
+
+def test_rate_limited_key_cools_down():
+    pool = ApiKeyPool(parse_api_keys("a,b"))
+
+    with pytest.raises(openai.RateLimitError), pool.lease():
+        raise status_error(429, {"retry-after-ms": "200"})
+    # only the other key is handed out during the cooldown
+    assert [pool.acquire().key for _ in range(3)] == ["b", "b", "b"]
+    assert pool.stats()["...a"]["rate_limited"] == 1
+    assert not pool.stats()["...a"]["available"]
+
+
+def test_rejected_key_is_skipped():
+    pool = ApiKeyPool(parse_api_keys("a,b"))
+
+    with pytest.raises(openai.AuthenticationError), pool.lease():
+        raise status_error(401)
+    assert [pool.acquire().key for _ in range(2)] == ["b", "b"]
+
+
+def test_rejected_keys_fail_at_once():
+    pool = ApiKeyPool(parse_api_keys("a"))
+
+    with pytest.raises(openai.AuthenticationError), pool.lease():
+        raise status_error(401)
+    # the only key is rejected, the next call fails instead of waiting for its cooldown
+    start = time.monotonic()
+    with pytest.raises(openai.AuthenticationError):
+        pool.acquire()
+    with pytest.raises(openai.AuthenticationError):
+        pool.acquire(deadline=time.monotonic() + 60)
+    assert time.monotonic() - start < 0.1
+    assert pool.stats()["...a"]["in_flight"] == 0
+
+    # nor does a scheduled call hold its concurrency slot waiting for the key
+    scheduler = RequestScheduler("test")
+
+    def call():
+        with pool.lease():
+            return "answer"
+
+    with pytest.raises(openai.AuthenticationError):
+        scheduler.run(call)
+    assert scheduler.concurrency.in_flight == 0
+
+
+def test_acquire_deadline():
+    pool = ApiKeyPool(parse_api_keys("a,b"))
+    rejected, limited = pool.acquire(), pool.acquire()
+    pool.release(rejected, status_error(401))
+    pool.release(limited, status_error(429), retry_after_s=10)
+
+    # the rate limited key isn't free by the deadline, and the rejected key isn't waited for
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pool.acquire(deadline=time.monotonic() + 5)
+    assert time.monotonic() - start < 0.1
+
+
+def test_failing_key_backs_off():
+    pool = ApiKeyPool(parse_api_keys("a,b"), strategy="least_loaded")
+
+    for _ in range(3):
+        key = pool.acquire()
+        assert key.key == "a"
+        pool.release(key, status_error(500))
+    assert pool.acquire().key == "b"
+
+
+def test_acquire_waits_when_every_key_cools_down():
+    pool = ApiKeyPool(parse_api_keys("a"))
+    key = pool.acquire()
+    pool.release(key, status_error(429), retry_after_s=0.2)
+
+    start = time.monotonic()
+    assert pool.acquire() == key
+    assert time.monotonic() - start >= 0.15
+
+
+def test_retries_rotate_keys():
+    pool = ApiKeyPool(parse_api_keys("a,b"))
+    scheduler = RequestScheduler("test", pause_on_rate_limit=False)
+    used = []
+
+    def call():
+        with pool.lease() as key:
+            used.append(key.key)
+            if key.key == "a":
+                raise status_error(429, {"retry-after": "10"})
+            return key.key
+
+    start = time.monotonic()
+    assert scheduler.run(call) == "b"
+    assert used == ["a", "b"]
+    # the backend isn't paused for the limited key's cooldown
+    assert time.monotonic() - start < 1
+
+
+def test_pool_is_thread_safe():
+    pool = ApiKeyPool(parse_api_keys("a,b,c"), strategy="least_loaded")
+
+    def lease_many():
+        for _ in range(200):
+            with pool.lease():
+                pass
+
+    threads = [threading.Thread(target=lease_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pool.stats()
+    assert sum(key["successes"] for key in stats.values()) == 1600
+    assert all(key["in_flight"] == 0 for key in stats.values())
+
+
+def test_get_api_key_pool(monkeypatch):
+    monkeypatch.setenv("LLM_API_KEY", "k1@org, k2")
+    monkeypatch.setenv("LLM_KEY_STRATEGY", "least_loaded")
+    settings = resolve_backend("openai_compatible")
+
+    pool = get_api_key_pool(settings)
+    assert pool.keys == [ApiKey("k1", "org"), ApiKey("k2")]
+    assert pool.strategy == "least_loaded"
+    assert get_api_key_pool(settings) is pool
+
+    monkeypatch.delenv("LLM_API_KEY")
+    # falls back to the backend's default key
+    assert get_api_key_pool(settings).keys == [ApiKey("local")]
@@ -7,7 +7,13 @@ from pydantic import BaseModel, ValidationError
 from comfyui_structured_outputs.attribute_utils import (
     BaseAttributeModel,
     BaseAttributesModel,
+    attribute_name,
     attributes_to_model,
+    clear_model_caches,
+    create_attribute_model,
+    merge_attribute_groups,
+    model_json_schema,
+    split_attributes,
     string_to_type,
 )
 
@@ -224,3 +230,115 @@ def test_attributes_to_model_param(attrs, expected_field_names):
     ReturnModel = attributes_to_model(attrs)
     actual_fields = list(ReturnModel.model_fields.keys())
     assert actual_fields == expected_field_names
+
+
+def test_create_attribute_model_is_cached():
+    """
+    Test that identical attribute definitions return the same model class.
+    """
+    model_a = create_attribute_model("color", "str", description="A color")
+    model_b = create_attribute_model("color", "str", None, "A color", None)
+    assert model_a is model_b
+    assert model_a(value="red").key == "color"
+
+    # any difference in the definition produces a new model
+    assert create_attribute_model("color", "str", description="Other") is not model_a
+    assert create_attribute_model("color", "str", options="red, blue") is not model_a
+    assert create_attribute_model("colour", "str", description="A color") is not model_a
+
+
+def test_attributes_to_model_is_cached():
+    """
+    Test that the same attribute set returns the same return model class and JSON schema.
+    """
+    ReturnModel = attributes_to_model([MyStrAttr, MyIntAttr])
+    assert attributes_to_model([MyStrAttr, MyIntAttr]) is ReturnModel
+    assert attributes_to_model([MyIntAttr, MyStrAttr]) is not ReturnModel
+
+    schema = model_json_schema(ReturnModel)
+    assert schema == ReturnModel.model_json_schema()
+    assert model_json_schema(ReturnModel) is schema
+
+
+def test_merge_attribute_groups():
+    """
+    Test that groups are merged in order, with attributes shared by groups asked once.
+    """
+    color = create_attribute_model("color", "str", description="A color")
+    count = create_attribute_model("count", "int")
+    mood = create_attribute_model("mood", "str", options="happy, sad")
+
+    merged, field_names = merge_attribute_groups([[color, count], [color, mood], []])
+    assert merged == [color, count, mood]
+    assert field_names == [
+        {"color": "color", "count": "count"},
+        {"color": "color", "mood": "mood"},
+        {},
+    ]
+
+
+def test_merge_attribute_groups_name_collision():
+    """
+    Test that a name defined differently by a later group is asked under the group's namespace.
+    """
+    color = create_attribute_model("color", "str")
+    other_color = create_attribute_model("color", "int")
+    merged, field_names = merge_attribute_groups([[color], [other_color]])
+
+    assert [attribute_name(attribute) for attribute in merged] == [
+        "color",
+        "g2__color",
+    ]
+    assert field_names == [{"color": "color"}, {"color": "g2__color"}]
+    assert issubclass(merged[1], other_color)
+    assert merged[1].model_fields["value"].annotation is int
+    # the same class on every merge, so the merged return model is cached
+    assert merge_attribute_groups([[color], [other_color]])[0] == merged
+
+
+def test_split_attributes():
+    """
+    Test that each group gets its own return model from the merged response.
+    """
+    color = create_attribute_model("color", "str")
+    count = create_attribute_model("count", "int")
+    mood = create_attribute_model("mood", "str")
+    merged, _ = merge_attribute_groups([[color, count], [mood]])
+    MergedModel = attributes_to_model(merged)
+    response = MergedModel(
+        color=color(value="red"), count=count(value=2), mood=mood(value="calm")
+    )
+
+    first = split_attributes(response, attributes_to_model([color, count]))
+    assert type(first) is attributes_to_model([color, count])
+    assert first.color.value == "red"
+    assert first.count.value == 2
+    second = split_attributes(response, attributes_to_model([mood]))
+    assert list(type(second).model_fields) == ["mood"]
+    assert second.mood.value == "calm"
+    assert split_attributes(response, attributes_to_model([])).model_dump() == {}
+
+
+def test_split_namespaced_attributes():
+    color = create_attribute_model("color", "str")
+    other_color = create_attribute_model("color", "int")
+    merged, field_names = merge_attribute_groups([[color], [other_color]])
+    MergedModel = attributes_to_model(merged)
+    response = MergedModel.model_validate(
+        {"color": {"value": "red"}, "g2__color": {"value": 3}}
+    )
+
+    first = split_attributes(response, attributes_to_model([color]), field_names[0])
+    assert first.color.value == "red"
+    second = split_attributes(
+        response, attributes_to_model([other_color]), field_names[1]
+    )
+    assert type(second.color) is other_color
+    assert second.color.key == "color"
+    assert second.color.value == 3
+
+
+def test_clear_model_caches():
+    model = create_attribute_model("cleared", "int")
+    clear_model_caches()
+    assert create_attribute_model("cleared", "int") is not model
@@ -0,0 +1,165 @@
+import pytest
+
+from comfyui_structured_outputs.api_keys import ApiKey
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.backends import (
+    BACKENDS,
+    get_backend_client,
+    prewarm_from_env,
+    resolve_backend,
+)
+from comfyui_structured_outputs.client_registry import CLIENT_REGISTRY
+from comfyui_structured_outputs.streaming import stream_structured_output
+from comfyui_structured_outputs.stub_backend import placeholder_for_schema
+
+ReturnModel = attributes_to_model(
+    [
+        create_attribute_model("color", "str", example="red"),
+        create_attribute_model("count", "int", options="3, 4"),
+        create_attribute_model("is_cool", "bool"),
+    ]
+)
+
+MESSAGES: list[dict] = [{"role": "user", "content": "Describe the image"}]
+
+
+@pytest.fixture(autouse=True)
+def clear_llm_env(monkeypatch):
+    for key in (
+        "LLM_BACKEND",
+        "LLM_BASE_URL",
+        "LLM_MODEL",
+        "LLM_MODE",
+        "LLM_RPM",
+        "LLM_TPM",
+        "LLM_MAX_CONCURRENCY",
+        "LLM_API_KEY",
+        "PREWARM_CLIENT",
+    ):
+        monkeypatch.delenv(key, raising=False)
+
+
+def test_resolve_backend_defaults():
+    assert resolve_backend("openai") == BACKENDS["openai"]
+    assert resolve_backend("stub").model == "stub"
+
+
+def test_resolve_backend_from_env(monkeypatch):
+    monkeypatch.setenv("LLM_BACKEND", "openai_compatible")
+    monkeypatch.setenv("LLM_MODEL", "qwen2.5-vl")
+    monkeypatch.setenv("LLM_MODE", "json")
+
+    settings = resolve_backend()
+    assert settings.name == "openai_compatible"
+    assert settings.base_url == "http://127.0.0.1:8000/v1"
+    assert settings.model == "qwen2.5-vl"
+    assert settings.mode == "json"
+
+
+def test_resolve_backend_rate_limits(monkeypatch):
+    assert resolve_backend("openai").requests_per_minute is None
+
+    monkeypatch.setenv("LLM_RPM", "500")
+    monkeypatch.setenv("LLM_TPM", "30000")
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY", "4")
+    settings = resolve_backend("openai")
+    assert settings.requests_per_minute == 500
+    assert settings.tokens_per_minute == 30000
+    assert settings.max_concurrency == 4
+
+
+def test_resolve_backend_env_settings_only_apply_to_env_backend(monkeypatch):
+    monkeypatch.setenv("LLM_BACKEND", "openai_compatible")
+    monkeypatch.setenv("LLM_MODEL", "local-model")
+    monkeypatch.setenv("LLM_BASE_URL", "http://127.0.0.1:8080/v1")
+    monkeypatch.setenv("LLM_RPM", "500")
+
+    assert resolve_backend("openai_compatible").model == "local-model"
+    # a node picking another backend gets that backend's settings
+    assert resolve_backend("openai") == BACKENDS["openai"]
+    assert resolve_backend("stub").model == "stub"
+    assert resolve_backend("openai", model="gpt-4o-mini").model == "gpt-4o-mini"
+
+
+def test_resolve_backend_overrides(monkeypatch):
+    monkeypatch.setenv("LLM_BACKEND", "openai_compatible")
+    monkeypatch.setenv("LLM_MODEL", "from-env")
+
+    settings = resolve_backend(
+        "openai_compatible",
+        model="from-node",
+        base_url="http://127.0.0.1:8080/v1",
+        mode="tools",
+    )
+    assert settings.model == "from-node"
+    assert settings.base_url == "http://127.0.0.1:8080/v1"
+    assert settings.mode == "tools"
+    # empty node inputs don't override
+    assert resolve_backend("openai_compatible", model="").model == "from-env"
+
+
+@pytest.mark.parametrize("kwargs", [{"name": "unknown"}, {"mode": "unknown"}])
+def test_resolve_backend_invalid(kwargs):
+    with pytest.raises(ValueError, match="Invalid"):
+        resolve_backend(**{"name": "stub", **kwargs})
+
+
+def test_prewarm_from_env_uses_env_backend(monkeypatch):
+    assert prewarm_from_env() is None
+
+    monkeypatch.setenv("PREWARM_CLIENT", "true")
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    assert prewarm_from_env() is None
+
+    monkeypatch.setenv("LLM_BACKEND", "openai_compatible")
+    # nothing listens on the discard port, so the connection attempt fails immediately
+    monkeypatch.setenv("LLM_BASE_URL", "http://127.0.0.1:9/v1")
+    monkeypatch.setenv("LLM_API_KEY", "sk-first@org-a, sk-second")
+    clients = len(CLIENT_REGISTRY)
+    thread = prewarm_from_env()
+    thread.join(timeout=30)
+    assert len(CLIENT_REGISTRY) == clients + 1
+
+    # the first run gets the pre-warmed client of the first key
+    get_backend_client(resolve_backend(), api_key=ApiKey("sk-first", "org-a"))
+    assert len(CLIENT_REGISTRY) == clients + 1
+
+
+def test_placeholder_for_schema():
+    value = placeholder_for_schema(ReturnModel.model_json_schema())
+
+    assert value["color"] == {"key": "color", "value": "red", "error": None}
+    assert value["count"]["value"] == 3
+    assert value["is_cool"]["value"] is False
+    ReturnModel.model_validate(value)
+
+
+@pytest.mark.parametrize("mode", ["tools", "json", "json_schema"])
+def test_stub_backend_create(mode):
+    settings = resolve_backend("stub", mode=mode)
+    client = get_backend_client(settings)
+
+    response = client.chat.completions.create(
+        model=settings.model, response_model=ReturnModel, messages=MESSAGES
+    )
+    assert isinstance(response, ReturnModel)
+    assert response.count.value == 3
+
+
+@pytest.mark.parametrize("mode", ["tools", "json"])
+def test_stub_backend_streaming(mode):
+    settings = resolve_backend("stub", mode=mode)
+
+    response, stats = stream_structured_output(
+        get_backend_client(settings),
+        ReturnModel,
+        messages=MESSAGES,
+        model=settings.model,
+    )
+    assert isinstance(response, ReturnModel)
+    assert response.color.value == "red"
+    assert stats.chunks > 1
+    assert set(stats.attribute_s) == {"color", "count", "is_cool"}
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from comfyui_structured_outputs.background import (
+    BackgroundJob,
+    PendingResult,
+    resolve,
+    run_in_background,
+    then,
+)
+
+
+def test_results_are_resolved_by_index():
+    release = threading.Event()
+
+    def requests():
+        release.wait(timeout=5)
+        return ["first", "second"]
+
+    handles = run_in_background(requests, count=2)
+    # returns before the requests are done
+    assert not any(handle.done() for handle in handles)
+
+    release.set()
+    assert [resolve(handle) for handle in handles] == ["first", "second"]
+    assert all(handle.done() for handle in handles)
+
+
+def test_resolve_passes_other_values_through():
+    assert resolve("value") == "value"
+    assert resolve(None) is None
+
+
+def test_then_transforms_values_and_handles():
+    assert then(2, lambda value: value * 10) == 20
+
+    release = threading.Event()
+
+    def requests():
+        release.wait(timeout=5)
+        return [1, 2]
+
+    handles = run_in_background(requests, count=2)
+    transformed = [
+        then(then(handle, lambda value: value * 10), str) for handle in handles
+    ]
+    # returns a handle without waiting
+    assert all(isinstance(handle, PendingResult) for handle in transformed)
+
+    release.set()
+    assert [resolve(handle) for handle in transformed] == ["10", "20"]
+    assert [resolve(handle) for handle in handles] == [1, 2]
+
+
+def test_failed_job_runs_again_on_next_resolve():
+    calls = []
+
+    def requests():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("no connection")
+        return ["result"]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handle = PendingResult(BackgroundJob(requests, executor), 0)
+        with pytest.raises(ConnectionError):
+            handle.result()
+        assert handle.result() == "result"
+        # a job that succeeded keeps its results
+        assert handle.result() == "result"
+    assert handle.job.submissions == 2
+
+
+def test_timeout_leaves_job_running():
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        job = BackgroundJob(lambda: [release.wait(timeout=5)], executor)
+        with pytest.raises(FutureTimeoutError):
+            job.result(timeout_s=0.01)
+        release.set()
+        assert job.result() == [True]
+    assert job.submissions == 1
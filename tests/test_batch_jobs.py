@@ -0,0 +1,155 @@
+import json
+
+import httpx
+import instructor
+import pytest
+from openai import OpenAI
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.batch_jobs import BatchJob, BatchJobState
+from comfyui_structured_outputs.stub_backend import (
+    STUB_BASE_URL,
+    StubBatchApi,
+    StubChatCompletions,
+    stub_http_client,
+)
+
+ColorAttr = create_attribute_model("color", "str", options="red, blue")
+ReturnModel = attributes_to_model([ColorAttr])
+
+
+def stub_client(api: StubBatchApi) -> OpenAI:
+    return OpenAI(
+        api_key="stub",
+        base_url=STUB_BASE_URL,
+        http_client=stub_http_client(api),
+        max_retries=0,
+    )
+
+
+def messages_list(count: int) -> list[list[dict]]:
+    return [
+        [{"role": "user", "content": f"question {index}"}] for index in range(count)
+    ]
+
+
+@pytest.mark.parametrize(
+    "mode", [instructor.Mode.TOOLS, instructor.Mode.JSON, instructor.Mode.JSON_SCHEMA]
+)
+def test_batch_job_run(tmp_path, mode):
+    api = StubBatchApi(polls_to_complete=3)
+    job = BatchJob(
+        stub_client(api),
+        ReturnModel,
+        messages_list(3),
+        model="stub",
+        mode=mode,
+        jobs_dir=tmp_path,
+    )
+
+    results = job.run(poll_interval_s=0.001)
+    assert [response.color.value for response in results.responses] == ["red"] * 3
+    assert results.errors == {}
+    assert results.prompt_tokens > 0
+
+    lines = [json.loads(line) for line in job.requests_path.read_text().splitlines()]
+    assert [line["custom_id"] for line in lines] == [
+        "request-0",
+        "request-1",
+        "request-2",
+    ]
+    assert lines[0]["url"] == "/v1/chat/completions"
+    assert lines[0]["body"]["model"] == "stub"
+
+
+def test_batch_job_resumes(tmp_path):
+    api = StubBatchApi(polls_to_complete=2)
+    job = BatchJob(
+        stub_client(api), ReturnModel, messages_list(2), "stub", jobs_dir=tmp_path
+    )
+    batch_id = job.submit()
+    assert job.poll() == "in_progress"
+
+    # e.g. after a restart, the same requests pick up the submitted batch
+    resumed = BatchJob(
+        stub_client(api), ReturnModel, messages_list(2), "stub", jobs_dir=tmp_path
+    )
+    assert resumed.state.batch_id == batch_id
+    assert resumed.run(poll_interval_s=0.001).errors == {}
+    assert len(api.batches) == 1
+
+    # other requests are another job
+    other = BatchJob(
+        stub_client(api), ReturnModel, messages_list(3), "stub", jobs_dir=tmp_path
+    )
+    assert other.fingerprint != job.fingerprint
+    assert other.state.batch_id is None
+
+    # the output was downloaded once, the saved state is enough to read the results
+    api.files.clear()
+    assert BatchJobState.load(resumed.state_path).status == "completed"
+    assert resumed.results().errors == {}
+
+
+@pytest.mark.parametrize("status", ["failed", "expired", "cancelled"])
+def test_batch_job_resubmits_unfinished_batch(tmp_path, status):
+    api = StubBatchApi(polls_to_complete=2)
+    job = BatchJob(
+        stub_client(api), ReturnModel, messages_list(2), "stub", jobs_dir=tmp_path
+    )
+    failed_id = job.submit()
+    api.batches[failed_id]["status"] = status
+    assert job.wait(poll_interval_s=0.001) == status
+    with pytest.raises(ValueError, match="without any output"):
+        job.results()
+
+    # running the same requests again submits a new batch instead of resuming the failed one
+    rerun = BatchJob(
+        stub_client(api), ReturnModel, messages_list(2), "stub", jobs_dir=tmp_path
+    )
+    results = rerun.run(poll_interval_s=0.001)
+    assert [response.color.value for response in results.responses] == ["red"] * 2
+    assert rerun.state.batch_id != failed_id
+    assert len(api.batches) == 2
+
+
+class InvalidSecondAnswer(StubChatCompletions):
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        response = super().__call__(request)
+        if "question 1" in request.content.decode():
+            body = response.json()
+            body["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"] = (
+                '{"color": {"key": "color", "value": "green"}}'
+            )
+            return httpx.Response(200, json=body)
+        return response
+
+
+def test_batch_job_invalid_responses(tmp_path):
+    api = StubBatchApi(InvalidSecondAnswer())
+    job = BatchJob(
+        stub_client(api), ReturnModel, messages_list(3), "stub", jobs_dir=tmp_path
+    )
+
+    results = job.run(poll_interval_s=0.001)
+    assert results.responses[1] is None
+    assert results.responses[0] is not None and results.responses[2] is not None
+    assert list(results.errors) == [1]
+    assert results.errors[1].startswith("Invalid response")
+
+
+def test_batch_job_timeout_and_results_before_completion(tmp_path):
+    api = StubBatchApi(polls_to_complete=100)
+    job = BatchJob(
+        stub_client(api), ReturnModel, messages_list(1), "stub", jobs_dir=tmp_path
+    )
+
+    with pytest.raises(TimeoutError):
+        job.wait(poll_interval_s=0.001, timeout_s=0.01)
+    with pytest.raises(ValueError):
+        job.results()
+    with pytest.raises(ValueError):
+        BatchJob(stub_client(api), ReturnModel, [], "stub", jobs_dir=tmp_path)
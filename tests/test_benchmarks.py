@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import pytest
+
+from benchmarks.bench_startup import PROJECT_DIR, measure_startup
+from benchmarks.harness import (
+    BenchResult,
+    Comparison,
+    compare_results,
+    load_results,
+    save_results,
+    time_fn,
+)
+
+
+def result(median_us: float) -> BenchResult:
+    return BenchResult(
+        median_us=median_us,
+        min_us=median_us,
+        max_us=median_us,
+        calls_per_repeat=1,
+        repeats=1,
+    )
+
+
+def test_time_fn():
+    calls = []
+    bench_result = time_fn(lambda: calls.append(1), repeats=3, min_repeat_s=0.001)
+
+    assert bench_result.repeats == 3
+    # warm up call, plus the timed calls
+    assert len(calls) == 1 + 3 * bench_result.calls_per_repeat
+    assert 0 < bench_result.min_us <= bench_result.median_us <= bench_result.max_us
+
+
+def test_save_and_load_results(tmp_path: Path):
+    results = {"case[1]": result(10.0), "case[2]": result(20.0)}
+    save_results(results, tmp_path / "results" / "latest.json")
+
+    assert load_results(tmp_path / "results" / "latest.json") == results
+
+
+def test_compare_results():
+    comparisons = compare_results(
+        current={"same": result(100.0), "slower": result(150.0), "new": result(1.0)},
+        baseline={"same": result(100.0), "slower": result(100.0), "gone": result(1.0)},
+    )
+
+    assert [comparison.name for comparison in comparisons] == ["same", "slower"]
+    assert not comparisons[0].is_regression()
+    assert comparisons[1].ratio == 1.5
+    assert comparisons[1].is_regression()
+    assert not comparisons[1].is_regression(threshold=0.6)
+
+
+@pytest.mark.parametrize(
+    "baseline_us, current_us, expected",
+    [(100.0, 109.0, False), (100.0, 111.0, True), (0.1, 0.5, False), (0.0, 5.0, False)],
+)
+def test_is_regression(baseline_us, current_us, expected):
+    # differences below the timer noise floor are never regressions
+    assert Comparison("case", baseline_us, current_us).is_regression() == expected
+
+
+def test_startup_does_not_import_heavy_modules():
+    # the library modules the nodes import, the node modules themselves need ComfyUI
+    for module in (
+        "comfyui_structured_outputs.backends",
+        "comfyui_structured_outputs.batch_jobs",
+        "comfyui_structured_outputs.scheduler",
+        "comfyui_structured_outputs.streaming",
+        "comfyui_structured_outputs.utils.image_utils",
+    ):
+        measurement = measure_startup(module=module, path=PROJECT_DIR)
+        assert measurement["loaded_by_import"] == [], module
@@ -0,0 +1,71 @@
+import threading
+
+import instructor
+
+from comfyui_structured_outputs.client_registry import ClientRegistry
+
+
+def test_same_settings_share_client():
+    registry = ClientRegistry()
+    client_a = registry.get("sk-a")
+    client_b = registry.get("sk-a")
+
+    assert client_a is client_b
+    assert len(registry) == 1
+
+
+def test_different_settings_get_different_clients():
+    registry = ClientRegistry()
+    default_client = registry.get("sk-a")
+    other_key_client = registry.get("sk-b")
+    other_url_client = registry.get("sk-a", base_url="http://127.0.0.1:8000/v1")
+    other_mode_client = registry.get("sk-a", mode=instructor.Mode.JSON)
+
+    clients = [default_client, other_key_client, other_url_client, other_mode_client]
+    assert len({id(client) for client in clients}) == 4
+    assert len(registry) == 4
+
+
+def test_clients_share_connection_pool():
+    registry = ClientRegistry()
+    client_a = registry.get("sk-a")
+    client_b = registry.get("sk-b")
+
+    assert client_a.client._client is registry.http_client
+    assert client_b.client._client is registry.http_client
+
+
+def test_concurrent_get_returns_single_client():
+    registry = ClientRegistry()
+    results = []
+
+    def get_client():
+        results.append(registry.get("sk-a"))
+
+    threads = [threading.Thread(target=get_client) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(client) for client in results}) == 1
+
+
+def test_prewarm_failure_does_not_raise():
+    registry = ClientRegistry()
+    # nothing listens on the discard port, so the connection attempt fails immediately
+    thread = registry.prewarm("sk-a", base_url="http://127.0.0.1:9/v1")
+    thread.join(timeout=30)
+
+    assert not thread.is_alive()
+    assert len(registry) == 1
+
+
+def test_clear_closes_pool():
+    registry = ClientRegistry()
+    http_client = registry.http_client
+    registry.get("sk-a")
+    registry.clear()
+
+    assert http_client.is_closed
+    assert len(registry) == 0
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from comfyui_structured_outputs import encoded_image_cache
+from comfyui_structured_outputs.encoded_image_cache import EncodedImageCache
+from comfyui_structured_outputs.utils.image_utils import EncodedImage, encode_image
+
+
+def image(seed: int = 0, size: int = 32) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(1, size, size, 3, generator=generator)
+
+
+def encoded(size_bytes: int) -> EncodedImage:
+    return EncodedImage(
+        data="a" * size_bytes, mime_type="image/png", width=1, height=1, encode_s=0.0
+    )
+
+
+def test_encode_reuses_payload():
+    cache = EncodedImageCache(max_bytes=1 << 20)
+    first = cache.encode(image(), image_format="JPEG", quality=80)
+    second = cache.encode(image(), image_format="jpeg", quality=80)
+
+    assert second.data == first.data
+    assert second.data == encode_image(image(), image_format="JPEG", quality=80).data
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["size_bytes"] == first.size_bytes
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"image_format": "WEBP"},
+        {"image_format": "JPEG", "quality": 50},
+        {"max_side": 16},
+        {"detail": "low"},
+    ],
+)
+def test_encoding_options_are_keyed(options):
+    cache = EncodedImageCache(max_bytes=1 << 20)
+    cache.encode(image())
+    reencoded = cache.encode(image(), **options)
+
+    assert reencoded.data == encode_image(image(), **options).data
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["entries"] == 2
+
+
+def test_other_pixels_miss():
+    cache = EncodedImageCache(max_bytes=1 << 20)
+    cache.encode(image(seed=0))
+    cache.encode(image(seed=1))
+    assert cache.stats()["hits"] == 0
+
+
+def test_evicts_least_recently_used_by_size():
+    cache = EncodedImageCache(max_bytes=250)
+    cache.put("a", encoded(100))
+    cache.put("b", encoded(100))
+    assert cache.get("a") is not None
+    cache.put("c", encoded(100))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["size_bytes"] == 200
+
+
+def test_replacing_entry_updates_size():
+    cache = EncodedImageCache(max_bytes=1000)
+    cache.put("a", encoded(100))
+    cache.put("a", encoded(300))
+    assert cache.stats()["size_bytes"] == 300
+
+
+def test_oversized_payload_is_not_cached():
+    cache = EncodedImageCache(max_bytes=100)
+    cache.put("a", encoded(50))
+    cache.put("b", encoded(200))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+
+def test_disabled_cache_always_encodes():
+    cache = EncodedImageCache(max_bytes=0)
+    cache.encode(image())
+    cache.encode(image())
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["hits"] == 0
+
+
+def test_concurrent_encodes_are_shared(monkeypatch):
+    calls = []
+
+    def slow_encode(image_tensor, **image_options):
+        calls.append(image_options)
+        time.sleep(0.05)
+        return encode_image(image_tensor, **image_options)
+
+    monkeypatch.setattr(encoded_image_cache, "encode_image", slow_encode)
+    cache = EncodedImageCache(max_bytes=1 << 20)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.encode(image())))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len({result.data for result in results}) == 1
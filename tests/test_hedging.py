@@ -0,0 +1,228 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import pytest
+
+from comfyui_structured_outputs.hedging import (
+    HISTOGRAM_MAX_S,
+    CancelToken,
+    LatencyHistogram,
+    cancellable,
+    deadline_kwargs,
+    hedged_call,
+    raise_if_cancelled,
+    remaining_s,
+)
+from comfyui_structured_outputs.metrics import RequestTimings
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) is None
+
+    for _ in range(90):
+        histogram.observe(1.0)
+    for _ in range(10):
+        histogram.observe(10.0)
+
+    assert histogram.count() == 100
+    # bucket upper bounds are within about 12% of the latency
+    assert 1.0 <= histogram.percentile(50) < 1.15
+    assert 1.0 <= histogram.percentile(90) < 1.15
+    assert 10.0 <= histogram.percentile(95) < 11.5
+    assert histogram.percentile(100) == histogram.percentile(95)
+
+
+def test_histogram_clamps_out_of_range_latencies():
+    histogram = LatencyHistogram()
+    histogram.observe(0.0)
+    histogram.observe(10 * HISTOGRAM_MAX_S)
+    assert histogram.percentile(1) == histogram.bounds[0]
+    assert histogram.percentile(100) == histogram.bounds[-1]
+
+
+def test_histogram_drops_old_latencies():
+    clock = FakeClock()
+    histogram = LatencyHistogram(window_s=60, slices=6, clock=clock)
+    for _ in range(10):
+        histogram.observe(10.0)
+    clock.now += 30
+    for _ in range(10):
+        histogram.observe(1.0)
+    assert histogram.count() == 20
+
+    # the first slice leaves the window
+    clock.now += 35
+    assert histogram.count() == 10
+    assert histogram.percentile(99) < 1.15
+
+    clock.now += 60
+    assert histogram.count() == 0
+    assert histogram.percentile(50) is None
+
+
+def test_deadline_helpers():
+    assert remaining_s(None) is None
+    assert deadline_kwargs(None) == {}
+    assert remaining_s(time.monotonic() - 1) == 0.0
+    assert 0 < deadline_kwargs(time.monotonic() + 5)["timeout"] <= 5
+
+
+def test_hedged_call_returns_fast_answer_without_hedging():
+    calls = []
+
+    def call(timings):
+        calls.append(timings)
+        timings.add("network", 0.01)
+        return "answer"
+
+    timings = RequestTimings()
+    assert hedged_call(call, hedge_after_s=1.0, timings=timings) == ("answer", False)
+    assert len(calls) == 1
+    assert not timings.hedged
+    assert timings.stages_s["network"] == 0.01
+
+
+def test_hedged_call_returns_first_answer():
+    release = threading.Event()
+    calls = 0
+
+    def call(timings):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            # the first call is stuck
+            release.wait(timeout=5)
+            return "slow"
+        timings.add("network", 0.02)
+        return "hedged"
+
+    timings = RequestTimings()
+    start = time.perf_counter()
+    try:
+        assert hedged_call(call, hedge_after_s=0.05, timings=timings) == (
+            "hedged",
+            True,
+        )
+    finally:
+        release.set()
+    assert time.perf_counter() - start < 1
+    assert timings.hedged
+    # only the stages of the answering call
+    assert timings.stages_s["network"] == 0.02
+
+
+def test_hedged_call_is_not_sent_without_capacity():
+    calls = 0
+
+    def call(timings):
+        nonlocal calls
+        calls += 1
+        time.sleep(0.1)
+        return "answer"
+
+    timings = RequestTimings()
+    result = hedged_call(
+        call, hedge_after_s=0.01, can_hedge=lambda: False, timings=timings
+    )
+    assert result == ("answer", False)
+    assert calls == 1
+    assert not timings.hedged
+
+
+def test_hedged_call_waits_for_other_call_on_error():
+    calls = 0
+
+    def call(timings):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            time.sleep(0.1)
+            raise ConnectionError("failed")
+        time.sleep(0.2)
+        return "hedged"
+
+    assert hedged_call(call, hedge_after_s=0.01) == ("hedged", True)
+
+
+def test_hedged_call_raises_if_both_fail():
+    def call(timings):
+        time.sleep(0.05)
+        raise ConnectionError("failed")
+
+    with pytest.raises(ConnectionError):
+        hedged_call(call, hedge_after_s=0.01)
+
+
+def test_hedged_call_deadline():
+    release = threading.Event()
+
+    def call(timings):
+        release.wait(timeout=5)
+        return "late"
+
+    start = time.perf_counter()
+    try:
+        with pytest.raises(TimeoutError):
+            hedged_call(call, hedge_after_s=0.02, deadline=time.monotonic() + 0.1)
+    finally:
+        release.set()
+    assert time.perf_counter() - start < 1
+
+
+def test_cancel_token_runs_callbacks_once():
+    released = []
+    token = CancelToken()
+    release = token.once(released.append, "cancelled")
+    done = token.once(released.append, "cancelled")
+
+    done("done")
+    token.cancel()
+    release("done")
+    token.cancel()
+    assert released == ["done", "cancelled"]
+
+    # acquiring after the cancel releases at once
+    with pytest.raises(CancelledError):
+        token.once(released.append, "late")
+    assert released[-1] == "late"
+
+
+def test_cancellable_outside_hedged_call():
+    released = []
+    release = cancellable(released.append)
+    release("done")
+    assert released == ["done"]
+    raise_if_cancelled()
+
+
+def test_hedged_call_cancels_abandoned_call():
+    release = threading.Event()
+    released = []
+    calls = 0
+
+    def call(timings):
+        nonlocal calls
+        calls += 1
+        index = calls
+        done = cancellable(released.append, f"cancelled {index}")
+        if index == 1:
+            release.wait(timeout=5)
+        done(f"done {index}")
+        return index
+
+    try:
+        assert hedged_call(call, hedge_after_s=0.02) == (2, True)
+        # released while the first call is still running
+        assert released == ["done 2", "cancelled 1"]
+    finally:
+        release.set()
@@ -1,8 +1,22 @@
+import numpy as np
+import pytest
 import torch
+from PIL import Image
 
+from comfyui_structured_outputs.utils import image_utils
 from comfyui_structured_outputs.utils.image_utils import (
+    base64_to_pil,
     base64_to_tensor,
+    encode_image,
+    hamming_distance,
+    perceptual_hash,
+    provider_image_size,
+    resize_image,
+    tensor_fingerprint,
     tensor_to_base64,
+    tensor_to_pil_images,
+    tensor_to_uint8,
+    uint8_to_pil_image,
 )
 
 
@@ -44,3 +58,230 @@ def test_round_trip_float():
     assert torch.equal(recovered_image, expected_image), (
         "Recovered image tensor from float conversion does not match the expected uint8 image."
     )
+
+
+@pytest.mark.parametrize(
+    "size, detail, expected",
+    [
+        ((512, 512), "auto", (512, 512)),
+        ((4096, 4096), "high", (768, 768)),
+        ((4096, 2048), "high", (1536, 768)),
+        ((3840, 2160), "auto", (1365, 768)),
+        ((4096, 2048), "low", (512, 256)),
+        ((256, 128), "low", (256, 128)),
+    ],
+)
+def test_provider_image_size(size, detail, expected):
+    """
+    Test that images are fit to the provider's tiling, and never upscaled.
+    """
+    assert provider_image_size(*size, detail=detail) == expected
+
+
+def test_provider_image_size_invalid_detail():
+    with pytest.raises(ValueError, match="Invalid detail"):
+        provider_image_size(512, 512, detail="medium")
+
+
+def test_resize_image_max_side():
+    pil_img = Image.new("RGB", (1000, 500))
+
+    assert resize_image(pil_img) is pil_img
+    assert resize_image(pil_img, max_side=200).size == (200, 100)
+    assert resize_image(pil_img, max_side=2000).size == (1000, 500)
+    assert resize_image(pil_img, max_side=200, detail="low").size == (200, 100)
+    assert resize_image(pil_img, detail="low").size == (512, 256)
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG", "WEBP", "jpeg"])
+def test_encode_image_formats(image_format):
+    """
+    Test that each format encodes to the matching MIME type and decodes back to the same size.
+    """
+    image = torch.rand((1, 64, 96, 3), dtype=torch.float32)
+    encoded = encode_image(image, image_format=image_format, quality=80)
+
+    assert encoded.mime_type == f"image/{image_format.lower()}"
+    assert encoded.data_url.startswith(f"data:image/{image_format.lower()};base64,")
+    assert (encoded.width, encoded.height) == (96, 64)
+    assert encoded.size_bytes == len(encoded.data)
+    assert encoded.encode_s >= 0
+    assert base64_to_pil(encoded.data).size == (96, 64)
+
+
+def test_encode_image_downscales():
+    image = torch.zeros((1, 2160, 3840, 3), dtype=torch.uint8)
+    encoded = encode_image(image, image_format="JPEG", detail="high", max_side=1024)
+
+    assert (encoded.width, encoded.height) == (1024, 576)
+    assert base64_to_pil(encoded.data).size == (1024, 576)
+
+
+def test_encode_image_invalid_format():
+    with pytest.raises(ValueError, match="Invalid image format"):
+        encode_image(torch.zeros((1, 8, 8, 3)), image_format="GIF")
+
+
+def reference_uint8(image: torch.Tensor) -> np.ndarray:
+    # the original per-image conversion
+    return (image.numpy() * 255).clip(0, 255).astype(np.uint8)
+
+
+def test_tensor_to_uint8_uint8_is_view():
+    """
+    Test that uint8 tensors are returned without copying.
+    """
+    image = torch.randint(0, 256, (2, 16, 16, 3), dtype=torch.uint8)
+    array = tensor_to_uint8(image)
+
+    assert np.shares_memory(array, image.numpy())
+    assert np.array_equal(array, image.numpy())
+
+
+@pytest.mark.parametrize("dtype", [torch.int64, torch.int32, torch.int16])
+def test_tensor_to_uint8_other_integers_are_clipped(dtype):
+    image = torch.tensor([-1, 0, 128, 255, 256, 1000], dtype=dtype).reshape(1, 1, 2, 3)
+    expected = np.array([0, 0, 128, 255, 255, 255], dtype=np.uint8).reshape(1, 1, 2, 3)
+
+    assert np.array_equal(tensor_to_uint8(image), expected)
+    out = np.zeros((1, 1, 2, 3), dtype=np.uint8)
+    assert np.array_equal(tensor_to_uint8(image, out=out), expected)
+
+
+def test_tensor_to_uint8_rejects_bool():
+    with pytest.raises(TypeError, match="Unsupported"):
+        tensor_to_uint8(torch.ones((1, 2, 2, 3), dtype=torch.bool))
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64, torch.float16])
+def test_tensor_to_uint8_float_matches_reference(dtype):
+    image = torch.rand((3, 17, 23, 3), dtype=torch.float32) * 1.2 - 0.1
+    image = image.to(dtype)
+    expected = reference_uint8(image.float())
+
+    assert np.array_equal(tensor_to_uint8(image), expected)
+
+
+def test_tensor_to_uint8_chunks(monkeypatch):
+    """
+    Test that the chunked conversion covers every row, when the chunk size doesn't divide the height.
+    """
+    monkeypatch.setattr(image_utils, "CONVERSION_CHUNK_VALUES", 7 * 10 * 3)
+    image = torch.rand((2, 33, 10, 3), dtype=torch.float32)
+
+    assert np.array_equal(tensor_to_uint8(image), reference_uint8(image))
+
+
+def test_tensor_to_uint8_out():
+    image = torch.rand((2, 8, 8, 3), dtype=torch.float32)
+    out = np.zeros((2, 8, 8, 3), dtype=np.uint8)
+
+    assert tensor_to_uint8(image, out=out) is out
+    assert np.array_equal(out, reference_uint8(image))
+
+    with pytest.raises(ValueError, match="Expected out array"):
+        tensor_to_uint8(image, out=np.zeros((1, 8, 8, 3), dtype=np.uint8))
+
+
+def test_tensor_to_pil_images():
+    image = torch.rand((4, 8, 12, 3), dtype=torch.float32)
+    pil_images = tensor_to_pil_images(image)
+
+    assert len(pil_images) == 4
+    for index, pil_img in enumerate(pil_images):
+        assert pil_img.mode == "RGB"
+        assert np.array_equal(np.array(pil_img), reference_uint8(image)[index])
+
+
+@pytest.mark.parametrize("channels, mode", [(1, "L"), (4, "RGBA")])
+def test_uint8_to_pil_image_shares_buffer(channels, mode):
+    array = np.zeros((8, 12, channels), dtype=np.uint8)
+    pil_img = uint8_to_pil_image(array)
+    assert pil_img.mode == mode
+    assert pil_img.size == (12, 8)
+
+    # the image reads from the array's buffer
+    array[0, 0, 0] = 255
+    assert np.array(pil_img).reshape(8, 12, channels)[0, 0, 0] == 255
+
+
+def test_tensor_fingerprint_depends_on_content_shape_and_dtype():
+    # larger than a block, with a partial last block
+    image = torch.rand((2, 130, 130, 3))
+    fingerprint = tensor_fingerprint(image)
+    assert len(fingerprint) == 32
+    assert tensor_fingerprint(image.clone()) == fingerprint
+
+    changed = image.clone()
+    changed[1, 129, 129, 2] += 0.5
+    assert tensor_fingerprint(changed) != fingerprint
+    assert tensor_fingerprint(image.reshape(2, 130, 390, 1)) != fingerprint
+    assert tensor_fingerprint(image.to(torch.float16)) != fingerprint
+    assert tensor_fingerprint(image.to(torch.bfloat16)) != fingerprint
+
+
+def test_tensor_fingerprint_of_non_contiguous_tensor():
+    image = torch.rand((1, 64, 64, 4))
+    view = image[..., :3]
+    assert not view.is_contiguous()
+    assert tensor_fingerprint(view) == tensor_fingerprint(view.contiguous())
+
+
+def test_tensor_fingerprint_sampling():
+    image = torch.rand((1, 512, 512, 3))
+    sampled = tensor_fingerprint(image, sample_stride=4)
+    assert sampled == tensor_fingerprint(image.clone(), sample_stride=4)
+    assert sampled != tensor_fingerprint(image)
+
+    # a change in a block that isn't sampled is missed
+    changed = image.clone()
+    changed.view(-1)[image_utils.FINGERPRINT_BLOCK_BYTES // 4] += 0.5
+    assert tensor_fingerprint(changed, sample_stride=4) == sampled
+    assert tensor_fingerprint(changed) != tensor_fingerprint(image)
+
+    with pytest.raises(ValueError):
+        tensor_fingerprint(image, sample_stride=0)
+
+
+def test_tensor_fingerprint_hashes_lanes_in_parallel(monkeypatch):
+    image = torch.rand((1, 64, 64, 3))
+    fingerprint = tensor_fingerprint(image)
+    monkeypatch.setattr(image_utils, "FINGERPRINT_PARALLEL_BYTES", 0)
+    assert tensor_fingerprint(image) == fingerprint
+
+
+def gradient_image(height: int = 240, width: int = 320) -> torch.Tensor:
+    y, x = torch.meshgrid(
+        torch.linspace(0, 1, height), torch.linspace(0, 1, width), indexing="ij"
+    )
+    return torch.stack(
+        [torch.sin(x * 7 + y * 3) * 0.5 + 0.5, torch.cos(y * 5) * 0.5 + 0.5, x * y],
+        dim=-1,
+    )[None]
+
+
+def test_perceptual_hash_of_near_duplicates():
+    image = gradient_image()
+    hash_value = perceptual_hash(image)
+    assert 0 <= hash_value < 1 << image_utils.PERCEPTUAL_HASH_BITS
+
+    reencoded = base64_to_tensor(encode_image(image, "JPEG", quality=50).data)
+    cropped = image[:, 4:-4, 6:-6]
+    noisy = (image + torch.randn_like(image) * 0.03).clamp(0, 1)
+    for near_duplicate in (reencoded, cropped, noisy):
+        assert hamming_distance(hash_value, perceptual_hash(near_duplicate)) <= 4
+
+    assert hamming_distance(hash_value, perceptual_hash(image.flip(2))) > 16
+    assert (
+        hamming_distance(hash_value, perceptual_hash(torch.rand(1, 240, 320, 3))) > 16
+    )
+
+
+def test_perceptual_hash_of_grayscale_and_large_images():
+    image = gradient_image(1200, 1600)
+    gray = image.mean(dim=-1, keepdim=True)
+    assert hamming_distance(perceptual_hash(image), perceptual_hash(gray)) <= 8
+    # only the first image of a batch is hashed
+    assert perceptual_hash(
+        torch.cat([image, torch.rand_like(image)])
+    ) == perceptual_hash(image)
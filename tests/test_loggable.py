@@ -0,0 +1,96 @@
+import json
+import logging
+from logging import handlers
+from pathlib import Path
+
+import pytest
+
+from comfyui_structured_outputs.utils.loggable import Loggable, lazy
+from logs import LOGS_DIR
+
+
+@pytest.fixture
+def restore_logs():
+    yield
+    # back to the session's setup, see conftest.py
+    Loggable.setup_logs(log_path=LOGS_DIR / "tests.log")
+
+
+def queue_handlers() -> list[logging.Handler]:
+    return [
+        handler
+        for handler in logging.getLogger().handlers
+        if isinstance(handler, handlers.QueueHandler)
+    ]
+
+
+def test_setup_logs_replaces_previous_setup(tmp_path: Path, restore_logs):
+    log_path = tmp_path / "test.log"
+    Loggable.setup_logs(log_path=log_path)
+    Loggable.setup_logs(log_path=log_path)
+    assert len(queue_handlers()) == 1
+
+    Loggable.log().info("written once")
+    Loggable.shutdown_logs()
+    assert queue_handlers() == []
+    assert log_path.read_text().count("written once") == 1
+
+
+def test_json_file_logs(tmp_path: Path, restore_logs):
+    log_path = tmp_path / "test.log"
+    Loggable.setup_logs(log_path=log_path, json_file=True)
+    Loggable.log().debug("request %s done", 3, extra={"duration_ms": 12.5})
+    try:
+        raise ValueError("failed")
+    except ValueError:
+        Loggable.log().exception("request failed")
+    Loggable.shutdown_logs()
+
+    done, failed = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert done["message"] == "request 3 done"
+    assert done["level"] == "DEBUG"
+    assert done["logger"] == "Loggable"
+    assert done["duration_ms"] == 12.5
+    assert failed["message"] == "request failed"
+    assert "ValueError: failed" in failed["exception"]
+
+
+def test_exceptions_are_written_to_text_logs(tmp_path: Path, restore_logs):
+    log_path = tmp_path / "test.log"
+    Loggable.setup_logs(log_path=log_path)
+    try:
+        raise ValueError("failed")
+    except ValueError:
+        Loggable.log().exception("request failed")
+    Loggable.shutdown_logs()
+
+    text = log_path.read_text()
+    assert "request failed" in text
+    assert "ValueError: failed" in text
+
+
+def test_lazy_arguments_are_only_computed_when_enabled(
+    tmp_path: Path, restore_logs, monkeypatch
+):
+    calls = []
+
+    def stats():
+        calls.append(1)
+        return {"hits": 1}
+
+    log_path = tmp_path / "test.log"
+    Loggable.setup_logs(
+        log_path=log_path, console_log_level=logging.INFO, file_log_level=logging.INFO
+    )
+    # the handlers pytest adds to the root logger take debug records too
+    for handler in logging.getLogger().handlers:
+        if handler not in queue_handlers():
+            monkeypatch.setattr(handler, "level", logging.INFO)
+    Loggable.log().debug("stats: %s", lazy(stats))
+    assert calls == []
+    # other handlers of the root logger still get debug records
+    assert logging.getLogger().level == logging.DEBUG
+    Loggable.log().info("stats: %s", lazy(stats))
+    assert calls == [1]
+    Loggable.shutdown_logs()
+    assert "stats: {'hits': 1}" in log_path.read_text()
@@ -0,0 +1,150 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.backends import get_backend_client, resolve_backend
+from comfyui_structured_outputs.metrics import (
+    METRICS_PREFIX,
+    MetricsRegistry,
+    RequestTimings,
+    get_metrics,
+    instrument_client,
+    record_request,
+    track_request,
+)
+
+ReturnModel = attributes_to_model([create_attribute_model("color", "str")])
+
+
+@pytest.fixture
+def registry() -> MetricsRegistry:
+    return MetricsRegistry(buckets=(0.1, 1.0, float("inf")))
+
+
+def test_counters(registry: MetricsRegistry):
+    registry.inc("requests_total", backend="stub")
+    registry.inc("requests_total", 2, backend="stub")
+    registry.inc("requests_total", backend="openai")
+
+    assert registry.counter_value("requests_total", backend="stub") == 3
+    assert registry.counter_value("requests_total", backend="openai") == 1
+    assert registry.counter_value("requests_total", backend="other") == 0
+
+
+def test_histogram_prometheus_format(registry: MetricsRegistry):
+    registry.describe("stage_seconds", "Time per stage")
+    for value in (0.05, 0.5, 5.0):
+        registry.observe("stage_seconds", value, stage="network")
+
+    text = registry.to_prometheus()
+    assert "# HELP stage_seconds Time per stage" in text
+    assert "# TYPE stage_seconds histogram" in text
+    # buckets are cumulative
+    assert 'stage_seconds_bucket{stage="network",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="network",le="1"} 2' in text
+    assert 'stage_seconds_bucket{stage="network",le="+Inf"} 3' in text
+    assert 'stage_seconds_count{stage="network"} 3' in text
+    assert 'stage_seconds_sum{stage="network"} 5.55' in text
+
+
+def test_label_values_are_escaped(registry: MetricsRegistry):
+    registry.inc("requests_total", backend='say "hi"\\')
+    assert 'requests_total{backend="say \\"hi\\"\\\\"} 1' in registry.to_prometheus()
+
+
+@pytest.mark.parametrize("file_name", ["metrics.json", "metrics.prom"])
+def test_write(registry: MetricsRegistry, tmp_path: Path, file_name: str):
+    registry.inc("requests_total", backend="stub")
+    registry.observe("stage_seconds", 0.5, stage="encode")
+    path = tmp_path / "out" / file_name
+    registry.write(path)
+
+    content = path.read_text()
+    if path.suffix == ".json":
+        data = json.loads(content)
+        assert data["counters"]["requests_total"][0]["value"] == 1
+        assert data["histograms"]["stage_seconds"][0]["buckets"]["1.0"] == 1
+    else:
+        assert content == registry.to_prometheus()
+    # no temporary files are left behind
+    assert [file.name for file in path.parent.iterdir()] == [file_name]
+
+
+def test_request_timings_to_dict():
+    timings = RequestTimings()
+    timings.add("total", 0.25)
+    timings.add("encode", 0.1)
+    timings.add("encode", 0.05)
+
+    assert timings.to_dict()["stages_ms"] == {"encode": 150.0, "total": 250.0}
+    # stages are in the order they run
+    assert list(timings.to_dict()["stages_ms"]) == ["encode", "total"]
+    assert timings.to_dict()["first_attribute_ms"] is None
+    assert timings.to_dict()["attribute_ms"] == {}
+
+
+def test_first_attribute_time_is_recorded():
+    timings = RequestTimings(first_attribute_s=0.2, attribute_s={"color": 0.2})
+    assert timings.to_dict()["first_attribute_ms"] == 200.0
+    assert timings.to_dict()["attribute_ms"] == {"color": 200.0}
+
+    record_request(timings, "first_attribute_test", "success")
+    (series,) = [
+        series
+        for series in get_metrics().to_dict()["histograms"][
+            f"{METRICS_PREFIX}_first_attribute_seconds"
+        ]
+        if series["labels"] == {"backend": "first_attribute_test"}
+    ]
+    assert series["count"] == 1
+    assert series["sum"] == 0.2
+
+
+def test_track_request_times_api_calls():
+    settings = resolve_backend("stub", mode="tools")
+    client = get_backend_client(settings)
+    instrument_client(client)
+    # instrumenting twice doesn't double count
+    instrument_client(client)
+    before = get_metrics().counter_value(
+        f"{METRICS_PREFIX}_requests_total", backend="metrics_test", outcome="success"
+    )
+
+    with track_request("metrics_test") as timings:
+        _, completion = client.chat.completions.create_with_completion(
+            model=settings.model,
+            response_model=ReturnModel,
+            messages=[{"role": "user", "content": "Describe"}],
+        )
+        timings.record_usage(completion.usage)
+
+    assert timings.attempts == 1
+    assert 0 < timings.stages_s["network"] <= timings.stages_s["total"]
+    assert timings.prompt_tokens > 0
+    assert (
+        get_metrics().counter_value(
+            f"{METRICS_PREFIX}_requests_total",
+            backend="metrics_test",
+            outcome="success",
+        )
+        == before + 1
+    )
+
+
+def test_track_request_records_errors():
+    with pytest.raises(RuntimeError), track_request("metrics_error_test"):
+        raise RuntimeError("failed")
+
+    assert (
+        get_metrics().counter_value(
+            f"{METRICS_PREFIX}_requests_total",
+            backend="metrics_error_test",
+            outcome="error",
+        )
+        >= 1
+    )
@@ -0,0 +1,58 @@
+import random
+
+from comfyui_structured_outputs.near_duplicates import BKTree, NearDuplicateIndex
+from comfyui_structured_outputs.utils.image_utils import hamming_distance
+
+
+def test_bk_tree_search_matches_a_scan():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(500)]
+    # a few near-duplicates of the first hash
+    hashes += [hashes[0] ^ (1 << bit) ^ (1 << (bit + 7)) for bit in range(5)]
+    tree = BKTree(hashes[0], "key-0")
+    for index, hash_value in enumerate(hashes[1:], start=1):
+        tree.add(hash_value, f"key-{index}")
+
+    for query in (hashes[0], hashes[42], rng.getrandbits(64)):
+        for max_distance in (0, 2, 10, 24):
+            expected = sorted(
+                (hamming_distance(query, hash_value), f"key-{index}")
+                for index, hash_value in enumerate(hashes)
+                if hamming_distance(query, hash_value) <= max_distance
+            )
+            assert sorted(tree.search(query, max_distance)) == expected
+
+
+def test_bk_tree_keeps_every_key_of_a_hash():
+    tree = BKTree(0b1010, "a")
+    tree.add(0b1010, "b")
+    assert sorted(tree.search(0b1010, 0)) == [(0, "a"), (0, "b")]
+
+
+def test_index_returns_nearest_cached_response():
+    index = NearDuplicateIndex()
+    responses = {"far": "far response", "near": "near response"}
+    index.add("context", 0b1111_0000, "far")
+    index.add("context", 0b1111_0001, "near")
+    index.add("context", 0b1111_0011, "in flight")
+
+    assert index.get("context", 0b1111_0011, 3, responses.get) == ("near response", 1)
+    assert index.get("context", 0b0000_1111, 3, responses.get) is None
+    # other request contexts never match
+    assert index.get("other context", 0b1111_0001, 3, responses.get) is None
+
+    stats = index.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["hit_rate"] == 1 / 3
+    assert stats["entries"] == 3
+
+
+def test_index_evicts_oldest_entries():
+    index = NearDuplicateIndex(max_entries=4)
+    for key in range(10):
+        index.add("context", key, str(key))
+
+    assert index.stats()["entries"] == 4
+    found = {key for _, key in index.find("context", 0, 64)}
+    assert found == {"6", "7", "8", "9"}
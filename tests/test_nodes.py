@@ -0,0 +1,409 @@
+import itertools
+import json
+import time
+
+import instructor
+import openai
+import pytest
+import torch
+
+from benchmarks.harness import import_project_module
+
+STRUCTURED_MODES: tuple[instructor.Mode, ...] = (
+    instructor.Mode.TOOLS,
+    instructor.Mode.JSON,
+    instructor.Mode.JSON_SCHEMA,
+)
+
+
+# nodes use relative imports of the plugin package, so they are imported the way ComfyUI does, with their own
+# copy of the plugin package
+@pytest.fixture(scope="module")
+def structured_output():
+    return import_project_module("nodes.structured_output")
+
+
+@pytest.fixture(scope="module")
+def attribute_utils():
+    return import_project_module("comfyui_structured_outputs.attribute_utils")
+
+
+@pytest.fixture(scope="module")
+def background():
+    return import_project_module("comfyui_structured_outputs.background")
+
+
+@pytest.fixture
+def stub_api(monkeypatch, tmp_path):
+    """
+    Answers the stub backend's calls of the nodes, returning the Batch API handler, whose `chat` has the chat
+    completion requests it answered.
+    """
+    backends = import_project_module("comfyui_structured_outputs.backends")
+    batch_jobs = import_project_module("comfyui_structured_outputs.batch_jobs")
+    scheduler = import_project_module("comfyui_structured_outputs.scheduler")
+    stub_backend = import_project_module("comfyui_structured_outputs.stub_backend")
+    api = stub_backend.StubBatchApi()
+    clients = {
+        mode: instructor.from_openai(
+            openai.OpenAI(
+                api_key="stub",
+                base_url=stub_backend.STUB_BASE_URL,
+                http_client=stub_backend.stub_http_client(api),
+                max_retries=0,
+            ),
+            mode=mode,
+        )
+        for mode in STRUCTURED_MODES
+    }
+    monkeypatch.setattr(backends, "_stub_clients", clients)
+    # batch jobs resume by their requests, so each test gets its own jobs
+    monkeypatch.setattr(batch_jobs, "BATCH_JOBS_DIR", tmp_path / "batch_jobs")
+    # and its own schedulers, with their own latency histograms
+    monkeypatch.setattr(scheduler, "_schedulers", {})
+    return api
+
+
+@pytest.fixture(autouse=True)
+def clear_llm_env(monkeypatch):
+    for key in ("LLM_BACKEND", "LLM_BASE_URL", "LLM_MODEL", "LLM_MODE"):
+        monkeypatch.delenv(key, raising=False)
+
+
+@pytest.fixture
+def color(attribute_utils):
+    return attribute_utils.create_attribute_model("color", "str", example="red")
+
+
+def widget_values(node_class) -> dict:
+    """The widget values ComfyUI passes to `IS_CHANGED`, linked inputs (e.g. images, attributes) never are."""
+    input_types = node_class.INPUT_TYPES()
+    values = {}
+    for name, (input_type, options) in {
+        **input_types["required"],
+        **input_types["optional"],
+    }.items():
+        if isinstance(input_type, list):
+            values[name] = [options["default"]]
+        elif input_type in ("STRING", "INT", "FLOAT", "BOOLEAN"):
+            values[name] = [options.get("default", "")]
+    return values
+
+
+def test_is_changed_tracks_env_settings(structured_output, monkeypatch):
+    node_class = structured_output.StructuredOutputNode
+    values = widget_values(node_class)
+    assert "image_in" not in values
+    assert "attributes" not in values
+
+    unchanged = node_class.IS_CHANGED(**values)
+    assert node_class.IS_CHANGED(**values) == unchanged
+
+    monkeypatch.setenv("LLM_MODEL", "another-model")
+    assert node_class.IS_CHANGED(**values) != unchanged
+
+
+def test_is_changed_reports_invalid_settings(structured_output):
+    node_class = structured_output.StructuredOutputNode
+    values = {**widget_values(node_class), "structured_mode": ["invalid"]}
+    assert "invalid" in node_class.IS_CHANGED(**values)
+
+
+@pytest.mark.parametrize("in_background", [False, True])
+def test_fused_node_splits_groups(attribute_utils, background, stub_api, in_background):
+    fused = import_project_module("nodes.fused_structured_output")
+    create = attribute_utils.create_attribute_model
+    color = create("color", "str", example="red")
+    count = create("count", "int", options="3, 4")
+    other_color = create("color", "int", options="7, 8")
+
+    *outputs, _ = fused.FusedStructuredOutputNode().get_fused_structured_output(
+        ["Describe the image"],
+        [color, count],
+        attributes_2=[other_color],
+        backend=["stub"],
+        use_cache=[False],
+        background=[in_background],
+    )
+
+    assert len(outputs) == fused.FUSED_GROUP_COUNT
+    # one output per group and result, empty for the unconnected groups
+    assert [len(output) for output in outputs] == [1] * fused.FUSED_GROUP_COUNT
+    first, second, third, fourth = [background.resolve(output[0]) for output in outputs]
+    assert (first.color.value, first.count.value) == ("red", 3)
+    assert second.color.key == "color"
+    assert second.color.value == 7
+    assert third.model_dump() == fourth.model_dump() == {}
+    # one request answered every group
+    assert len(stub_api.chat.requests) == 1
+
+
+def test_batch_api_fails_fast_with_batch_id(
+    structured_output, attribute_utils, stub_api, monkeypatch
+):
+    monkeypatch.setenv("LLM_BATCH_POLL_S", "0.01")
+    stub_api.polls_to_complete = 1000
+    color = attribute_utils.create_attribute_model("color", "str", example="red")
+    images = [torch.rand(2, 8, 8, 3)]
+    node = structured_output.StructuredOutputNode()
+
+    def run():
+        return node.get_structured_output(
+            ["Describe the image"],
+            [color],
+            image_in=images,
+            batch_mode=[True],
+            batch_api=[True],
+            batch_max_wait_s=[0.05],
+            use_cache=[False],
+            backend=["stub"],
+        )
+
+    with pytest.raises(TimeoutError, match="Batch 'batch_.*' is still"):
+        run()
+    (batch_id,) = stub_api.batches
+
+    # the next run resumes the job
+    stub_api.polls_to_complete = 1
+    results, _ = run()
+    assert [result.color.value for result in results] == ["red", "red"]
+    assert list(stub_api.batches) == [batch_id]
+    # the lines of the batch, none made again in real time
+    assert len(stub_api.chat.requests) == 2
+
+
+def run_node(structured_output, color, images: torch.Tensor | None = None, **kwargs):
+    """
+    Runs the Structured Output Node on the stub backend, uncached unless `use_cache` is given, with the other
+    inputs as ComfyUI passes them.
+    """
+    return structured_output.StructuredOutputNode().get_structured_output(
+        ["Describe the image"],
+        [color],
+        image_in=None if images is None else [images],
+        **{
+            name: [value]
+            for name, value in {"backend": "stub", "use_cache": False, **kwargs}.items()
+        },
+    )
+
+
+def test_single_request(structured_output, color, stub_api):
+    results, timings = run_node(structured_output, color, torch.rand(3, 8, 8, 3))
+    # without batch mode only the first image is sent
+    assert [result.color.value for result in results] == ["red"]
+    assert json.loads(timings[0])["attempts"] == 1
+    assert len(stub_api.chat.requests) == 1
+
+
+def test_batch_mode(structured_output, color, stub_api):
+    results, timings = run_node(
+        structured_output, color, torch.rand(3, 8, 8, 3), batch_mode=True
+    )
+    assert [result.color.value for result in results] == ["red"] * 3
+    assert len(timings) == 3
+    assert len(stub_api.chat.requests) == 3
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_usage_is_recorded_and_settled(
+    structured_output, color, stub_api, monkeypatch, stream
+):
+    scheduler = import_project_module("comfyui_structured_outputs.scheduler")
+    settled = []
+    monkeypatch.setattr(
+        scheduler.RequestScheduler,
+        "settle_tokens",
+        lambda self, estimated, used: settled.append((estimated, used)),
+    )
+    _, timings = run_node(
+        structured_output, color, torch.rand(1, 8, 8, 3), streaming=stream
+    )
+
+    timings = json.loads(timings[0])
+    assert timings["prompt_tokens"] > 0
+    assert timings["completion_tokens"] > 0
+    # the tokens taken for the call are trued up with its usage
+    assert settled == [
+        (settled[0][0], timings["prompt_tokens"] + timings["completion_tokens"])
+    ]
+    assert len(stub_api.chat.requests) == 1
+
+
+@pytest.mark.parametrize("coalesce", [True, False])
+def test_coalescing(structured_output, color, stub_api, coalesce):
+    stub_api.chat.latency_s = 0.2
+    results, timings = run_node(
+        structured_output,
+        color,
+        torch.rand(1, 8, 8, 3).expand(3, -1, -1, -1),
+        batch_mode=True,
+        coalesce=coalesce,
+    )
+    assert [result.color.value for result in results] == ["red"] * 3
+    # each image gets its own copy of the result
+    assert len({id(result) for result in results}) == 3
+    coalesced = [json.loads(timing)["coalesced"] for timing in timings]
+    if coalesce:
+        assert sorted(coalesced) == [False, True, True]
+        assert len(stub_api.chat.requests) == 1
+    else:
+        assert coalesced == [False] * 3
+        assert len(stub_api.chat.requests) == 3
+
+
+def test_streaming_times_attributes(structured_output, attribute_utils, stub_api):
+    count = attribute_utils.create_attribute_model("count", "int", options="3, 4")
+    results, timings = structured_output.StructuredOutputNode().get_structured_output(
+        ["Describe the image"],
+        [attribute_utils.create_attribute_model("color", "str", example="red"), count],
+        backend=["stub"],
+        use_cache=[False],
+        streaming=[True],
+    )
+
+    assert (results[0].color.value, results[0].count.value) == ("red", 3)
+    timings = json.loads(timings[0])
+    assert list(timings["attribute_ms"]) == ["color", "count"]
+    assert timings["first_attribute_ms"] == timings["attribute_ms"]["color"]
+    assert len(stub_api.chat.requests) == 1
+
+
+def test_coalesced_call_rechecks_cache(structured_output, color, stub_api, monkeypatch):
+    response_cache = import_project_module("comfyui_structured_outputs.response_cache")
+    cache = response_cache.ResponseCache(path=None)
+    monkeypatch.setattr(response_cache, "_response_cache", cache)
+    images = torch.rand(1, 8, 8, 3)
+    run_node(structured_output, color, images, use_cache=True)
+    assert len(stub_api.chat.requests) == 1
+
+    # an identical request answered between the lookup and the call isn't made again
+    lookups = []
+    cache_get = cache.get
+
+    def get(key):
+        lookups.append(key)
+        # the first lookup is made before the identical request was cached
+        return None if len(lookups) == 1 else cache_get(key)
+
+    monkeypatch.setattr(cache, "get", get)
+    results, timings = run_node(structured_output, color, images, use_cache=True)
+    assert results[0].color.value == "red"
+    assert json.loads(timings[0])["cache_hit"]
+    assert len(lookups) == 2
+    assert len(stub_api.chat.requests) == 1
+
+
+@pytest.mark.parametrize("pack_size", [1, 2])
+def test_images_are_hashed_once(
+    structured_output, color, stub_api, monkeypatch, pack_size
+):
+    response_cache = import_project_module("comfyui_structured_outputs.response_cache")
+    encoded_image_cache = import_project_module(
+        "comfyui_structured_outputs.encoded_image_cache"
+    )
+    monkeypatch.setattr(
+        response_cache, "_response_cache", response_cache.ResponseCache(path=None)
+    )
+    hashed = []
+    tensor_fingerprint = structured_output.tensor_fingerprint
+
+    def counting_fingerprint(image, *args, **kwargs):
+        hashed.append(image)
+        return tensor_fingerprint(image, *args, **kwargs)
+
+    for module in (structured_output, encoded_image_cache):
+        monkeypatch.setattr(module, "tensor_fingerprint", counting_fingerprint)
+
+    # the hash keys the response cache, request coalescing and the encoded image cache
+    results, _ = run_node(
+        structured_output,
+        color,
+        torch.rand(4, 8, 8, 3),
+        batch_mode=True,
+        use_cache=True,
+        pack_size=pack_size,
+    )
+    assert [result.color.value for result in results] == ["red"] * 4
+    assert len(hashed) == 4
+
+
+def test_packing(structured_output, color, stub_api):
+    results, _ = run_node(
+        structured_output, color, torch.rand(5, 8, 8, 3), batch_mode=True, pack_size=3
+    )
+    assert [result.color.value for result in results] == ["red"] * 5
+    # packs of 3 and 2 images, the stub answers the first image of each pack, and the other 3 are sent on their own
+    packed = [
+        request
+        for request in stub_api.chat.requests
+        if "Image 0:" in json.dumps(request["messages"])
+    ]
+    assert len(packed) == 2
+    assert len(stub_api.chat.requests) == 5
+
+
+def test_background(structured_output, color, background, stub_api):
+    stub_api.chat.latency_s = 0.1
+    pending, timings = run_node(
+        structured_output,
+        color,
+        torch.rand(2, 8, 8, 3),
+        batch_mode=True,
+        background=True,
+    )
+    assert len(pending) == 2
+    assert [json.loads(timing) for timing in timings] == [{"background": True}] * 2
+    results = [background.resolve(result) for result in pending]
+    assert [result.color.value for result in results] == ["red"] * 2
+    assert len(stub_api.chat.requests) == 2
+
+
+def test_deadline_and_hedging(structured_output, color, stub_api):
+    hedging = import_project_module("comfyui_structured_outputs.hedging")
+    chat = stub_api.chat
+    request_timeouts = []
+    slow_calls = set()
+    calls = itertools.count()
+
+    def handler(request):
+        request_timeouts.append(request.extensions["timeout"]["read"])
+        if next(calls) in slow_calls:
+            time.sleep(1)
+        return chat(request)
+
+    stub_api.chat = handler
+    # the latency of the backend is observed before hedging
+    warmup = hedging.MIN_HEDGE_SAMPLES
+    run_node(structured_output, color, torch.rand(warmup, 8, 8, 3), batch_mode=True)
+    assert len(chat.requests) == warmup
+
+    # a stuck call is hedged, and the answer of the duplicate returned
+    slow_calls.add(warmup)
+    start = time.perf_counter()
+    results, timings = run_node(
+        structured_output,
+        color,
+        torch.rand(1, 8, 8, 3),
+        deadline_s=5.0,
+        hedge_percentile=90,
+    )
+    assert time.perf_counter() - start < 1
+    assert results[0].color.value == "red"
+    assert json.loads(timings[0])["hedged"]
+    # the deadline is the timeout of the HTTP calls
+    assert 0 < request_timeouts[-1] <= 5
+    assert len(request_timeouts) == warmup + 2
+
+    # the deadline bounds the call and its hedge when both are stuck
+    slow_calls.update({warmup + 2, warmup + 3})
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        run_node(
+            structured_output,
+            color,
+            torch.rand(1, 8, 8, 3),
+            deadline_s=0.3,
+            hedge_percentile=90,
+        )
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,78 @@
+import pytest
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.packing import (
+    build_packed_messages,
+    pack,
+    packed_model,
+    unpack_results,
+)
+from comfyui_structured_outputs.utils.image_utils import EncodedImage
+
+ColorAttr = create_attribute_model("color", "str", options="red, blue")
+ReturnModel = attributes_to_model([ColorAttr])
+
+
+def encoded_image(data: str = "aW1hZ2U=") -> EncodedImage:
+    return EncodedImage(
+        data=data,
+        mime_type="image/png",
+        width=8,
+        height=8,
+        encode_s=0.0,
+    )
+
+
+def packed_response(*indices: int) -> dict:
+    return {
+        "results": [
+            {"index": index, "attributes": {"color": {"key": "color", "value": "red"}}}
+            for index in indices
+        ]
+    }
+
+
+def test_packed_model():
+    model = packed_model(ReturnModel)
+    assert packed_model(ReturnModel) is model
+
+    schema = model.model_json_schema()
+    assert schema["properties"]["results"]["type"] == "array"
+    packed = model.model_validate(packed_response(0, 1))
+    assert isinstance(packed.results[1].attributes, ReturnModel)
+
+
+def test_build_packed_messages():
+    images = [encoded_image("YQ=="), encoded_image("Yg==")]
+    content = build_packed_messages("Describe", images, detail="low")[0]["content"]
+
+    assert content[0]["text"].startswith("Describe")
+    assert "numbered from 0 to 1" in content[0]["text"]
+    assert [part["text"] for part in content if part["type"] == "text"][1:] == [
+        "Image 0:",
+        "Image 1:",
+    ]
+    image_parts = [part for part in content if part["type"] == "image_url"]
+    assert image_parts[1]["image_url"] == {
+        "url": images[1].data_url,
+        "detail": "low",
+    }
+
+
+def test_unpack_results_drops_invalid_indices():
+    packed = packed_model(ReturnModel).model_validate(packed_response(2, 0, 0, 5, -1))
+    results = unpack_results(packed, count=4)
+
+    # 1 and 3 are missing, the repeated 0 and the out of range indices are dropped
+    assert sorted(results) == [0, 2]
+    assert results[0] is packed.results[1].attributes
+
+
+def test_pack():
+    assert pack([0, 1, 2, 3, 4], 2) == [[0, 1], [2, 3], [4]]
+    assert pack([], 3) == []
+    with pytest.raises(ValueError):
+        pack([0], 0)
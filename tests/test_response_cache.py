@@ -0,0 +1,148 @@
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+from comfyui_structured_outputs import response_cache
+from comfyui_structured_outputs.response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache_path(tmp_path: Path) -> Path:
+    return tmp_path / "responses.sqlite3"
+
+
+def test_make_key_depends_on_all_inputs():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+    schema = {"title": "ReturnModel"}
+    key = ResponseCache.make_key("gpt-4o", messages, schema)
+
+    assert key == ResponseCache.make_key("gpt-4o", messages, schema)
+    assert key != ResponseCache.make_key("gpt-4o-mini", messages, schema)
+    assert key != ResponseCache.make_key("gpt-4o", [], schema)
+    assert key != ResponseCache.make_key("gpt-4o", messages, {"title": "Other"})
+    assert key != ResponseCache.make_key(
+        "gpt-4o", messages, schema, image_bytes=b"\x00" * 12, image_shape=(1, 2, 2, 3)
+    )
+    assert ResponseCache.make_key(
+        "gpt-4o", messages, schema, image_bytes=b"\x00" * 12, image_shape=(1, 2, 2, 3)
+    ) != ResponseCache.make_key(
+        "gpt-4o", messages, schema, image_bytes=b"\x00" * 12, image_shape=(1, 4, 1, 3)
+    )
+    assert key != ResponseCache.make_key(
+        "gpt-4o", messages, schema, image_fingerprint="a" * 32
+    )
+    assert ResponseCache.make_key(
+        "gpt-4o", messages, schema, image_fingerprint="a" * 32
+    ) != ResponseCache.make_key("gpt-4o", messages, schema, image_fingerprint="b" * 32)
+
+
+def test_memory_hit_and_miss():
+    cache = ResponseCache(path=None)
+
+    assert cache.get("key") is None
+    cache.set("key", '{"a": 1}')
+    assert cache.get("key") == '{"a": 1}'
+
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_memory_lru_eviction():
+    cache = ResponseCache(path=None, max_memory_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    # touch "a" so "b" is the least recently used
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_disk_persists_between_instances(cache_path: Path):
+    cache = ResponseCache(path=cache_path)
+    cache.set("key", "value")
+    cache.close()
+
+    reopened = ResponseCache(path=cache_path)
+    assert reopened.get("key") == "value"
+    assert reopened.stats()["disk_hits"] == 1
+    # promoted to memory
+    assert reopened.get("key") == "value"
+    assert reopened.stats()["memory_hits"] == 1
+
+
+def test_disk_size_eviction(cache_path: Path):
+    cache = ResponseCache(path=cache_path, max_memory_entries=1, max_disk_entries=2)
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+        # accessed_at needs to differ between entries
+        time.sleep(0.01)
+
+    assert cache.stats()["disk_entries"] == 2
+    assert cache.get("a") is None
+    assert cache.get("b") == "b"
+
+
+def test_ttl_expiry(cache_path: Path):
+    cache = ResponseCache(path=cache_path, ttl_s=0.05)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+
+    time.sleep(0.1)
+    assert cache.get("key") is None
+    assert cache.stats()["disk_entries"] == 0
+
+
+def accessed_at(cache_path: Path, key: str) -> float:
+    with sqlite3.connect(cache_path) as connection:
+        return connection.execute(
+            "SELECT accessed_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()[0]
+
+
+def test_access_times_are_written_in_batches(cache_path: Path):
+    cache = ResponseCache(path=cache_path)
+    cache.set("a", "1")
+    cache.close()
+    stored = accessed_at(cache_path, "a")
+
+    reopened = ResponseCache(path=cache_path)
+    time.sleep(0.01)
+    assert reopened.get("a") == "1"
+    # written with the next set
+    assert accessed_at(cache_path, "a") == stored
+    reopened.set("b", "2")
+    assert accessed_at(cache_path, "a") > stored
+
+
+def test_eviction_is_periodic(cache_path: Path, monkeypatch):
+    monkeypatch.setattr(response_cache, "EVICTION_INTERVAL_SETS", 3)
+    cache = ResponseCache(path=cache_path, ttl_s=0.05)
+    cache.set("old", "1")
+    time.sleep(0.1)
+
+    cache.set("a", "2")
+    assert cache.stats()["disk_entries"] == 2
+    # the third set evicts the expired entry
+    cache.set("b", "3")
+    assert cache.stats()["disk_entries"] == 2
+
+
+def test_clear(cache_path: Path):
+    cache = ResponseCache(path=cache_path)
+    cache.set("key", "value")
+    cache.get("key")
+    cache.clear()
+
+    assert cache.stats() == {
+        "memory_hits": 0,
+        "disk_hits": 0,
+        "misses": 0,
+        "memory_entries": 0,
+        "disk_entries": 0,
+    }
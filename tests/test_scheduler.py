@@ -0,0 +1,319 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+from instructor.exceptions import InstructorRetryException
+
+from comfyui_structured_outputs.api_keys import ApiKey, ApiKeyPool
+from comfyui_structured_outputs.hedging import MIN_HEDGE_DELAY_S, MIN_HEDGE_SAMPLES
+from comfyui_structured_outputs.metrics import (
+    METRICS_PREFIX,
+    RequestTimings,
+    get_metrics,
+)
+from comfyui_structured_outputs.scheduler import (
+    AdaptiveConcurrency,
+    RequestScheduler,
+    TokenBucket,
+    estimate_tokens,
+    retry_after_s,
+)
+from comfyui_structured_outputs.utils.image_utils import EncodedImage
+
+
+def rate_limit_error(headers: dict | None = None) -> openai.RateLimitError:
+    response = httpx.Response(
+        429,
+        headers=headers or {},
+        request=httpx.Request("POST", "http://test/v1/chat/completions"),
+    )
+    return openai.RateLimitError("Rate limited", response=response, body=None)
+
+
+class FlakyCall:
+    """Raises the given errors on the first calls, then returns the number of calls."""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.calls
+
+
+def test_token_bucket_take_and_wait():
+    bucket = TokenBucket(rate_per_minute=600, capacity=2)
+
+    assert bucket.try_take(1) == 0
+    assert bucket.try_take(1) == 0
+    # empty, refills at 10 per second
+    assert bucket.try_take(1) == pytest.approx(0.1, abs=0.02)
+    assert bucket.take(1) <= 0.15
+
+
+def test_token_bucket_overdraw_and_adjust():
+    bucket = TokenBucket(rate_per_minute=60, capacity=10)
+
+    # more than the capacity is taken from a full bucket, leaving a debt
+    assert bucket.try_take(15) == 0
+    assert bucket.level == pytest.approx(-5, abs=0.1)
+    # the request used fewer tokens than estimated
+    bucket.adjust(-10)
+    assert bucket.level == pytest.approx(5, abs=0.1)
+
+
+def test_adaptive_concurrency():
+    concurrency = AdaptiveConcurrency(max_limit=8, initial_limit=4)
+
+    for _ in range(4):
+        concurrency.on_success()
+    assert concurrency.limit == pytest.approx(5, abs=0.1)
+
+    assert concurrency.on_congestion(0.5)
+    assert concurrency.limit == pytest.approx(2.5, abs=0.1)
+    # concurrent 429s only cut the limit once
+    assert not concurrency.on_congestion(0.5)
+    assert concurrency.limit == pytest.approx(2.5, abs=0.1)
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"retry-after-ms": "250"}, 0.25),
+        ({"retry-after": "2"}, 2.0),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0.0),
+        ({"retry-after": "soon"}, None),
+        ({}, None),
+    ],
+)
+def test_retry_after_s(headers, expected):
+    assert retry_after_s(rate_limit_error(headers)) == expected
+
+
+def test_run_retries_rate_limits():
+    scheduler = RequestScheduler("scheduler_test", max_concurrency=4)
+    call = FlakyCall(rate_limit_error({"retry-after-ms": "50"}))
+
+    start = time.perf_counter()
+    assert scheduler.run(call) == 2
+    # waited for the Retry-After
+    assert time.perf_counter() - start >= 0.05
+    assert scheduler.concurrency.limit < 4
+    assert (
+        get_metrics().counter_value(
+            f"{METRICS_PREFIX}_rate_limited_total", backend="scheduler_test"
+        )
+        >= 1
+    )
+
+
+def test_run_unwraps_instructor_errors():
+    scheduler = RequestScheduler("scheduler_test")
+    wrapped = InstructorRetryException(
+        rate_limit_error({"retry-after-ms": "1"}),
+        n_attempts=1,
+        total_usage=0,
+    )
+
+    assert scheduler.run(FlakyCall(wrapped)) == 2
+
+
+def test_run_raises_other_errors_and_exhausted_retries():
+    scheduler = RequestScheduler("scheduler_test", max_retries=1)
+
+    call = FlakyCall(ValueError("invalid"))
+    with pytest.raises(ValueError):
+        scheduler.run(call)
+    assert call.calls == 1
+
+    call = FlakyCall(*[rate_limit_error({"retry-after-ms": "1"})] * 2)
+    with pytest.raises(openai.RateLimitError):
+        scheduler.run(call)
+    assert call.calls == 2
+    # slots are released on errors
+    assert scheduler.concurrency.in_flight == 0
+
+
+def test_run_limits_concurrency():
+    scheduler = RequestScheduler("scheduler_test", max_concurrency=2)
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def call():
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+
+    threads = [threading.Thread(target=scheduler.run, args=(call,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_in_flight == 2
+
+
+def test_run_stops_retrying_at_deadline():
+    scheduler = RequestScheduler("scheduler_test")
+    call = FlakyCall(*[rate_limit_error({"retry-after-ms": "200"})] * 3)
+
+    # the retry would start after the deadline
+    with pytest.raises(openai.RateLimitError):
+        scheduler.run(call, deadline=time.monotonic() + 0.1)
+    assert call.calls == 1
+
+    call = FlakyCall()
+    with pytest.raises(TimeoutError):
+        scheduler.run(call, deadline=time.monotonic() - 1)
+    assert call.calls == 0
+    assert scheduler.concurrency.in_flight == 0
+
+
+def test_run_takes_tokens_once_per_call():
+    scheduler = RequestScheduler("scheduler_tokens_test", tokens_per_minute=60)
+    # a large capacity, and a refill that is negligible during the test
+    scheduler.tokens = TokenBucket(rate_per_minute=60, capacity=10_000)
+    full = scheduler.tokens.level
+    call = FlakyCall(*[rate_limit_error({"retry-after-ms": "1"})] * 2)
+
+    timings = RequestTimings()
+    assert scheduler.run(call, estimated_tokens=1000, timings=timings) == 3
+    assert call.calls == 3
+    assert full - scheduler.tokens.level == pytest.approx(1000, abs=5)
+    assert "queue" in timings.stages_s
+
+    # a failed call gives its tokens back
+    level = scheduler.tokens.level
+    with pytest.raises(ValueError):
+        scheduler.run(FlakyCall(ValueError("invalid")), estimated_tokens=1000)
+    assert scheduler.tokens.level == pytest.approx(level, abs=5)
+
+
+def test_run_deadline_bounds_saturated_bucket():
+    scheduler = RequestScheduler("scheduler_deadline_test", requests_per_minute=6)
+    # empty the bucket, the next request is in 10 s
+    scheduler.requests.take(scheduler.requests.capacity)
+    call = FlakyCall()
+
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError, match="deadline"):
+        scheduler.run(call, deadline=time.monotonic() + 0.1)
+    assert time.perf_counter() - start < 0.5
+    assert call.calls == 0
+    # the slot is given back
+    assert scheduler.concurrency.in_flight == 0
+
+
+def test_run_deadline_bounds_concurrency_and_pause():
+    scheduler = RequestScheduler("scheduler_deadline_test", max_concurrency=1)
+    scheduler.concurrency.acquire()
+    with pytest.raises(TimeoutError):
+        scheduler.run(FlakyCall(), deadline=time.monotonic() + 0.05)
+    scheduler.concurrency.release()
+
+    scheduler.pause(10)
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        scheduler.run(FlakyCall(), deadline=time.monotonic() + 0.05)
+    assert time.perf_counter() - start < 0.5
+    assert scheduler.concurrency.in_flight == 0
+
+
+def test_token_bucket_take_deadline():
+    bucket = TokenBucket(rate_per_minute=60, capacity=1)
+    bucket.take(1)
+    with pytest.raises(TimeoutError):
+        bucket.take(1, deadline=time.monotonic() + 0.1)
+    # nothing was taken
+    assert bucket.level > -0.5
+
+
+def test_run_hedges_slow_calls():
+    scheduler = RequestScheduler("scheduler_hedge_test", max_concurrency=4)
+    # no hedging until enough latencies were observed
+    assert scheduler.hedge_after_s(90) is None
+    for _ in range(MIN_HEDGE_SAMPLES):
+        scheduler.run(lambda: None)
+    assert scheduler.hedge_after_s(90) >= MIN_HEDGE_DELAY_S
+
+    calls = 0
+    release = threading.Event()
+
+    def call():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            release.wait(timeout=5)
+            return "slow"
+        return "hedged"
+
+    timings = RequestTimings()
+    try:
+        assert scheduler.run(call, timings=timings, hedge_percentile=90) == "hedged"
+    finally:
+        release.set()
+    assert timings.hedged
+    assert (
+        get_metrics().counter_value(
+            f"{METRICS_PREFIX}_hedge_wins_total", backend="scheduler_hedge_test"
+        )
+        == 1
+    )
+
+
+def test_abandoned_hedge_releases_slot_and_key():
+    scheduler = RequestScheduler("scheduler_hedge_release_test", max_concurrency=4)
+    for _ in range(MIN_HEDGE_SAMPLES):
+        scheduler.run(lambda: None)
+    key = ApiKey("key")
+    key_pool = ApiKeyPool([key])
+
+    calls = 0
+    started = threading.Event()
+    release = threading.Event()
+
+    def call():
+        nonlocal calls
+        with key_pool.lease():
+            calls += 1
+            if calls == 1:
+                started.set()
+                release.wait(timeout=5)
+                raise openai.APIConnectionError(
+                    request=httpx.Request("POST", "http://test/v1/chat/completions")
+                )
+            return "hedged"
+
+    try:
+        assert scheduler.run(call, hedge_percentile=90) == "hedged"
+        assert started.is_set()
+        # the first call is still running, but gave back its slot and key
+        assert scheduler.concurrency.in_flight == 0
+        assert key_pool.stats()[key.label]["in_flight"] == 0
+    finally:
+        release.set()
+    time.sleep(0.1)
+    # and it isn't retried
+    assert calls == 2
+    assert scheduler.concurrency.in_flight == 0
+    assert key_pool.stats()[key.label]["in_flight"] == 0
+    assert key_pool.stats()[key.label]["failures"] == 0
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("a" * 400) == 100
+
+    image = EncodedImage(b"", "image/png", 1024, 1024, 0.0)
+    # scaled to 768x768, 4 tiles
+    assert estimate_tokens("", image) == 85 + 4 * 170
+    assert estimate_tokens("", image, detail="low") == 85
@@ -0,0 +1,56 @@
+import os
+
+from comfyui_structured_outputs.settings import Settings, get_settings
+
+
+def test_settings_reload_when_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.delenv("SETTINGS_TEST_KEY", raising=False)
+    dotenv_path = tmp_path / ".env"
+    dotenv_path.write_text("SETTINGS_TEST_KEY=first\n")
+    settings = Settings(dotenv_path)
+
+    assert settings.get("SETTINGS_TEST_KEY") == "first"
+    assert settings.get("SETTINGS_TEST_KEY") == "first"
+    # parsed once for both lookups
+    assert settings.loads == 1
+
+    dotenv_path.write_text("SETTINGS_TEST_KEY=second value\n")
+    # make sure the modification time changes, even on coarse clocks
+    stat = dotenv_path.stat()
+    os.utime(dotenv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert settings.get("SETTINGS_TEST_KEY") == "second value"
+    assert settings.loads == 2
+
+
+def test_settings_environment_takes_precedence(tmp_path, monkeypatch):
+    dotenv_path = tmp_path / ".env"
+    dotenv_path.write_text("SETTINGS_TEST_KEY=from_file\n")
+    settings = Settings(dotenv_path)
+
+    monkeypatch.setenv("SETTINGS_TEST_KEY", "from_env")
+    assert settings.get("SETTINGS_TEST_KEY") == "from_env"
+    monkeypatch.delenv("SETTINGS_TEST_KEY")
+    assert settings.get("SETTINGS_TEST_KEY") == "from_file"
+    assert settings.get("SETTINGS_TEST_MISSING", "default") == "default"
+
+
+def test_settings_missing_file(tmp_path, monkeypatch, caplog):
+    monkeypatch.delenv("SETTINGS_TEST_KEY", raising=False)
+    dotenv_path = tmp_path / ".env"
+    settings = Settings(dotenv_path)
+
+    assert settings.get("SETTINGS_TEST_KEY") is None
+    assert settings.get("SETTINGS_TEST_KEY") is None
+    assert not settings.file_exists()
+    # the missing file is only reported once
+    assert caplog.text.count("does not exist") <= 1
+
+    # picked up once it is created
+    dotenv_path.write_text("SETTINGS_TEST_KEY=created\n")
+    assert settings.get("SETTINGS_TEST_KEY") == "created"
+    assert settings.file_exists()
+
+
+def test_get_settings_is_shared_per_path(tmp_path):
+    assert get_settings(tmp_path / ".env") is get_settings(tmp_path / ".env")
+    assert get_settings(tmp_path / ".env") is not get_settings(tmp_path / "other")
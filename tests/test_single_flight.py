@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from comfyui_structured_outputs.single_flight import SingleFlight
+from comfyui_structured_outputs.utils.utils import map_concurrently
+
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return {"color": "red"}
+
+    results = map_concurrently(
+        lambda _: single_flight.do("key", fetch), range(4), max_concurrency=4
+    )
+
+    assert len(calls) == 1
+    assert [result for result, _ in results] == [{"color": "red"}] * 4
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert single_flight.stats() == {"leaders": 1, "followers": 3, "in_flight": 0}
+
+
+def test_different_keys_are_not_coalesced():
+    single_flight = SingleFlight()
+
+    results = map_concurrently(
+        lambda key: single_flight.do(key, lambda: time.sleep(0.05) or key),
+        ["a", "b"],
+        max_concurrency=2,
+    )
+
+    assert results == [("a", False), ("b", False)]
+
+
+def test_sequential_calls_are_not_coalesced():
+    single_flight = SingleFlight()
+
+    assert single_flight.do("key", lambda: 1) == (1, False)
+    # the first call finished, so this makes a new call
+    assert single_flight.do("key", lambda: 2) == (2, False)
+
+
+def test_errors_are_raised_in_every_caller():
+    single_flight = SingleFlight()
+
+    def fetch():
+        time.sleep(0.1)
+        raise RuntimeError("failed")
+
+    errors = []
+
+    def call(_):
+        try:
+            single_flight.do("key", fetch)
+        except RuntimeError as e:
+            errors.append(e)
+
+    map_concurrently(call, range(3), max_concurrency=3)
+
+    assert len(errors) == 3
+    assert single_flight.in_flight() == 0
+    with pytest.raises(RuntimeError):
+        single_flight.do("key", fetch)
+
+
+def test_waiting_caller_deadline():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(
+            single_flight.do("key", lambda: release.wait(timeout=5) and "answer")
+        )
+    )
+    leader.start()
+    while not single_flight.in_flight():
+        time.sleep(0.001)
+
+    # the waiting caller gives up at its deadline, the call goes on for the others
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        single_flight.do("key", lambda: "other", deadline=time.monotonic() + 0.05)
+    assert time.monotonic() - start < 1
+    release.set()
+    leader.join()
+    assert results == [("answer", False)]
@@ -0,0 +1,113 @@
+import types
+
+import pytest
+from instructor import Partial
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.streaming import (
+    completed_attributes,
+    stream_structured_output,
+)
+
+ColorAttr = create_attribute_model("color", "str")
+CountAttr = create_attribute_model("count", "int")
+ReturnModel = attributes_to_model([ColorAttr, CountAttr])
+PartialReturnModel = Partial[ReturnModel].get_partial_model()
+
+# successive partial objects, as parsed from a streamed response
+CHUNKS: list[dict] = [
+    {},
+    {"color": {"key": "color", "value": "bl"}},
+    {"color": {"key": "color", "value": "blue"}},
+    {"color": {"key": "color", "value": "blue"}, "count": {"key": "count"}},
+    {
+        "color": {"key": "color", "value": "blue"},
+        "count": {"key": "count", "value": 3},
+    },
+    {
+        "color": {"key": "color", "value": "blue"},
+        "count": {"key": "count", "value": 3, "error": None},
+    },
+    # trailing chunks, e.g. closing braces
+    {
+        "color": {"key": "color", "value": "blue"},
+        "count": {"key": "count", "value": 3, "error": None},
+    },
+]
+
+
+class FakeStreamingClient:
+    """Yields partial responses built from `chunks`, and records if the stream was closed early."""
+
+    def __init__(self, chunks: list[dict]):
+        self.chunks = chunks
+        self.yielded = 0
+        self.closed = False
+        self.chat = types.SimpleNamespace(
+            completions=types.SimpleNamespace(create_partial=self.create_partial)
+        )
+
+    def create_partial(self, model, response_model, messages, **kwargs):
+        partial_model = Partial[response_model].get_partial_model()
+        try:
+            for chunk in self.chunks:
+                self.yielded += 1
+                yield partial_model.model_validate(chunk)
+        finally:
+            self.closed = True
+
+
+@pytest.mark.parametrize(
+    "chunk_index, expected",
+    [(0, []), (1, []), (3, ["color"]), (4, ["color"]), (5, ["color", "count"])],
+)
+def test_completed_attributes(chunk_index, expected):
+    partial = PartialReturnModel.model_validate(CHUNKS[chunk_index])
+    assert completed_attributes(partial, ["color", "count"]) == expected
+
+
+def test_stream_stops_early():
+    client = FakeStreamingClient(CHUNKS)
+    completed = []
+
+    response, stats = stream_structured_output(
+        client,
+        ReturnModel,
+        messages=[],
+        model="gpt-4o",
+        on_attribute=lambda name, value, elapsed: completed.append((name, value)),
+    )
+
+    assert response.color.value == "blue"
+    assert response.count.value == 3
+    assert completed == [("color", "blue"), ("count", 3)]
+    assert stats.stopped_early
+    assert client.closed
+    # the trailing chunk was never read
+    assert client.yielded == len(CHUNKS) - 1
+    assert stats.first_chunk_s <= stats.first_attribute_s <= stats.total_s
+    assert set(stats.attribute_s) == {"color", "count"}
+
+
+def test_stream_without_stop_early_reads_everything():
+    # without an `error` field, the last attribute only completes when the stream ends
+    client = FakeStreamingClient(CHUNKS[:5])
+
+    response, stats = stream_structured_output(
+        client, ReturnModel, messages=[], model="gpt-4o", stop_early=False
+    )
+
+    assert response.count.value == 3
+    assert not stats.stopped_early
+    assert client.yielded == 5
+    assert stats.attribute_s["count"] == stats.total_s
+
+
+def test_empty_stream_raises():
+    with pytest.raises(ValueError, match="Stream ended"):
+        stream_structured_output(
+            FakeStreamingClient([]), ReturnModel, messages=[], model="gpt-4o"
+        )
@@ -0,0 +1,76 @@
+import pytest
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.templates import compile_template
+
+ReturnModel = attributes_to_model(
+    [
+        create_attribute_model("subject", "str"),
+        create_attribute_model("count", "int"),
+        create_attribute_model("score", "float"),
+    ]
+)
+
+
+def make_attributes(subject: str, count: int, score: float = 0.5):
+    return ReturnModel.model_validate(
+        {
+            "subject": {"key": "subject", "value": subject},
+            "count": {"key": "count", "value": count},
+            "score": {"key": "score", "value": score},
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "format_text",
+    [
+        "",
+        "no placeholders",
+        "{count} {subject}s",
+        "{subject!r} scored {score:.2f}, {{literal braces}}",
+        "{count:>{count}}",
+        "{subject:>{count}}",
+        "{score:.{count}f}",
+        "{subject[0]}{subject.upper}",
+    ],
+)
+def test_render_matches_str_format(format_text):
+    attributes = make_attributes("cat", 3, 0.875)
+    mapping = {key: value["value"] for key, value in attributes.model_dump().items()}
+
+    assert compile_template(format_text).render(attributes) == format_text.format(
+        **mapping
+    )
+
+
+def test_templates_are_cached():
+    assert compile_template("{subject}") is compile_template("{subject}")
+    assert compile_template("{subject}").field_names == {"subject"}
+    assert compile_template("{subject:>{count}}").field_names == {"subject", "count"}
+
+
+def test_render_batch():
+    template = compile_template("{count} {subject}")
+    results = [make_attributes("cat", 1), make_attributes("dog", 2)]
+
+    assert template.render_batch(results) == ["1 cat", "2 dog"]
+
+
+@pytest.mark.parametrize(
+    "format_text", ["{unknown}", "{subject} {color.value}", "{subject:>{width}}"]
+)
+def test_unknown_placeholders_raise(format_text):
+    with pytest.raises(ValueError, match="not attributes"):
+        compile_template(format_text).render_batch([make_attributes("cat", 1)])
+
+
+@pytest.mark.parametrize(
+    "format_text", ["{}", "{0}", "{subject", "}", "{subject:>{}}", "{subject:>{0}}"]
+)
+def test_invalid_templates_raise(format_text):
+    with pytest.raises(ValueError):
+        compile_template(format_text)
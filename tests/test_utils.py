@@ -1,4 +1,6 @@
 import tempfile
+import threading
+import time
 from pathlib import Path
 
 import pytest
@@ -7,6 +9,9 @@ from comfyui_structured_outputs.utils.utils import (
     change_dir,
     dotenv_file_exists,
     get_env,
+    get_env_flag,
+    lazy_import,
+    map_concurrently,
 )
 
 
@@ -42,3 +47,74 @@ def test_dotenv(env_file_items: dict):
 
     value1 = get_env("SOME_KEY")
     assert value1 == "A_VALUE"
+
+
+@pytest.mark.parametrize(
+    "env_file_items",
+    [{"FLAG_ON": "true", "FLAG_ONE": "1", "FLAG_OFF": "false"}],
+    indirect=True,
+)
+def test_get_env_flag(env_file_items: dict):
+    assert get_env_flag("FLAG_ON")
+    assert get_env_flag("FLAG_ONE")
+    assert not get_env_flag("FLAG_OFF", default=True)
+    assert get_env_flag("FLAG_MISSING", default=True)
+
+
+def test_map_concurrently_preserves_order():
+    def slow_square(value: int) -> int:
+        # later items finish first
+        time.sleep(0.01 * (5 - value))
+        return value * value
+
+    assert map_concurrently(slow_square, range(5), max_concurrency=5) == [
+        0,
+        1,
+        4,
+        9,
+        16,
+    ]
+
+
+def test_map_concurrently_limits_concurrency():
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def track(_):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+
+    map_concurrently(track, range(20), max_concurrency=3)
+    assert 1 < max_in_flight <= 3
+
+
+def test_map_concurrently_raises():
+    def fail_on_two(value: int) -> int:
+        if value == 2:
+            raise RuntimeError("failed")
+        return value
+
+    with pytest.raises(RuntimeError, match="failed"):
+        map_concurrently(fail_on_two, range(4), max_concurrency=2)
+
+    with pytest.raises(ValueError):
+        map_concurrently(fail_on_two, range(4), max_concurrency=0)
+
+
+def test_lazy_import_imports_on_first_use():
+    module = lazy_import("json")
+    assert not module.is_loaded
+    assert module.dumps({"a": 1}) == '{"a": 1}'
+    assert module.is_loaded
+
+
+def test_lazy_import_missing_module_fails_on_use():
+    module = lazy_import("not_an_installed_module")
+    with pytest.raises(ModuleNotFoundError):
+        _ = module.anything
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+from pydantic import ValidationError
+
+from comfyui_structured_outputs.attribute_utils import (
+    attributes_to_model,
+    create_attribute_model,
+)
+from comfyui_structured_outputs.packing import packed_model
+from comfyui_structured_outputs.wire_schema import (
+    compact_json_schema,
+    expand_response,
+    schema_tokens,
+    wire_model,
+)
+
+ColorAttr = create_attribute_model("color", "str", options="red, blue")
+CountAttr = create_attribute_model(
+    "count", "int", description="Number of cats", example="3"
+)
+ReturnModel = attributes_to_model([ColorAttr, CountAttr])
+
+
+def test_compact_json_schema_drops_titles_and_empty_examples():
+    schema = {
+        "title": "Root",
+        "type": "object",
+        "properties": {
+            "title": {"title": "Title", "type": "string", "examples": [None]},
+            "name": {"title": "Name", "type": "string", "examples": ["cat"]},
+        },
+    }
+    assert compact_json_schema(schema) == {
+        "title": "Root",
+        "type": "object",
+        "properties": {
+            # a property called "title" is kept
+            "title": {"type": "string"},
+            "name": {"type": "string", "examples": ["cat"]},
+        },
+    }
+
+
+def test_compact_json_schema_merges_identical_defs():
+    schema = {
+        "$defs": {
+            "A": {"title": "A", "type": "string"},
+            "B": {"title": "B", "type": "string"},
+            "C": {"title": "C", "type": "integer"},
+        },
+        "properties": {
+            "a": {"$ref": "#/$defs/A"},
+            "b": {"$ref": "#/$defs/B"},
+            "c": {"$ref": "#/$defs/C"},
+        },
+    }
+    compacted = compact_json_schema(schema)
+    assert set(compacted["$defs"]) == {"A", "C"}
+    assert compacted["properties"]["b"] == {"$ref": "#/$defs/A"}
+    assert compacted["properties"]["c"] == {"$ref": "#/$defs/C"}
+
+
+def test_wire_model_is_flat():
+    model = wire_model(ReturnModel)
+    assert wire_model(ReturnModel) is model
+
+    schema = model.model_json_schema()
+    assert "$defs" not in schema
+    assert schema["title"] == ReturnModel.__name__
+    assert set(schema["properties"]) == {"color", "count"}
+    assert schema["properties"]["color"]["enum"] == ["red", "blue"]
+    assert schema["properties"]["count"] == {
+        "type": "integer",
+        "description": "Number of cats",
+        "examples": ["3"],
+    }
+
+
+def test_wire_model_reduces_schema_tokens():
+    attributes = [
+        create_attribute_model(f"attribute_{i}", "str", description=f"Attribute {i}")
+        for i in range(20)
+    ]
+    model = attributes_to_model(attributes)
+    assert schema_tokens(wire_model(model)) < schema_tokens(model) / 2
+
+
+def test_expand_response():
+    response = wire_model(ReturnModel).model_validate_json(
+        json.dumps({"color": "blue", "count": 2})
+    )
+    expanded = expand_response(response, ReturnModel)
+    assert isinstance(expanded, ReturnModel)
+    assert expanded.color.key == "color"
+    assert expanded.color.value == "blue"
+    assert expanded.count.value == 2
+    assert expanded.count.error is None
+
+
+def test_wire_model_validates_options():
+    with pytest.raises(ValidationError):
+        wire_model(ReturnModel).model_validate({"color": "green", "count": 2})
+
+
+def test_packed_wire_model():
+    packed = packed_model(wire_model(ReturnModel)).model_validate(
+        {"results": [{"index": 0, "attributes": {"color": "red", "count": 1}}]}
+    )
+    expanded = expand_response(packed.results[0].attributes, ReturnModel)
+    assert expanded.color.value == "red"